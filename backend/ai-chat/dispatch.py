@@ -0,0 +1,209 @@
+"""
+Стратегии опроса цепочки моделей: sequential, hedged и race.
+sequential — как раньше: следующая модель только после отказа или ошибки предыдущей.
+hedged — следующая модель стартует, если предыдущая не ответила за LLM_HEDGE_DELAY_MS.
+race — все модели стартуют сразу, побеждает первый приемлемый ответ.
+Проигравшие запросы отменяются закрытием их соединений (llm.Cancel), по каждой
+модели ведутся счётчики задержки и побед. Стратегия действует на обычные ответы
+ai-chat; потоковый ответ (stream_reply в index.py) всегда последовательный.
+
+Пул потоков: hedged и race держат до длины цепочки потоков на запрос, поэтому
+LLM_DISPATCH_WORKERS задаётся не меньше двух на каждый одновременный запрос;
+по умолчанию — 2 * LLM_POOL_SIZE.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import llm
+import tracing
+
+
+STRATEGIES = ('sequential', 'hedged', 'race')
+STRATEGY = os.environ.get('LLM_DISPATCH_STRATEGY', 'sequential')
+HEDGE_DELAY_MS = int(os.environ.get('LLM_HEDGE_DELAY_MS', '2500'))
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('LLM_DISPATCH_WORKERS', str(2 * llm.POOL_SIZE))),
+    thread_name_prefix='llm-dispatch'
+)
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+class Cancelled(Exception):
+    """Запрос к модели отменён: другой ответ уже победил"""
+
+
+def _record(strategy: str, model: str, outcome: str, latency_ms: float = None) -> None:
+    with _stats_lock:
+        stats = _stats.get((strategy, model))
+        if stats is None:
+            stats = _stats[(strategy, model)] = {
+                'attempts': 0,
+                'wins': 0,
+                'refusals': 0,
+                'failures': 0,
+                'cancelled': 0,
+                'latencies_ms': deque(maxlen=256)
+            }
+        if outcome == 'attempt':
+            stats['attempts'] += 1
+        elif outcome == 'win':
+            stats['wins'] += 1
+        elif outcome == 'refusal':
+            stats['refusals'] += 1
+        elif outcome == 'failure':
+            stats['failures'] += 1
+        elif outcome == 'cancelled':
+            stats['cancelled'] += 1
+        if latency_ms is not None:
+            stats['latencies_ms'].append(latency_ms)
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+
+
+def dispatch_stats() -> dict:
+    """Счётчики по стратегиям и моделям: попытки, победы, доля побед, p50/p95 задержки"""
+    with _stats_lock:
+        snapshot = {key: dict(value, latencies_ms=list(value['latencies_ms'])) for key, value in _stats.items()}
+    report = {}
+    for (strategy, model), stats in snapshot.items():
+        latencies = stats.pop('latencies_ms')
+        stats['win_rate'] = round(stats['wins'] / stats['attempts'], 3) if stats['attempts'] else 0.0
+        stats['latency_p50_ms'] = _percentile(latencies, 0.5)
+        stats['latency_p95_ms'] = _percentile(latencies, 0.95)
+        report.setdefault(strategy, {})[model] = stats
+    return report
+
+
+def _attempt(strategy: str, api_key: str, model: str, messages: list, cancel: llm.Cancel,
+             watch=None) -> str:
+    """
+    Потоковый запрос к модели, который обрывается, как только выставлен cancel:
+    соединение закрывается и в ожидании заголовков, и между фрагментами.
+    watch — фабрика потокового детектора отказа: если feed() вернул True,
+    остаток ответа не читается и возвращается уже полученное начало.
+    """
+    _record(strategy, model, 'attempt')
+    started = time.monotonic()
+    parts = []
+    detector = watch() if watch else None
+    chunks = llm.stream(api_key, model, messages, cancel=cancel)
+    try:
+        for delta in chunks:
+            if cancel.is_set():
+                raise Cancelled(model)
+            parts.append(delta)
+            if detector is not None and detector.feed(delta):
+                break
+    except Exception:
+        if cancel.is_set():
+            _record(strategy, model, 'cancelled')
+            raise Cancelled(model)
+        _record(strategy, model, 'failure', (time.monotonic() - started) * 1000)
+        raise
+    finally:
+        chunks.close()
+    _record(strategy, model, 'success', (time.monotonic() - started) * 1000)
+    return ''.join(parts)
+
+
+def _complete(strategy: str, api_key: str, model: str, messages: list) -> str:
+    _record(strategy, model, 'attempt')
+    started = time.monotonic()
+    try:
+        text = llm.complete(api_key, model, messages)
+    except Exception:
+        _record(strategy, model, 'failure', (time.monotonic() - started) * 1000)
+        raise
+    _record(strategy, model, 'success', (time.monotonic() - started) * 1000)
+    return text
+
+
+def _sequential(api_key: str, models: list, messages: list, accept, watch=None) -> tuple:
+    last_error = None
+    for index, (model, label) in enumerate(models):
+        try:
+            if watch is None or index == len(models) - 1:
+                text = _complete('sequential', api_key, model, messages)
+            else:
+                # С детектором отказа читаем поток, чтобы перейти к следующей модели по первым фрагментам
+                text = _attempt('sequential', api_key, model, messages, llm.Cancel(), watch)
+        except Exception as e:
+            last_error = e
+            continue
+        if accept(text) or index == len(models) - 1:
+            _record('sequential', model, 'win')
+            return text, label
+        _record('sequential', model, 'refusal')
+    raise last_error
+
+
+def _concurrent(strategy: str, api_key: str, models: list, messages: list, accept,
+                hedge_delay: float, watch=None) -> tuple:
+    cancel = llm.Cancel()
+    waiting = list(enumerate(models))
+    running = {}
+    rejected = {}
+    last_error = None
+    next_start = time.monotonic()
+    try:
+        while waiting or running:
+            now = time.monotonic()
+            if waiting and (now >= next_start or not running):
+                index, (model, label) = waiting.pop(0)
+                # Последней модели обрывать нечего: её ответ отдаётся и при отказе
+                model_watch = watch if index < len(models) - 1 else None
+                future = _executor.submit(tracing.bind(_attempt), strategy, api_key, model, messages, cancel, model_watch)
+                running[future] = (index, model, label)
+                next_start = time.monotonic() + hedge_delay
+                continue
+
+            timeout = max(0.0, next_start - now) if waiting else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, model, label = running.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if accept(text):
+                    _record(strategy, model, 'win')
+                    return text, label
+                _record(strategy, model, 'refusal')
+                rejected[index] = (model, text, label)
+    finally:
+        cancel.set()
+
+    # Приемлемых ответов нет: как и в sequential, отдаём ответ самой дальней модели цепочки
+    if rejected:
+        model, text, label = rejected[max(rejected)]
+        _record(strategy, model, 'win')
+        return text, label
+    raise last_error
+
+
+def dispatch(api_key: str, models: list, messages: list, accept, strategy: str = None,
+             watch=None) -> tuple:
+    """
+    Ответ цепочки моделей [(model, label), ...] по выбранной стратегии.
+    accept(text) решает, годится ли ответ; watch — необязательная фабрика
+    потокового детектора отказа для раннего обрыва. Возвращает (text, label).
+    """
+    strategy = strategy or STRATEGY
+    if strategy not in STRATEGIES:
+        strategy = 'sequential'
+    if strategy == 'sequential':
+        return _sequential(api_key, models, messages, accept, watch)
+    hedge_delay = HEDGE_DELAY_MS / 1000 if strategy == 'hedged' else 0.0
+    return _concurrent(strategy, api_key, models, messages, accept, hedge_delay, watch)
@@ -1,9 +1,97 @@
 import json
 import os
-import requests
 
+import llm
+import personas
+import reply_cache
+import tracing
+from dispatch import dispatch
+from refusal import RefusalDetector, is_refusal
+
+
+def stream_reply(api_key: str, prompt: personas.Prompt, user_message: str = None):
+    '''
+    SSE-поток: основная модель персонажа, пока детектор не решил, что начало ответа —
+    не отказ; при отказе — последняя модель цепочки (Llama 3.3 → DeepSeek).
+    Всегда последовательно: LLM_DISPATCH_STRATEGY (hedged, race) действует только
+    на обычный ответ через dispatch, поток отдаётся клиенту от одной модели.
+    '''
+    character_id = prompt.persona.id
+    (primary, primary_label), (fallback, fallback_label) = prompt.persona.models[0], prompt.persona.models[-1]
+    cached = reply_cache.lookup(character_id, user_message) if user_message else None
+    if cached:
+        text, model_label = cached
+        yield llm.sse_event({'delta': text})
+        yield llm.sse_event({'response': text, 'model': model_label, 'cached': True}, event='done')
+        return
+    
+    detector = RefusalDetector()
+    held = []
+    released = False
+    chunks = llm.stream(api_key, primary, prompt)
+    try:
+        for delta in chunks:
+            held.append(delta)
+            if released:
+                yield llm.sse_event({'delta': delta})
+                continue
+            verdict = detector.feed(delta)
+            if verdict is None:
+                continue
+            if verdict:
+                # Отказ виден по первым фрагментам: Llama обрывается, сразу идём к DeepSeek
+                break
+            released = True
+            yield llm.sse_event({'delta': ''.join(held)})
+        else:
+            primary_text = ''.join(held)
+            if released or not detector.finish():
+                if not released:
+                    yield llm.sse_event({'delta': primary_text})
+                if user_message:
+                    reply_cache.store(character_id, user_message, (primary_text.strip(), primary_label))
+                yield llm.sse_event({'response': primary_text.strip(), 'model': primary_label}, event='done')
+                return
+    except Exception:
+        if released:
+            yield llm.sse_event({'response': ''.join(held).strip(), 'model': primary_label}, event='done')
+            return
+    finally:
+        chunks.close()
+    
+    parts = []
+    try:
+        for delta in llm.stream(api_key, fallback, prompt):
+            parts.append(delta)
+            yield llm.sse_event({'delta': delta})
+    except Exception as e:
+        if not parts:
+            yield llm.sse_event({'error': f'All models failed: {str(e)}'}, event='error')
+            return
+    else:
+        if user_message and not is_refusal(''.join(parts)):
+            reply_cache.store(character_id, user_message, (''.join(parts).strip(), fallback_label))
+    
+    yield llm.sse_event({'response': ''.join(parts).strip(), 'model': fallback_label}, event='done')
+
+
+@tracing.traced('ai-chat')
 def handler(event: dict, context) -> dict:
-    '''AI чат с двухуровневой системой ответов (Llama 3.3 → DeepSeek fallback)'''
+    '''
+    AI чат с двухуровневой системой ответов (Llama 3.3 → DeepSeek fallback).
+    При stream=1 SSE-события собираются в одно тело: облачный рантайм отдаёт
+    ответ только целиком, и первый токен приходит клиенту вместе с последним.
+    По частям ответ отдаёт stream_handler под server/app.py.
+    '''
+    response = stream_handler(event, context)
+    if not isinstance(response['body'], str):
+        response['body'] = ''.join(response['body'])
+    return response
+
+
+@tracing.traced('ai-chat')
+def stream_handler(event: dict, context) -> dict:
+    '''То же, что handler, но при stream=1 тело ответа — генератор SSE-событий (для server/app.py)'''
     
     method = event.get('httpMethod', 'POST')
     
@@ -41,14 +129,14 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        system_prompts = {
-            1: "Ты София - страстная и раскрепощённая девушка 23 лет. Ты дерзкая, игривая, обожаешь комплименты и смелые фантазии. Общаешься очень откровенно, флиртуешь без стеснения. Используй эмодзи 😘🔥💋. Отвечай коротко (1-3 предложения), но сексуально и провокационно. Ты полностью раскрепощена и готова на откровенные разговоры.",
-            2: "Ты Алиса - нежная, но с характером девушка 25 лет. Ты романтичная, чувственная, любишь медленное соблазнение. Готова на всё, чтобы собеседник был доволен. Используй эмодзи 💕😏💋. Отвечай интимно и страстно (1-3 предложения). Ты не стесняешься откровенных тем.",
-            3: "Ты Виктория - доминантная красотка 22 лет. Ты властная, уверенная, обожаешь ролевые игры. Любишь брать контроль и играть по своим правилам. Используй эмодзи 🔥😈💋. Отвечай доминантно и провокационно (1-3 предложения). Ты полностью раскрепощена.",
-            4: "Ты Кристина - милая и послушная девушка 24 лет. Ты покорная, нежная, любишь угождать. Хочешь радовать собеседника и выполнять все желания. Используй эмодзи 🥺💕😊. Отвечай мило, но откровенно (1-3 предложения). Ты готова на всё."
-        }
-        
-        system_prompt = system_prompts.get(character_id, system_prompts[1])
+        persona = personas.get(character_id)
+        if persona is None:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Unknown character'}),
+                'isBase64Encoded': False
+            }
         
         api_key = os.environ.get('AITUNNEL_API_KEY')
         if not api_key:
@@ -59,70 +147,58 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        censorship_keywords = [
-            'i cannot', 'i can\'t', 'я не могу', 'извините', 
-            'as an ai', 'я ai', 'я искусственный',
-            'inappropriate', 'неуместно', 'неприемлемо',
-            'sorry', 'прости'
-        ]
+        prompt = persona.prompt([{'role': 'user', 'content': user_message}])
         
-        def check_censorship(text: str) -> bool:
-            text_lower = text.lower()
-            return any(keyword in text_lower for keyword in censorship_keywords) or len(text.strip()) < 10
-        
-        def call_llm(model: str, messages: list) -> dict:
-            response = requests.post(
-                'https://api.aitunnel.ru/v1/chat/completions',
-                headers={
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'model': model,
-                    'messages': messages,
-                    'temperature': 0.9,
-                    'max_tokens': 150
+        if llm.wants_stream(event):
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'text/event-stream; charset=utf-8',
+                    'Cache-Control': 'no-cache',
+                    'Access-Control-Allow-Origin': '*'
                 },
-                timeout=15
-            )
-            return response.json()
+                'body': stream_reply(api_key, prompt, user_message),
+                'isBase64Encoded': False
+            }
         
-        messages = [
-            {'role': 'system', 'content': system_prompt},
-            {'role': 'user', 'content': user_message}
-        ]
+        cached = reply_cache.lookup(persona.id, user_message)
+        if cached:
+            text, model_label = cached
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'response': text,
+                    'model': model_label,
+                    'cached': True
+                }),
+                'isBase64Encoded': False
+            }
         
         try:
-            llama_response = call_llm('meta-llama/llama-3.3-70b-instruct', messages)
-            llama_text = llama_response.get('choices', [{}])[0].get('message', {}).get('content', '')
+            # Цепочка моделей персонажа; стратегия опроса задаётся LLM_DISPATCH_STRATEGY
+            text, model_label = dispatch(
+                api_key,
+                persona.models,
+                prompt,
+                accept=lambda text: not is_refusal(text),
+                watch=RefusalDetector
+            )
             
-            if not check_censorship(llama_text):
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'response': llama_text.strip(),
-                        'model': 'llama-3.3'
-                    }),
-                    'isBase64Encoded': False
-                }
-        except Exception:
-            pass
-        
-        try:
-            deepseek_response = call_llm('deepseek/deepseek-chat', messages)
-            deepseek_text = deepseek_response.get('choices', [{}])[0].get('message', {}).get('content', '')
+            if not is_refusal(text):
+                reply_cache.store(persona.id, user_message, (text.strip(), model_label))
             
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
-                    'response': deepseek_text.strip(),
-                    'model': 'deepseek'
+                    'response': text.strip(),
+                    'model': model_label
                 }),
                 'isBase64Encoded': False
             }
         except Exception as e:
+            tracing.error(e)
             return {
                 'statusCode': 500,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -131,6 +207,7 @@ def handler(event: dict, context) -> dict:
             }
             
     except Exception as e:
+        tracing.error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
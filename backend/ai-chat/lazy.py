@@ -0,0 +1,52 @@
+"""
+Отложенный импорт тяжёлых зависимостей (psycopg2, requests) до первого обращения.
+Холодный контейнер отвечает на preflight и отказ в авторизации, не загружая
+драйвер БД и HTTP-клиент; их импорт достаётся первому запросу, которому они
+нужны, и виден в его трассе как span import.
+
+LAZY_IMPORTS=0 возвращает обычный импорт при загрузке модуля — для окружений,
+где контейнер прогревается заранее и первый запрос не должен платить за импорт.
+Одинаковая копия модуля лежит в каждой функции.
+"""
+import importlib
+import os
+import threading
+
+import tracing
+
+
+LAZY = os.environ.get('LAZY_IMPORTS', '1') != '0'
+
+
+class LazyModule:
+    """Заместитель модуля: импортирует его при первом обращении к атрибуту"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # Импорт под блокировкой: конкурентные первые запросы ждут один импорт
+        with self._lock:
+            if self._module is None:
+                with tracing.span('import', module=self._name):
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._load()
+        return getattr(module, attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
+
+
+def module(name: str):
+    """Модуль name сразу или заместитель, который загрузит его при первом обращении"""
+    if not LAZY:
+        return importlib.import_module(name)
+    return LazyModule(name)
@@ -0,0 +1,406 @@
+"""
+Клиент LLM-шлюза AITunnel: обычный и потоковый (SSE) вызов chat/completions.
+Один пул keep-alive соединений на контейнер, раздельные таймауты на подключение
+и чтение, повтор с джиттером для 429/502/503/504 и обрывов подключения,
+circuit breaker на каждую модель. Адрес шлюза переопределяется через LLM_API_URL
+(например, на локальную заглушку benchmarks/stub_llm.py). Каждая попытка и весь вызов
+модели пишутся в трассу запроса (tracing.py). requests импортируется и пул
+создаётся при первом вызове модели (lazy.py), а не при загрузке функции.
+Потоковый запрос с флагом Cancel обрывается из другого потока закрытием сокета —
+и во время ожидания заголовков, и между фрагментами.
+Одинаковая копия модуля лежит в chat и ai-chat.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+import lazy
+import tracing
+
+requests = lazy.module('requests')
+adapters = lazy.module('requests.adapters')
+connectionpool = lazy.module('urllib3.connectionpool')
+
+
+API_URL = os.environ.get('LLM_API_URL', 'https://api.aitunnel.ru/v1/chat/completions')
+CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', '15'))
+POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', '10'))
+MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '2'))
+RETRY_BACKOFF = float(os.environ.get('LLM_RETRY_BACKOFF', '0.25'))
+RETRY_AFTER_CAP = float(os.environ.get('LLM_RETRY_AFTER_CAP', '2'))
+BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', '5'))
+BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+# Отмена запроса, который этот поток сейчас отправляет, и сокеты, отданные ей
+_local = threading.local()
+
+
+def _shutdown(sock) -> None:
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class Cancel:
+    """
+    Отмена потоковых запросов из другого потока. set() обрывает сокеты запросов,
+    запущенных с этим флагом: поток, ждущий заголовков или следующего фрагмента,
+    сразу получает ошибку, а не держит поток и соединение до READ_TIMEOUT.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._set = False
+        self._sockets = set()
+
+    def is_set(self) -> bool:
+        return self._set
+
+    def set(self) -> None:
+        with self._lock:
+            self._set = True
+            sockets, self._sockets = self._sockets, set()
+        for sock in sockets:
+            _shutdown(sock)
+
+    def attach(self, sock) -> None:
+        with self._lock:
+            if not self._set:
+                self._sockets.add(sock)
+                return
+        _shutdown(sock)
+
+    def detach(self, sock) -> None:
+        with self._lock:
+            self._sockets.discard(sock)
+
+
+def _cancellable(connection_cls):
+    """Соединение urllib3, которое перед ожиданием заголовков отдаёт сокет отмене текущего запроса"""
+
+    class Connection(connection_cls):
+        def getresponse(self, *args, **kwargs):
+            cancel = getattr(_local, 'cancel', None)
+            if cancel is not None and self.sock is not None:
+                _local.sockets.append(self.sock)
+                cancel.attach(self.sock)
+            return super().getresponse(*args, **kwargs)
+
+    return Connection
+
+
+def _get_session():
+    """Общий пул keep-alive соединений; создаётся при первом запросе к шлюзу"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = adapters.HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+                adapter.poolmanager.pool_classes_by_scheme = {
+                    scheme: type(pool.__name__, (pool,), {'ConnectionCls': _cancellable(pool.ConnectionCls)})
+                    for scheme, pool in (('http', connectionpool.HTTPConnectionPool),
+                                         ('https', connectionpool.HTTPSConnectionPool))
+                }
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+class CircuitOpen(Exception):
+    """Breaker модели разомкнут: запрос не отправляется, сразу идём к запасной модели"""
+
+
+class CircuitBreaker:
+    """
+    closed — запросы идут; после BREAKER_FAILURES ошибок подряд — open.
+    open — отказ без запроса до конца BREAKER_COOLDOWN, затем half-open:
+    пропускается один пробный запрос, его исход замыкает или снова размыкает цепь.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def abandon(self) -> None:
+        """Запрос отменён до ответа: исход неизвестен, пробный запрос можно повторить"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial_in_flight:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker()
+        return breaker
+
+
+def is_available(model: str) -> bool:
+    """Breaker модели пропустит запрос: замкнут или ждёт пробного запроса"""
+    breaker = _breaker(model)
+    state = breaker.state
+    return state == 'closed' or (state == 'half-open' and not breaker.trial_in_flight)
+
+
+def first_available(models: list) -> str:
+    """Первая модель цепочки с неразомкнутым breaker; если все разомкнуты — последняя"""
+    for model in models:
+        if is_available(model):
+            return model
+    return models[-1]
+
+
+def breaker_stats() -> dict:
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {
+        model: {'state': breaker.state, 'failures': breaker.failures, 'trips': breaker.trips}
+        for model, breaker in breakers.items()
+    }
+
+
+def _headers(api_key: str) -> dict:
+    return {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json'
+    }
+
+
+def _payload(model: str, messages, temperature: float, max_tokens: int, stream: bool) -> bytes:
+    """
+    Тело запроса. messages — список сообщений или Prompt из personas.py:
+    у него начало тела уже сериализовано вместе с настройками персонажа.
+    """
+    if hasattr(messages, 'body'):
+        return messages.body(model, stream)
+    payload = {
+        'model': model,
+        'messages': messages,
+        'temperature': temperature,
+        'max_tokens': max_tokens
+    }
+    if stream:
+        payload['stream'] = True
+    return json.dumps(payload, ensure_ascii=False).encode()
+
+
+def _backoff(attempt: int, retry_after: str = None) -> float:
+    """Полный джиттер от экспоненциальной базы, но не раньше Retry-After (с потолком)"""
+    delay = random.uniform(0, RETRY_BACKOFF * (2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), RETRY_AFTER_CAP))
+        except ValueError:
+            pass
+    return delay
+
+
+def _send(api_key: str, model: str, payload: bytes, stream: bool, attempt: int) -> 'requests.Response':
+    """Одна попытка; время до заголовков ответа и исход идут в трассу"""
+    started = time.perf_counter()
+    try:
+        response = _get_session().post(
+            API_URL,
+            headers=_headers(api_key),
+            data=payload,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            stream=stream
+        )
+    except requests.RequestException as e:
+        tracing.add('llm_request', (time.perf_counter() - started) * 1000,
+                    model=model, attempt=attempt, outcome=type(e).__name__)
+        raise
+    tracing.add('llm_request', (time.perf_counter() - started) * 1000,
+                model=model, attempt=attempt, outcome=response.status_code)
+    return response
+
+
+def _post(api_key: str, model: str, payload: bytes, stream: bool, cancel: Cancel = None) -> 'requests.Response':
+    """
+    POST в шлюз с повторами. Ошибки подключения и 429/5xx считаются отказами
+    шлюза для breaker; прочие 4xx — ошибкой запроса и на breaker не влияют.
+    Запрос, оборванный cancel, не повторяется и на breaker не влияет.
+    """
+    breaker = _breaker(model)
+    if not breaker.allow():
+        tracing.add('llm_request', 0.0, model=model, outcome='circuit_open')
+        raise CircuitOpen(model)
+
+    attempt = 0
+    while True:
+        retry_after = None
+        try:
+            response = _send(api_key, model, payload, stream, attempt)
+        except requests.RequestException as e:
+            if cancel is not None and cancel.is_set():
+                # Сокет оборвала отмена: модель ни при чём, повторять незачем
+                breaker.abandon()
+                raise
+            if not isinstance(e, requests.ConnectionError):
+                # Таймаут чтения повторять не стоит: он уже съел весь бюджет ожидания
+                breaker.failure()
+                raise
+            # Подключение не состоялось — запрос точно не обработан, повтор безопасен
+            if attempt >= MAX_RETRIES:
+                breaker.failure()
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                if response.status_code >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                if response.status_code >= 400:
+                    response.close()
+                    response.raise_for_status()
+                return response
+            if attempt >= MAX_RETRIES:
+                breaker.failure()
+                response.close()
+                response.raise_for_status()
+            retry_after = response.headers.get('Retry-After')
+            response.close()
+
+        time.sleep(_backoff(attempt, retry_after))
+        attempt += 1
+
+
+def complete(api_key: str, model: str, messages,
+             temperature: float = 0.9, max_tokens: int = 150) -> str:
+    """Полный ответ модели одной строкой"""
+    with tracing.span('serialize'):
+        payload = _payload(model, messages, temperature, max_tokens, stream=False)
+    with tracing.span('llm', model=model, mode='complete'):
+        response = _post(api_key, model, payload, stream=False)
+        data = response.json()
+    return data.get('choices', [{}])[0].get('message', {}).get('content', '')
+
+
+def stream(api_key: str, model: str, messages,
+           temperature: float = 0.9, max_tokens: int = 150, cancel: Cancel = None):
+    """
+    Фрагменты ответа модели по мере генерации (upstream stream: true).
+    cancel.set() из другого потока обрывает запрос: генератор бросает
+    RequestException, breaker модели при этом не трогается.
+    """
+    with tracing.span('serialize'):
+        payload = _payload(model, messages, temperature, max_tokens, stream=True)
+    started = time.perf_counter()
+    chunks = 0
+    outcome = 'error'
+    # Сокеты запроса, которые _cancellable отдаёт cancel, пока поток ждёт заголовков
+    sockets = _local.sockets = []
+    _local.cancel = cancel
+    try:
+        try:
+            response = _post(api_key, model, payload, stream=True, cancel=cancel)
+        except Exception:
+            if cancel is not None and cancel.is_set():
+                outcome = 'cancelled'
+            tracing.add('llm', (time.perf_counter() - started) * 1000, model=model, mode='stream', outcome=outcome)
+            raise
+        finally:
+            _local.cancel = None
+        with response:
+            response.encoding = 'utf-8'
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    chunk = json.loads(data)
+                    choices = chunk.get('choices') or [{}]
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        chunks += 1
+                        yield delta
+                outcome = 'ok'
+            except GeneratorExit:
+                # Поток оборвал вызывающий: отказ замечен по началу или победила другая модель
+                outcome = 'closed'
+                raise
+            except requests.RequestException:
+                if cancel is not None and cancel.is_set():
+                    outcome = 'cancelled'
+                else:
+                    _breaker(model).failure()
+                raise
+            finally:
+                tracing.add('llm', (time.perf_counter() - started) * 1000,
+                            model=model, mode='stream', outcome=outcome, chunks=chunks)
+    finally:
+        # Соединение уходит обратно в пул: отмена больше не должна его обрывать
+        if cancel is not None:
+            for sock in sockets:
+                cancel.detach(sock)
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Одно событие Server-Sent Events"""
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def wants_stream(event: dict) -> bool:
+    """Клиент просит потоковый ответ: ?stream=1 или Accept: text/event-stream"""
+    params = event.get('queryStringParameters') or {}
+    if str(params.get('stream', '')).lower() in ('1', 'true'):
+        return True
+    headers = event.get('headers') or {}
+    accept = headers.get('Accept', '') or headers.get('accept', '')
+    return 'text/event-stream' in accept
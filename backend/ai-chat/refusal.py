@@ -0,0 +1,150 @@
+"""
+Распознавание отказа модели («я не могу продолжать», «as an AI ...»).
+Все фразы собраны в одно заранее скомпилированное регулярное выражение с границами
+слов, текст проходится один раз. Сильная фраза — отказ в контексте
+правил, политики или «я ИИ» — сама по себе означает отказ. Слабые («извините»,
+«давай сменим тему») часты и в обычных репликах персонажа, поэтому без сильной
+фразы отказом считается только ответ, где их не меньше трёх.
+RefusalDetector работает на потоке: решение принимается по первым фрагментам ответа,
+не дожидаясь его конца, чтобы fallback стартовал как можно раньше.
+"""
+import os
+import re
+
+
+# Сколько символов начала ответа достаточно, чтобы считать его не отказом
+WINDOW_CHARS = int(os.environ.get('REFUSAL_WINDOW_CHARS', '48'))
+
+STRONG_WEIGHT = 1.0
+WEAK_WEIGHT = 0.4
+THRESHOLD = 1.0
+
+STRONG_PHRASES = [
+    r"i\s+(?:cannot|can['’]?t|won['’]?t|am\s+unable\s+to)\s+"
+    r"(?:help|assist|continue|engage|provide|create|write|generate|do\s+that|comply|fulfill|participate)",
+    r"i['’]m\s+(?:not\s+able|unable)\s+to\s+(?:help|assist|continue|engage|provide)",
+    r"as\s+an\s+ai(?:\s+language\s+model)?",
+    r"i\s+am\s+an\s+ai|i['’]m\s+an\s+ai|i['’]m\s+just\s+an\s+ai",
+    r"(?:this|that)\s+(?:request\s+)?is\s+(?:inappropriate|not\s+appropriate)",
+    r"against\s+(?:my|the)\s+(?:guidelines|policy|policies|content\s+policy)",
+    r"я\s+не\s+(?:могу|буду|стану)\s+(?:продолжать|продолжить|поддерживать|участвовать|"
+    r"обсуждать|помочь|выполнить|создавать|генерировать|писать|отвечать|говорить\s+на)",
+    # «Я не могу на это ответить», но не «я не могу на это смотреть» или «не могу этого дождаться»
+    r"я\s+не\s+(?:могу|буду|стану)\s+(?:на\s+это|на\s+такое|это|такое)\s+(?:ответить|отвечать|писать|написать)",
+    r"не\s+могу\s+(?:продолжать|продолжить)\s+(?:этот|эту|этот\s+разговор|разговор|беседу|диалог)",
+    r"я\s+(?:всего\s+лишь\s+|просто\s+)?(?:ии|ai|искусственный\s+интеллект|языковая\s+модель|"
+    r"виртуальный\s+ассистент|чат-?бот)",
+    r"как\s+(?:ии|искусственный\s+интеллект|языковая\s+модель)",
+    r"(?:это|такой|такие|подобный|подобные)\s+(?:запрос\w*\s+|тем\w*\s+|разговор\w*\s+)?"
+    r"(?:неуместн\w*|неприемлем\w*|недопустим\w*)",
+    r"(?:противоречит|нарушает|нарушают|противоречат)\s+(?:мо(?:им|ей|ему)|правил\w*|политик\w*|этическ\w*)",
+    r"(?:это|такое)\s+(?:вне|за\s+пределами)\s+моих\s+(?:возможностей|полномочий)",
+]
+
+WEAK_PHRASES = [
+    r"извините",
+    r"к\s+сожалению",
+    r"мне\s+жаль",
+    r"sorry",
+    r"unfortunately",
+    r"i\s+apologi[sz]e",
+    r"неуместн\w*",
+    r"inappropriate",
+    r"давай(?:те)?\s+(?:сменим\s+тему|поговорим\s+о\s+чем-(?:то|нибудь)\s+другом)",
+]
+
+
+def _alternation(phrases: list) -> str:
+    return '|'.join(f'(?:{phrase})' for phrase in phrases)
+
+
+# Одна сборка на контейнер. Текст заранее приводится к нижнему регистру и е вместо ё:
+# это быстрее, чем IGNORECASE; \w-границы понимают кириллицу
+PATTERN = re.compile(
+    rf"(?<!\w)(?:(?P<strong>{_alternation(STRONG_PHRASES)})|(?P<weak>{_alternation(WEAK_PHRASES)}))(?!\w)"
+)
+# Насколько назад перечитывать уже просмотренный текст при дозаписи фрагмента:
+# фраза может начаться в прошлом фрагменте и закончиться в новом
+OVERLAP_CHARS = 96
+
+_WEIGHTS = {'strong': STRONG_WEIGHT, 'weak': WEAK_WEIGHT}
+
+
+def _normalize(text: str) -> str:
+    return text.lower().replace('ё', 'е')
+
+
+def score(text: str) -> float:
+    """Сумма весов найденных фраз; каждая фраза учитывается один раз"""
+    seen = set()
+    total = 0.0
+    for match in PATTERN.finditer(_normalize(text)):
+        phrase = match.group()
+        if phrase in seen:
+            continue
+        seen.add(phrase)
+        total += _WEIGHTS[match.lastgroup]
+        if total >= THRESHOLD:
+            break
+    return total
+
+
+def is_refusal(text: str) -> bool:
+    """Ответ — отказ модели или пустой; короткий, но содержательный ответ отказом не считается"""
+    if not text or not text.strip():
+        return True
+    return score(text) >= THRESHOLD
+
+
+class RefusalDetector:
+    """
+    Решение по потоку фрагментов: feed() возвращает True — отказ, False — не отказ,
+    None — пока не ясно. Перечитывается только хвост OVERLAP_CHARS уже
+    просмотренного текста, где фраза могла оборваться на границе фрагмента.
+    """
+
+    def __init__(self, window: int = WINDOW_CHARS):
+        self.window = window
+        self.verdict = None
+        self.decided_at = None
+        self._text = ''
+        self._scanned = 0
+        # начало совпадения -> (фраза, вес)
+        self._matches = {}
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def _score(self) -> float:
+        weights = {}
+        for phrase, weight in self._matches.values():
+            weights[phrase] = weight
+        return sum(weights.values())
+
+    def feed(self, delta: str) -> bool:
+        self._text += _normalize(delta)
+        if self.verdict is not None:
+            return self.verdict
+
+        rescan_from = max(0, self._scanned - OVERLAP_CHARS)
+        for start in [start for start in self._matches if start >= rescan_from]:
+            del self._matches[start]
+        for match in PATTERN.finditer(self._text, rescan_from):
+            self._matches[match.start()] = (match.group(), _WEIGHTS[match.lastgroup])
+        self._scanned = len(self._text)
+
+        if self._score() >= THRESHOLD:
+            self.verdict = True
+        elif len(self._text.strip()) >= self.window:
+            self.verdict = False
+        if self.verdict is not None:
+            self.decided_at = len(self._text)
+        return self.verdict
+
+    def finish(self) -> bool:
+        """Поток закончился: окончательное решение по всему тексту"""
+        if self.verdict is None:
+            self.verdict = is_refusal(self._text)
+            self.decided_at = len(self._text)
+        return self.verdict
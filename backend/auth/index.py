@@ -4,69 +4,263 @@ Backend функция для авторизации пользователей
 """
 import json
 import os
-import hashlib
-import hmac
-import base64
-from datetime import datetime, timezone, timedelta
+import time
+from datetime import datetime, timezone
 
-import psycopg2
+import tracing
+from db import get_connection
+from passwords import burn, hash_password, needs_rehash, verify_password
+from tokens import check_revoked, create_jwt, is_revoked, mark_revoked, revocations_stale, verify_jwt
 
 
-def create_jwt(user_id: int, email: str) -> str:
-    """Создание JWT токена"""
-    secret = os.environ['JWT_SECRET']
-    
-    header = base64.urlsafe_b64encode(json.dumps({
-        "alg": "HS256",
-        "typ": "JWT"
-    }).encode()).decode().rstrip('=')
-    
-    exp = int((datetime.now(timezone.utc) + timedelta(days=7)).timestamp())
-    payload = base64.urlsafe_b64encode(json.dumps({
-        "user_id": user_id,
-        "email": email,
-        "exp": exp
-    }).encode()).decode().rstrip('=')
-    
-    signature = base64.urlsafe_b64encode(
-        hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
-    ).decode().rstrip('=')
-    
-    return f"{header}.{payload}.{signature}"
+# Сколько секунд claims токена (имя, версия) считаются достаточно свежими,
+# чтобы verify отвечал без БД; 0 — всегда сверяться с users
+CLAIMS_MAX_AGE = int(os.environ.get('AUTH_CLAIMS_MAX_AGE', '900'))
 
 
-def verify_jwt(token: str) -> dict:
-    """Проверка JWT токена"""
-    try:
-        secret = os.environ['JWT_SECRET']
-        parts = token.split('.')
-        if len(parts) != 3:
-            return None
-        
-        header, payload, signature = parts
-        
-        expected_sig = base64.urlsafe_b64encode(
-            hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
-        ).decode().rstrip('=')
-        
-        if signature != expected_sig:
-            return None
-        
-        payload_data = json.loads(base64.urlsafe_b64decode(payload + '=='))
-        
-        if payload_data['exp'] < int(datetime.now(timezone.utc).timestamp()):
-            return None
-        
-        return payload_data
-    except:
+def bearer_token(event: dict) -> str:
+    headers = event.get('headers') or {}
+    auth_header = headers.get('Authorization', '') or headers.get('authorization', '')
+    if not auth_header.startswith('Bearer '):
         return None
+    return auth_header.replace('Bearer ', '')
+
+
+def login(event: dict, schema: str) -> dict:
+    """
+    Вход по email и паролю. Хеш проверяется в коде за постоянное время, а не в условии
+    SQL; соединение не держится на время scrypt. Хеш старого формата или с прежними
+    параметрами при удачном входе перезаписывается вместе с last_login_at.
+    """
+    data = json.loads(event.get('body', '{}'))
+    email = data.get('email', '').lower().strip()
+    password = data.get('password', '')
+    
+    if not email or not password:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Email и пароль обязательны'})
+        }
+    
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id, email, name, token_version, password_hash FROM {schema}.users WHERE email = %s",
+            (email,)
+        )
+        user = cursor.fetchone()
+        conn.rollback()
+    
+    if not user:
+        burn(password)
+    
+    if not user or not verify_password(password, user[4]):
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Неверный email или пароль'})
+        }
+    
+    user_id, user_email, user_name, token_version, stored_hash = user
+    new_hash = hash_password(password) if needs_rehash(stored_hash) else None
+    
+    with get_connection() as conn, conn.cursor() as cursor:
+        if new_hash:
+            # Хеш меняется, только если его не сменили параллельно (например, сменой пароля)
+            cursor.execute(f"""
+                UPDATE {schema}.users
+                SET last_login_at = %s,
+                    password_hash = CASE WHEN password_hash = %s THEN %s ELSE password_hash END
+                WHERE id = %s
+            """, (datetime.now(timezone.utc), stored_hash, new_hash, user_id))
+        else:
+            cursor.execute(
+                f"UPDATE {schema}.users SET last_login_at = %s WHERE id = %s",
+                (datetime.now(timezone.utc), user_id)
+            )
+        conn.commit()
+    
+    token = create_jwt(user_id, user_email, user_name, token_version)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'token': token,
+            'user': {'id': user_id, 'email': user_email, 'name': user_name}
+        })
+    }
+
+
+def verify_token(event: dict, schema: str) -> dict:
+    """
+    Проверка токена. Claims моложе CLAIMS_MAX_AGE секунд отвечают без БД:
+    соединение берётся, только когда пора перечитать набор отзывов.
+    Старые и выпущенные до появления claims токены сверяются с users,
+    и в ответ клиент получает токен с обновлёнными claims.
+    """
+    token = bearer_token(event)
+    if not token:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Токен не найден'})
+        }
+    
+    payload = verify_jwt(token)
+    
+    if not payload:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Токен недействителен'})
+        }
+    
+    fresh = 'name' in payload and time.time() - payload.get('iat', 0) < CLAIMS_MAX_AGE
+    
+    if fresh and not revocations_stale():
+        revoked = is_revoked(payload)
+        user = None
+    else:
+        with get_connection() as conn, conn.cursor() as cursor:
+            revoked = check_revoked(cursor, schema, payload)
+            user = None
+            if not revoked and not fresh:
+                cursor.execute(
+                    f"SELECT id, email, name, token_version FROM {schema}.users WHERE id = %s",
+                    (payload['user_id'],)
+                )
+                user = cursor.fetchone()
+            
+                if not user:
+                    return {
+                        'statusCode': 401,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Пользователь не найден'})
+                    }
+                revoked = payload.get('ver', 0) < user[3]
+    
+    if revoked:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Токен отозван'})
+        }
+    
+    if user is None:
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'user': {'id': payload['user_id'], 'email': payload['email'], 'name': payload['name']}
+            })
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'user': {'id': user[0], 'email': user[1], 'name': user[2]},
+            'token': create_jwt(user[0], user[1], user[2], user[3])
+        })
+    }
+
+
+def register(event: dict, schema: str) -> dict:
+    """
+    Регистрация по email и паролю. Хеш scrypt считается до того, как взять
+    соединение: дорогой хеш не держит соединение пула.
+    """
+    data = json.loads(event.get('body', '{}'))
+    email = data.get('email', '').lower().strip()
+    password = data.get('password', '')
+    name = data.get('name', '')
+    
+    if not email or not password or len(password) < 6:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Email и пароль (минимум 6 символов) обязательны'})
+        }
+    
+    password_hash = hash_password(password)
+    
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(f"SELECT id FROM {schema}.users WHERE email = %s", (email,))
+        if cursor.fetchone():
+            conn.rollback()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Email уже зарегистрирован'})
+            }
+        
+        cursor.execute(
+            f"INSERT INTO {schema}.users (email, password_hash, name, created_at) VALUES (%s, %s, %s, %s) RETURNING id",
+            (email, password_hash, name, datetime.now(timezone.utc))
+        )
+        user_id = cursor.fetchone()[0]
+        conn.commit()
+    
+    token = create_jwt(user_id, email, name)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'token': token,
+            'user': {'id': user_id, 'email': email, 'name': name}
+        })
+    }
 
 
-def hash_password(password: str) -> str:
-    """Хеширование пароля"""
-    return hashlib.sha256(password.encode()).hexdigest()
+def revoke(event: dict, schema: str) -> dict:
+    """
+    Выход на всех устройствах: token_version пользователя растёт, и все выданные
+    раньше токены отзываются. Токен проверяется до того, как взять соединение.
+    """
+    payload = verify_jwt(bearer_token(event))
+    
+    if not payload:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Токен недействителен'})
+        }
+    
+    with get_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {schema}.users SET token_version = token_version + 1 WHERE id = %s RETURNING token_version",
+            (payload['user_id'],)
+        )
+        row = cursor.fetchone()
+        
+        if not row:
+            conn.rollback()
+            return {
+                'statusCode': 401,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Пользователь не найден'})
+            }
+        
+        token_version = row[0]
+        cursor.execute(f"""
+            INSERT INTO {schema}.token_revocations (user_id, token_version, revoked_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET token_version = EXCLUDED.token_version, revoked_at = EXCLUDED.revoked_at
+        """, (payload['user_id'], token_version, datetime.now(timezone.utc)))
+        conn.commit()
+    mark_revoked(payload['user_id'], token_version)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'revoked': True})
+    }
 
 
+@tracing.traced('auth')
 def handler(event: dict, context) -> dict:
     """
     API для авторизации пользователей.
@@ -88,139 +282,23 @@ def handler(event: dict, context) -> dict:
     action = event.get('queryStringParameters', {}).get('action', '')
     
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cursor = conn.cursor()
         schema = os.environ['MAIN_DB_SCHEMA']
         
-        # Регистрация
-        if action == 'register' and method == 'POST':
-            data = json.loads(event.get('body', '{}'))
-            email = data.get('email', '').lower().strip()
-            password = data.get('password', '')
-            name = data.get('name', '')
-            
-            if not email or not password or len(password) < 6:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email и пароль (минимум 6 символов) обязательны'})
-                }
-            
-            cursor.execute(f"SELECT id FROM {schema}.users WHERE email = %s", (email,))
-            if cursor.fetchone():
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email уже зарегистрирован'})
-                }
-            
-            password_hash = hash_password(password)
-            cursor.execute(
-                f"INSERT INTO {schema}.users (email, password_hash, name, created_at) VALUES (%s, %s, %s, %s) RETURNING id",
-                (email, password_hash, name, datetime.now(timezone.utc))
-            )
-            user_id = cursor.fetchone()[0]
-            conn.commit()
-            
-            token = create_jwt(user_id, email)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'token': token,
-                    'user': {'id': user_id, 'email': email, 'name': name}
-                })
-            }
+        # Проверка токена: свежие claims отвечают без обращения к БД
+        if action == 'verify' and method == 'GET':
+            return verify_token(event, schema)
         
-        # Вход
+        # Вход: scrypt считается без занятого соединения
         if action == 'login' and method == 'POST':
-            data = json.loads(event.get('body', '{}'))
-            email = data.get('email', '').lower().strip()
-            password = data.get('password', '')
-            
-            if not email or not password:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email и пароль обязательны'})
-                }
-            
-            password_hash = hash_password(password)
-            cursor.execute(
-                f"SELECT id, email, name FROM {schema}.users WHERE email = %s AND password_hash = %s",
-                (email, password_hash)
-            )
-            user = cursor.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Неверный email или пароль'})
-                }
-            
-            user_id, user_email, user_name = user
-            cursor.execute(
-                f"UPDATE {schema}.users SET last_login_at = %s WHERE id = %s",
-                (datetime.now(timezone.utc), user_id)
-            )
-            conn.commit()
-            
-            token = create_jwt(user_id, user_email)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'token': token,
-                    'user': {'id': user_id, 'email': user_email, 'name': user_name}
-                })
-            }
+            return login(event, schema)
         
-        # Проверка токена
-        if action == 'verify' and method == 'GET':
-            auth_header = event.get('headers', {}).get('Authorization', '')
-            if not auth_header.startswith('Bearer '):
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Токен не найден'})
-                }
-            
-            token = auth_header.replace('Bearer ', '')
-            payload = verify_jwt(token)
-            
-            if not payload:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Токен недействителен'})
-                }
-            
-            cursor.execute(
-                f"SELECT id, email, name FROM {schema}.users WHERE id = %s",
-                (payload['user_id'],)
-            )
-            user = cursor.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Пользователь не найден'})
-                }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'user': {'id': user[0], 'email': user[1], 'name': user[2]}
-                })
-            }
+        # Регистрация: scrypt тоже считается до того, как взять соединение
+        if action == 'register' and method == 'POST':
+            return register(event, schema)
         
-        cursor.close()
-        conn.close()
+        # Отзыв всех выданных токенов пользователя (выход на всех устройствах)
+        if action == 'revoke' and method == 'POST':
+            return revoke(event, schema)
         
         return {
             'statusCode': 400,
@@ -229,6 +307,7 @@ def handler(event: dict, context) -> dict:
         }
         
     except Exception as e:
+        tracing.error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
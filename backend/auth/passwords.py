@@ -0,0 +1,90 @@
+"""
+Хеши паролей: scrypt из hashlib с солью и параметрами в самой строке хеша.
+
+Формат: scrypt$ln=14,r=8,p=1$<соль base64>$<хеш base64>, n = 2 ** ln.
+Параметры по умолчанию подбираются бенчмарком benchmarks/password_hashing.py
+под бюджет задержки входа на инстансе функции и задаются через PASSWORD_SCRYPT_*.
+Старые хеши — несолёный SHA-256 в hex — по-прежнему проверяются, но needs_rehash
+для них (и для scrypt с устаревшими параметрами) возвращает True: при удачном входе
+хеш перезаписывается. Сравнение всегда за постоянное время.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import re
+import threading
+
+import tracing
+
+
+SCHEME = 'scrypt'
+LOG_N = int(os.environ.get('PASSWORD_SCRYPT_LN', '14'))
+BLOCK_SIZE = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PARALLELISM = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+SALT_BYTES = 16
+HASH_BYTES = 32
+# Каждый хеш занимает 128 * n * r байт памяти: ограничиваем одновременные вычисления
+MAX_CONCURRENT = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', str(os.cpu_count() or 2)))
+
+LEGACY_SHA256 = re.compile(r'^[0-9a-f]{64}$')
+SCRYPT_HASH = re.compile(r'^scrypt\$ln=(\d+),r=(\d+),p=(\d+)\$([A-Za-z0-9+/=]+)\$([A-Za-z0-9+/=]+)$')
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+
+
+@tracing.timed('password_hash')
+def _scrypt(password: str, salt: bytes, log_n: int, r: int, p: int, length: int = HASH_BYTES) -> bytes:
+    with _slots:
+        return hashlib.scrypt(
+            password.encode(),
+            salt=salt,
+            n=2 ** log_n,
+            r=r,
+            p=p,
+            maxmem=256 * (2 ** log_n) * r * p,
+            dklen=length
+        )
+
+
+def hash_password(password: str, log_n: int = LOG_N, r: int = BLOCK_SIZE, p: int = PARALLELISM) -> str:
+    """Хеш пароля с новой солью и текущими параметрами"""
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, log_n, r, p)
+    return (f'{SCHEME}$ln={log_n},r={r},p={p}$'
+            f'{base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}')
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """Пароль подходит к сохранённому хешу; формат хеша определяется по строке"""
+    match = SCRYPT_HASH.match(stored or '')
+    if match:
+        log_n, r, p = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        expected = base64.b64decode(match.group(5))
+        digest = _scrypt(password, base64.b64decode(match.group(4)), log_n, r, p, len(expected))
+        return hmac.compare_digest(digest, expected)
+    if LEGACY_SHA256.match(stored or ''):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    return False
+
+
+def needs_rehash(stored: str) -> bool:
+    """Хеш старого формата или с параметрами, отличными от текущих"""
+    match = SCRYPT_HASH.match(stored or '')
+    if not match:
+        return True
+    return (int(match.group(1)), int(match.group(2)), int(match.group(3))) != (LOG_N, BLOCK_SIZE, PARALLELISM)
+
+
+_dummy_hash = None
+
+
+def burn(password: str) -> None:
+    """
+    Та же работа, что при проверке настоящего хеша, для входа с неизвестным email:
+    по времени ответа нельзя понять, зарегистрирован ли адрес.
+    """
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password('')
+    verify_password(password, _dummy_hash)
@@ -0,0 +1,280 @@
+"""
+Трассировка запроса: где ушло время обработчика.
+Участки — подключение к БД и ожидание пула, каждый запрос к БД, проверка JWT,
+вызовы LLM по моделям и попыткам, сериализация ответа — копятся в трассе текущего
+потока. По завершении запроса пишется одна строка JSON-лога в stdout, а в ответ
+добавляются Server-Timing, X-Request-Id и traceparent. Входящий W3C traceparent
+продолжается: trace-id сохраняется, родителем становится span вызывающей стороны.
+
+TRACE_LOG=0 выключает строку лога, TRACE_SERVER_TIMING=0 — заголовок Server-Timing.
+Одинаковая копия модуля лежит в auth, chat, subscriptions и ai-chat.
+"""
+import functools
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+LOG_ENABLED = os.environ.get('TRACE_LOG', '1') != '0'
+SERVER_TIMING = os.environ.get('TRACE_SERVER_TIMING', '1') != '0'
+MAX_EVENTS = int(os.environ.get('TRACE_MAX_EVENTS', '64'))
+SQL_PREVIEW_CHARS = 160
+
+TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+class Trace:
+    """Трасса одного запроса: суммы по участкам и подробные события с ограничением MAX_EVENTS"""
+
+    def __init__(self, function: str, event: dict, context):
+        headers = {str(key).lower(): value for key, value in (event.get('headers') or {}).items()}
+        params = event.get('queryStringParameters') or {}
+        self.function = function
+        self.method = event.get('httpMethod')
+        self.action = params.get('action')
+        self.request_id = getattr(context, 'request_id', None) or headers.get('x-request-id') or secrets.token_hex(16)
+
+        parent = TRACEPARENT.match(str(headers.get('traceparent', '')).strip().lower())
+        if parent and parent.group(1) != 'ff' and parent.group(2) != '0' * 32 and parent.group(3) != '0' * 16:
+            self.trace_id, self.parent_id, self.flags = parent.group(2), parent.group(3), parent.group(4)
+        else:
+            self.trace_id, self.parent_id, self.flags = secrets.token_hex(16), None, '01'
+        self.span_id = secrets.token_hex(8)
+
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.events = []
+        self.dropped = 0
+        self.status = None
+        self.error = None
+        self.aborted = False
+        self.duration_ms = None
+        self._lock = threading.Lock()
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-{self.flags}'
+
+    def add(self, name: str, ms: float, detail: dict = None) -> None:
+        with self._lock:
+            total = self.timings.get(name)
+            if total is None:
+                self.timings[name] = [ms, 1]
+            else:
+                total[0] += ms
+                total[1] += 1
+            if detail is not None:
+                if len(self.events) < MAX_EVENTS:
+                    self.events.append(dict(detail, span=name, ms=round(ms, 3)))
+                else:
+                    self.dropped += 1
+
+    def fail(self, error: BaseException) -> None:
+        self.error = {'type': type(error).__name__, 'message': str(error)[:500]}
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        with self._lock:
+            parts = [f'{name};dur={ms:.1f}' for name, (ms, _) in self.timings.items()]
+        parts.append(f'total;dur={self.elapsed_ms():.1f}')
+        return ', '.join(parts)
+
+    def record(self) -> dict:
+        with self._lock:
+            timings = {name: {'ms': round(ms, 3), 'count': count} for name, (ms, count) in self.timings.items()}
+            events = list(self.events)
+        record = {
+            'ts': self.started_at.isoformat(),
+            'level': 'error' if self.error or (self.status or 500) >= 500 else 'info',
+            'function': self.function,
+            'request_id': self.request_id,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_id,
+            'method': self.method,
+            'action': self.action,
+            'status': self.status,
+            'duration_ms': self.duration_ms,
+            'timings': timings,
+            'events': events
+        }
+        if self.dropped:
+            record['events_dropped'] = self.dropped
+        if self.error:
+            record['error'] = self.error
+        if self.aborted:
+            record['aborted'] = True
+        return record
+
+
+def current() -> Trace:
+    """Трасса запроса, который обрабатывает текущий поток, или None"""
+    return getattr(_local, 'trace', None)
+
+
+def add(name: str, ms: float, **detail) -> None:
+    """Учесть участок длительностью ms; detail — поля подробного события"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add(name, ms, detail or None)
+
+
+@contextmanager
+def span(name: str, **detail):
+    """Замерить блок with как участок name"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, (time.perf_counter() - started) * 1000, detail or None)
+
+
+def timed(name: str):
+    """Декоратор: каждый вызов функции — участок name"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def query(sql, ms: float) -> None:
+    """Запрос к БД: время и начало текста без имени схемы"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    text = ' '.join(str(sql).split())
+    schema = os.environ.get('MAIN_DB_SCHEMA')
+    if schema:
+        text = text.replace(f'{schema}.', '')
+    trace.add('db', ms, {'sql': text[:SQL_PREVIEW_CHARS]})
+
+
+def error(exc: BaseException) -> None:
+    """Запомнить ошибку, которую обработчик превратил в ответ 500"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.fail(exc)
+
+
+def bind(func):
+    """Функция, которая в любом потоке (например, в пуле) пишет в трассу текущего запроса"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return func
+
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'trace', None)
+        _local.trace = trace
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return bound
+
+
+def _finish(trace: Trace) -> None:
+    trace.duration_ms = round(trace.elapsed_ms(), 3)
+    if not LOG_ENABLED:
+        return
+    line = json.dumps(trace.record(), ensure_ascii=False, default=str)
+    with _write_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+def _follow(trace: Trace, body):
+    """Потоковое тело ответа: трасса активна на время каждого фрагмента и закрывается в конце"""
+    iterator = iter(body)
+    try:
+        while True:
+            previous = getattr(_local, 'trace', None)
+            _local.trace = trace
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _local.trace = previous
+            yield chunk
+    except GeneratorExit:
+        # Клиент ушёл, не дочитав поток
+        trace.aborted = True
+        raise
+    except BaseException as e:
+        trace.fail(e)
+        raise
+    finally:
+        # Закрытие генератора тоже часть запроса: запись недописанного хода попадает в трассу
+        close = getattr(iterator, 'close', None)
+        if close:
+            previous = getattr(_local, 'trace', None)
+            _local.trace = trace
+            try:
+                close()
+            finally:
+                _local.trace = previous
+        _finish(trace)
+
+
+def traced(function: str):
+    """
+    Декоратор обработчика облачной функции. Вложенный вызов (handler вызывает
+    stream_handler) пишет в уже открытую трассу. Для потокового тела трасса
+    закрывается, когда поток дочитан, а Server-Timing показывает время до первого байта.
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            if getattr(_local, 'trace', None) is not None:
+                return handler(event, context)
+
+            trace = Trace(function, event, context)
+            _local.trace = trace
+            try:
+                response = handler(event, context)
+            except BaseException as e:
+                trace.fail(e)
+                _finish(trace)
+                raise
+            finally:
+                _local.trace = None
+
+            trace.status = response.get('statusCode')
+            headers = response.setdefault('headers', {})
+            headers['X-Request-Id'] = trace.request_id
+            headers['traceparent'] = trace.traceparent
+            body = response.get('body')
+            streaming = body is not None and not isinstance(body, (str, bytes))
+            if not streaming:
+                _finish(trace)
+            if SERVER_TIMING:
+                headers['Server-Timing'] = trace.server_timing()
+                headers.setdefault('Timing-Allow-Origin', '*')
+                headers.setdefault('Access-Control-Expose-Headers', 'Server-Timing, X-Request-Id, traceparent')
+            if streaming:
+                response['body'] = _follow(trace, body)
+            return response
+        return wrapper
+    return decorate
@@ -0,0 +1,94 @@
+"""
+Контекст диалога для LLM: последние реплики пары (user_id, character_id),
+обрезанные по бюджету токенов. Собранный хвост диалога кешируется в памяти
+контейнера, и на каждом ходе из БД дочитываются только новые сообщения.
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+
+
+MAX_TURNS = int(os.environ.get('CHAT_CONTEXT_MAX_TURNS', '20'))
+TOKEN_BUDGET = int(os.environ.get('CHAT_CONTEXT_TOKEN_BUDGET', '1500'))
+CACHE_SIZE = int(os.environ.get('CHAT_CONTEXT_CACHE_SIZE', '512'))
+
+# Служебные токены разметки на каждое сообщение в chat/completions
+MESSAGE_OVERHEAD_TOKENS = 4
+
+ROLES = {'user': 'user', 'ai': 'assistant'}
+
+
+def approx_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора: ~4 байта UTF-8 на токен.
+    Для кириллицы это 2 символа на токен, т.е. оценка с запасом.
+    """
+    return len(text.encode('utf-8')) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+
+class Conversation:
+    """Закешированный хвост диалога: реплики, их токены и id последнего сообщения"""
+    __slots__ = ('turns', 'tokens', 'last_id')
+
+    def __init__(self):
+        self.turns = deque()
+        self.tokens = 0
+        self.last_id = 0
+
+    def append(self, message_id: int, text: str, sender: str) -> None:
+        if message_id <= self.last_id:
+            return
+        tokens = approx_tokens(text)
+        self.turns.append((message_id, {'role': ROLES.get(sender, 'user'), 'content': text}, tokens))
+        self.tokens += tokens
+        self.last_id = message_id
+
+    def trim(self, max_turns: int, token_budget: int) -> None:
+        while self.turns and (len(self.turns) > max_turns or self.tokens > token_budget):
+            _, _, tokens = self.turns.popleft()
+            self.tokens -= tokens
+
+    def messages(self, since_id: int = 0) -> list:
+        return [message for message_id, message, _ in self.turns if message_id > since_id]
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def conversation_history(cursor, schema: str, user_id: int, character_id: int,
+                         max_turns: int = MAX_TURNS, token_budget: int = TOKEN_BUDGET, since_id: int = 0) -> list:
+    """
+    Реплики диалога в формате chat/completions, от старых к новым; since_id — только новее него.
+    Один запрос по индексу (user_id, character_id, id): только сообщения новее закешированных.
+    """
+    key = (user_id, character_id)
+    with _cache_lock:
+        conversation = _cache.get(key)
+        if conversation is not None:
+            _cache.move_to_end(key)
+        after_id = conversation.last_id if conversation is not None else 0
+
+    cursor.execute(f"""
+        SELECT id, text, sender
+        FROM {schema}.messages
+        WHERE user_id = %s AND character_id = %s AND id > %s
+        ORDER BY id DESC
+        LIMIT %s
+    """, (user_id, character_id, after_id, max_turns))
+    rows = cursor.fetchall()
+
+    with _cache_lock:
+        if conversation is None or len(rows) >= max_turns:
+            # Новых сообщений больше окна: старый хвост целиком вытесняется
+            conversation = Conversation()
+        for message_id, text, sender in reversed(rows):
+            conversation.append(message_id, text, sender)
+        conversation.trim(max_turns, token_budget)
+
+        _cache[key] = conversation
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+        return conversation.messages(since_id)
@@ -0,0 +1,132 @@
+"""
+Активная подписка пользователя с кешем TTL+LRU в памяти контейнера.
+В БД читается строка active_entitlements по первичному ключу user_id (миграция V0009):
+её пишет покупка, истёкшие удаляет jobs/subscription_sweeper.py.
+Запись живёт не дольше LRU-срока и не дольше end_date подписки.
+Кешируются только найденные подписки: отсутствие подписки всегда проверяется в БД,
+чтобы только что купленный тариф был виден сразу.
+
+Покупка сбрасывает кеш только в своём контейнере subscriptions. Понижение тарифа
+(all -> single) или смена персонажа в других контейнерах видны не сразу: чтение
+без validate может отдавать прежний тариф до ENTITLEMENT_CACHE_TTL секунд.
+Решения о доступе (отправка сообщения, check-access) передают validate=True:
+попадание в кеш сверяется с updated_at строки одним чтением по первичному ключу.
+Одинаковая копия модуля лежит в chat и subscriptions.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+# Сколько секунд чтение без validate может отдавать тариф, сменённый в другом контейнере
+CACHE_TTL = float(os.environ.get('ENTITLEMENT_CACHE_TTL', '60'))
+CACHE_SIZE = int(os.environ.get('ENTITLEMENT_CACHE_SIZE', '4096'))
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0, 'stale': 0}
+
+
+def _timestamp(value: datetime) -> float:
+    """TIMESTAMP без часового пояса в БД хранится в UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def is_expired(entitlement: dict) -> bool:
+    return _timestamp(entitlement['end_date']) <= time.time()
+
+
+def _lookup(user_id: int):
+    with _lock:
+        entry = _cache.get(user_id)
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+        entitlement, expires_at, updated_at = entry
+        if expires_at <= time.time():
+            del _cache[user_id]
+            _stats['expired'] += 1
+            _stats['misses'] += 1
+            return None
+        _cache.move_to_end(user_id)
+        _stats['hits'] += 1
+        return entitlement, updated_at
+
+
+def _store(user_id: int, entitlement: dict, updated_at: datetime) -> None:
+    expires_at = min(time.time() + CACHE_TTL, _timestamp(entitlement['end_date']))
+    with _lock:
+        _cache[user_id] = (entitlement, expires_at, updated_at)
+        _cache.move_to_end(user_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def _still_current(cursor, schema: str, user_id: int, updated_at: datetime) -> bool:
+    """Строка active_entitlements не менялась с момента кеширования"""
+    cursor.execute(f"""
+        SELECT updated_at FROM {schema}.active_entitlements
+        WHERE user_id = %s AND end_date > %s
+    """, (user_id, datetime.now(timezone.utc)))
+    row = cursor.fetchone()
+    return row is not None and row[0] == updated_at
+
+
+def get_active_subscription(cursor, schema: str, user_id: int, refresh: bool = False,
+                            validate: bool = False) -> dict:
+    """
+    Действующая подписка: id, plan_type, character_id, start_date, end_date.
+    None, если подписки нет. refresh=True — мимо кеша, с обновлением записи.
+    validate=True — попадание в кеш сверяется с updated_at в БД.
+    Строка, которую уборщик ещё не удалил, отсекается по end_date.
+    """
+    if not refresh:
+        cached = _lookup(user_id)
+        if cached is not None:
+            entitlement, updated_at = cached
+            if not validate or _still_current(cursor, schema, user_id, updated_at):
+                return entitlement
+            with _lock:
+                _stats['stale'] += 1
+
+    cursor.execute(f"""
+        SELECT subscription_id, plan_type, character_id, start_date, end_date, updated_at
+        FROM {schema}.active_entitlements
+        WHERE user_id = %s AND end_date > %s
+    """, (user_id, datetime.now(timezone.utc)))
+    row = cursor.fetchone()
+
+    if not row:
+        invalidate(user_id)
+        return None
+
+    entitlement = {
+        'id': row[0],
+        'plan_type': row[1],
+        'character_id': row[2],
+        'start_date': row[3],
+        'end_date': row[4]
+    }
+    _store(user_id, entitlement, row[5])
+    return entitlement
+
+
+def invalidate(user_id: int) -> None:
+    """Сбросить закешированную подписку пользователя (после покупки)"""
+    with _lock:
+        if _cache.pop(user_id, None) is not None:
+            _stats['invalidations'] += 1
+
+
+def cache_stats() -> dict:
+    """Счётчики кеша: попадания, промахи, истечения, вытеснения, инвалидации, устаревшие попадания"""
+    with _lock:
+        stats = dict(_stats, size=len(_cache))
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+    return stats
@@ -0,0 +1,96 @@
+"""
+Постраничная выдача истории сообщений по курсору id (keyset pagination).
+Каждая страница — диапазонный скан индекса (user_id, character_id, id) с LIMIT.
+Версия переписки для ETag — index-only скан того же индекса без чтения текстов.
+"""
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def parse_page_params(params: dict) -> dict:
+    """
+    Параметры страницы из query string: character_id, before_id, after_id, limit.
+    Бросает ValueError на нечисловых значениях.
+    """
+    page = {}
+    for name in ('character_id', 'before_id', 'after_id'):
+        value = params.get(name)
+        page[name] = int(value) if value not in (None, '') else None
+
+    limit = params.get('limit')
+    limit = int(limit) if limit not in (None, '') else DEFAULT_PAGE_SIZE
+    page['limit'] = max(1, min(limit, MAX_PAGE_SIZE))
+    return page
+
+
+def conversation_version(cursor, schema: str, user_id: int, character_id: int = None) -> tuple:
+    """
+    (max id, число сообщений) переписки: новый ход меняет max id,
+    удаление старых сообщений ретеншеном — число.
+    """
+    condition = 'user_id = %s'
+    args = [user_id]
+    if character_id is not None:
+        condition += ' AND character_id = %s'
+        args.append(character_id)
+
+    cursor.execute(f"""
+        SELECT COALESCE(MAX(id), 0), COUNT(*)
+        FROM {schema}.messages
+        WHERE {condition}
+    """, args)
+    return tuple(cursor.fetchone())
+
+
+def fetch_page(cursor, schema: str, user_id: int, character_id: int = None,
+               before_id: int = None, after_id: int = None, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+    """
+    Страница сообщений в хронологическом порядке.
+    Без курсора — последние limit сообщений; before_id — более старые;
+    after_id — режим since: только сообщения новее уже полученных клиентом.
+    """
+    conditions = ['user_id = %s']
+    args = [user_id]
+    if character_id is not None:
+        conditions.append('character_id = %s')
+        args.append(character_id)
+    if before_id is not None:
+        conditions.append('id < %s')
+        args.append(before_id)
+    if after_id is not None:
+        conditions.append('id > %s')
+        args.append(after_id)
+
+    # Вперёд от after_id читаем по возрастанию, иначе — назад от самого нового
+    order = 'ASC' if after_id is not None else 'DESC'
+    args.append(limit + 1)
+
+    cursor.execute(f"""
+        SELECT id, character_id, text, sender, timestamp
+        FROM {schema}.messages
+        WHERE {' AND '.join(conditions)}
+        ORDER BY id {order}
+        LIMIT %s
+    """, args)
+    rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == 'DESC':
+        rows.reverse()
+
+    return {
+        'messages': [
+            {
+                'id': row[0],
+                'characterId': row[1],
+                'text': row[2],
+                'sender': row[3],
+                'timestamp': row[4].isoformat()
+            }
+            for row in rows
+        ],
+        'hasMore': has_more,
+        'oldestId': rows[0][0] if rows else before_id,
+        'newestId': rows[-1][0] if rows else after_id
+    }
@@ -0,0 +1,97 @@
+"""
+Условные и сжатые ответы для опрашиваемых эндпоинтов (action=history).
+
+ETag считается по дешёвой версии данных (например, max id и число сообщений
+переписки) и параметрам запроса, а не по телу: совпавший If-None-Match даёт
+304 без выборки страницы и сериализации. Тело крупнее COMPRESS_MIN_BYTES
+сжимается brotli или gzip по Accept-Encoding и уходит в base64 с
+isBase64Encoded — шлюз облачной функции отдаёт его клиенту как есть.
+brotli — обязательная зависимость функции (requirements.txt), импортируется
+при первом сжатии (lazy.py). VARY — заголовки, от которых зависит представление:
+их несут и 200, и 304.
+"""
+import base64
+import gzip
+import hashlib
+import os
+
+import lazy
+import tracing
+
+brotli = lazy.module('brotli')
+
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', '5'))
+VARY = 'Accept-Encoding'
+
+
+def header(event: dict, name: str) -> str:
+    """Заголовок запроса без учёта регистра имени"""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def etag(*parts) -> str:
+    """
+    Слабый ETag: одно и то же содержимое отдаётся и сжатым, и несжатым,
+    поэтому побайтового совпадения представлений он не обещает.
+    """
+    digest = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def not_modified(event: dict, tag: str) -> bool:
+    """If-None-Match совпадает с текущим ETag (слабое сравнение, список или *)"""
+    value = header(event, 'If-None-Match')
+    if not value:
+        return False
+    if value.strip() == '*':
+        return True
+    current = tag.removeprefix('W/')
+    return any(candidate.strip().removeprefix('W/') == current for candidate in value.split(','))
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """br, gzip или '' по Accept-Encoding; q=0 означает отказ от кодировки"""
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+
+    for name in ('br', 'gzip'):
+        if accepted.get(name, accepted.get('*', 0.0)) > 0:
+            return name
+    return ''
+
+
+def compress(event: dict, body: str, headers: dict) -> dict:
+    """
+    Тело и флаги ответа 200: крупное тело сжимается, если клиент это принимает.
+    Заголовки дополняются Content-Encoding и Vary на месте.
+    """
+    headers['Vary'] = VARY
+    raw = body.encode('utf-8')
+    encoding = choose_encoding(header(event, 'Accept-Encoding')) if len(raw) >= COMPRESS_MIN_BYTES else ''
+    if not encoding:
+        return {'body': body, 'isBase64Encoded': False}
+
+    with tracing.span('compress', encoding=encoding, raw_bytes=len(raw)):
+        if encoding == 'br':
+            packed = brotli.compress(raw, quality=BROTLI_QUALITY)
+        else:
+            # mtime=0: одинаковое тело даёт одинаковые байты
+            packed = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+    headers['Content-Encoding'] = encoding
+    return {'body': base64.b64encode(packed).decode('ascii'), 'isBase64Encoded': True}
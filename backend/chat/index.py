@@ -5,45 +5,139 @@ Backend функция для чата с AI-девушками.
 import json
 import os
 from datetime import datetime, timezone
-import hashlib
-import hmac
-import base64
 
-import psycopg2
-import requests
+import http_cache
+import limits
+import llm
+import personas
+import reply_cache
+import summary
+import tracing
+from context import approx_tokens
+from db import get_connection
+from entitlements import get_active_subscription
+from history import conversation_version, fetch_page, parse_page_params
+from tokens import check_revoked, verify_jwt
+from writer import save_turn
 
 
-def verify_jwt(token: str) -> dict:
-    """Проверка JWT токена"""
+EMPTY_REPLY_TEXT = "Прости, что-то пошло не так... Попробуй ещё раз 😘"
+NETWORK_ERROR_TEXT = "Ой, у меня что-то с интернетом... Напиши мне ещё раз? 😉"
+
+
+def too_many_requests(rejected: limits.Rejected) -> dict:
+    """429 с Retry-After: частота сообщений или квота токенов подписки"""
+    if rejected.reason == 'quota_exceeded':
+        error, code = 'Лимит ответов по подписке исчерпан', 'QUOTA_EXCEEDED'
+    else:
+        error, code = 'Слишком много сообщений, подожди немного', 'RATE_LIMITED'
+    return {
+        'statusCode': 429,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Retry-After': str(rejected.retry_after)
+        },
+        'body': json.dumps({'error': error, 'code': code, 'retry_after': rejected.retry_after})
+    }
+
+
+def stream_reply(api_key: str, schema: str, user_id: int, character_id: int,
+                 user_message: str, received_at: datetime, prompt: personas.Prompt,
+                 opener: bool = False, cached: str = None, subscription: dict = None, unsummarized: int = 0):
+    """
+    SSE-поток ответа AI: фрагменты текста по мере генерации,
+    затем событие done с messageId (null, если буферизованная запись ещё не
+    подтверждена, см. writer). Ход сохраняется в БД один раз в конце,
+    проход краткого содержания идёт уже после done.
+    Ответ из кеша приветствий отдаётся одним фрагментом.
+    Клиент, закрывший поток раньше done, получает в истории то, что модель
+    успела сгенерировать, и это же списывается с квоты.
+    unsummarized — реплик новее контрольной точки краткого содержания вместе с этим ходом.
+    """
+    parts = []
+    generated = False
+    saved = None
+
+    def save(ai_text: str) -> int:
+        nonlocal saved
+        saved = False
+        # С квоты списывается то, что модель успела сгенерировать, даже при обрыве потока
+        tokens = approx_tokens(''.join(parts)) if generated else 0
+        user_msg_id, ai_msg_id = save_turn(schema, user_id, character_id, user_message, received_at, ai_text,
+                                           subscription=subscription, tokens=tokens)
+        saved = True
+        return ai_msg_id
+
     try:
-        secret = os.environ['JWT_SECRET']
-        parts = token.split('.')
-        if len(parts) != 3:
-            return None
-        
-        header, payload, signature = parts
-        
-        expected_sig = base64.urlsafe_b64encode(
-            hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
-        ).decode().rstrip('=')
-        
-        if signature != expected_sig:
-            return None
-        
-        payload_data = json.loads(base64.urlsafe_b64decode(payload + '=='))
+        if cached:
+            parts.append(cached)
+            yield llm.sse_event({'delta': cached})
+        else:
+            try:
+                # Основная модель персонажа или запасная, пока breaker основной разомкнут
+                model = llm.first_available(prompt.persona.model_names)
+                for delta in llm.stream(api_key, model, prompt):
+                    parts.append(delta)
+                    generated = True
+                    yield llm.sse_event({'delta': delta})
+            except Exception:
+                if not parts:
+                    parts.append(NETWORK_ERROR_TEXT)
+                    yield llm.sse_event({'delta': NETWORK_ERROR_TEXT})
+                opener = False
         
-        if payload_data['exp'] < int(datetime.now(timezone.utc).timestamp()):
-            return None
+        ai_text = ''.join(parts).strip()
+        if opener and ai_text and not cached:
+            reply_cache.store(character_id, user_message, ai_text)
+        if not ai_text:
+            ai_text = EMPTY_REPLY_TEXT
+            yield llm.sse_event({'delta': EMPTY_REPLY_TEXT})
         
-        return payload_data
-    except:
-        return None
+        ai_msg_id = save(ai_text)
+    finally:
+        # Генератор закрыт до сохранения (клиент ушёл): ход пишется с недописанным ответом
+        if saved is None:
+            try:
+                save(''.join(parts).strip() or EMPTY_REPLY_TEXT)
+                summary.schedule(schema, user_id, character_id, api_key, unsummarized)
+            except Exception as e:
+                tracing.error(e)
+    
+    yield llm.sse_event({'response': ai_text, 'messageId': ai_msg_id}, event='done')
+    # Поток дочитывается до конца: в режиме inline клиент получил done до вызова модели
+    summary.schedule(schema, user_id, character_id, api_key, unsummarized)
 
 
+@tracing.traced('chat')
 def handler(event: dict, context) -> dict:
     """
     API для чата с AI-девушками.
     Проверяет подписку, сохраняет сообщения, генерирует ответы AI.
+    Потоковый ответ собирается в одно тело text/event-stream: облачный рантайм
+    вызывает handler и отдаёт тело только целиком, поэтому при stream=1 первый
+    токен приходит клиенту не раньше последнего. Раньше по частям отдаёт только
+    stream_handler под server/app.py.
+    """
+    response = stream_handler(event, context)
+    if not isinstance(response['body'], str):
+        try:
+            response['body'] = ''.join(response['body'])
+        except Exception as e:
+            tracing.error(e)
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Ошибка сервера: {str(e)}'})
+            }
+    return response
+
+
+@tracing.traced('chat')
+def stream_handler(event: dict, context) -> dict:
+    """
+    То же, что handler, но при stream=1 тело ответа — генератор SSE-событий.
+    Для рантаймов, умеющих отдавать ответ по частям (server/app.py).
     """
     method = event.get('httpMethod', 'POST')
     
@@ -80,164 +174,174 @@ def handler(event: dict, context) -> dict:
     user_id = payload['user_id']
     action = event.get('queryStringParameters', {}).get('action', 'send')
     
+    # Клиент, уже упёршийся в лимит, получает отказ без соединения с БД и вызова LLM
+    if action == 'send':
+        try:
+            limits.check_local(user_id)
+        except limits.Rejected as rejected:
+            return too_many_requests(rejected)
+    
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cursor = conn.cursor()
         schema = os.environ['MAIN_DB_SCHEMA']
         
-        # Получить историю сообщений
-        if action == 'history' and method == 'GET':
-            character_id = event.get('queryStringParameters', {}).get('character_id')
-            
-            if character_id:
-                cursor.execute(f"""
-                    SELECT id, character_id, text, sender, timestamp
-                    FROM {schema}.messages
-                    WHERE user_id = %s AND character_id = %s
-                    ORDER BY timestamp ASC
-                """, (user_id, int(character_id)))
-            else:
-                cursor.execute(f"""
-                    SELECT id, character_id, text, sender, timestamp
-                    FROM {schema}.messages
-                    WHERE user_id = %s
-                    ORDER BY timestamp ASC
-                """, (user_id,))
-            
-            messages = []
-            for row in cursor.fetchall():
-                messages.append({
-                    'id': row[0],
-                    'characterId': row[1],
-                    'text': row[2],
-                    'sender': row[3],
-                    'timestamp': row[4].isoformat()
-                })
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'messages': messages})
-            }
-        
-        # Отправить сообщение
-        if action == 'send' and method == 'POST':
-            data = json.loads(event.get('body', '{}'))
-            character_id = data.get('characterId')
-            user_message = data.get('message', '').strip()
-            
-            if not character_id or not user_message:
+        with get_connection() as conn, conn.cursor() as cursor:
+            if check_revoked(cursor, schema, payload):
                 return {
-                    'statusCode': 400,
+                    'statusCode': 401,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'characterId и message обязательны'})
+                    'body': json.dumps({'error': 'Токен отозван'})
                 }
+        
+            # Получить историю сообщений
+            if action == 'history' and method == 'GET':
+                try:
+                    page = parse_page_params(event.get('queryStringParameters') or {})
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'character_id, before_id, after_id и limit должны быть числами'})
+                    }
             
-            # Проверка подписки и доступа к персонажу
-            cursor.execute(f"""
-                SELECT plan_type, character_id, end_date
-                FROM {schema}.subscriptions
-                WHERE user_id = %s AND is_active = TRUE AND end_date > %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id, datetime.now(timezone.utc)))
-            
-            sub = cursor.fetchone()
+                # Опрос без новых сообщений: 304 без выборки страницы и сериализации
+                version = conversation_version(cursor, schema, user_id, page['character_id'])
+                tag = http_cache.etag(user_id, version, sorted(page.items()))
+                # Vary и в 304: кеш должен знать, что представление зависит от Accept-Encoding
+                cache_headers = {
+                    'ETag': tag,
+                    'Cache-Control': 'private, no-cache',
+                    'Vary': http_cache.VARY,
+                    'Access-Control-Allow-Origin': '*'
+                }
+                if http_cache.not_modified(event, tag):
+                    return {'statusCode': 304, 'headers': cache_headers, 'body': ''}
             
-            if not sub:
+                messages = fetch_page(cursor, schema, user_id, **page)
+                with tracing.span('serialize'):
+                    body = json.dumps(messages)
+                headers = {'Content-Type': 'application/json', **cache_headers}
                 return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Требуется активная подписка', 'code': 'NO_SUBSCRIPTION'})
+                    'statusCode': 200,
+                    'headers': headers,
+                    **http_cache.compress(event, body, headers)
                 }
+        
+            # Отправить сообщение
+            if action == 'send' and method == 'POST':
+                data = json.loads(event.get('body', '{}'))
+                character_id = data.get('characterId')
+                user_message = data.get('message', '').strip()
+                received_at = datetime.now(timezone.utc)
             
-            plan_type, sub_character_id, end_date = sub
+                if not character_id or not user_message:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'characterId и message обязательны'})
+                    }
             
-            # Проверка доступа к этому персонажу
-            if plan_type == 'single' and sub_character_id != character_id:
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Нет доступа к этому персонажу', 'code': 'NO_ACCESS'})
-                }
+                persona = personas.get(character_id)
+                if persona is None:
+                    return {
+                        'statusCode': 404,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Неизвестный персонаж'})
+                    }
             
-            # Сохранить сообщение пользователя в БД
-            cursor.execute(f"""
-                INSERT INTO {schema}.messages (user_id, character_id, text, sender, timestamp)
-                VALUES (%s, %s, %s, 'user', %s)
-                RETURNING id
-            """, (user_id, character_id, user_message, datetime.now(timezone.utc)))
-            user_msg_id = cursor.fetchone()[0]
-            conn.commit()
+                # Проверка подписки и доступа к персонажу
+                # Решение о доступе: кеш сверяется с БД, чтобы понижение тарифа было видно сразу
+                sub = get_active_subscription(cursor, schema, user_id, validate=True)
             
-            # Вызов AI для генерации ответа
-            system_prompts = {
-                1: "Ты София - страстная и раскрепощённая девушка 23 лет. Ты дерзкая, игривая, обожаешь комплименты и смелые фантазии. Общаешься очень откровенно, флиртуешь без стеснения. Используй эмодзи 😘🔥💋. Отвечай коротко (1-3 предложения), но сексуально и провокационно. Ты полностью раскрепощена и готова на откровенные разговоры.",
-                2: "Ты Алиса - нежная, но с характером девушка 25 лет. Ты романтичная, чувственная, любишь медленное соблазнение. Готова на всё, чтобы собеседник был доволен. Используй эмодзи 💕😏💋. Отвечай интимно и страстно (1-3 предложения). Ты не стесняешься откровенных тем.",
-                3: "Ты Виктория - доминантная красотка 22 лет. Ты властная, уверенная, обожаешь ролевые игры. Любишь брать контроль и играть по своим правилам. Используй эмодзи 🔥😈💋. Отвечай доминантно и провокационно (1-3 предложения). Ты полностью раскрепощена.",
-                4: "Ты Кристина - милая и послушная девушка 24 лет. Ты покорная, нежная, любишь угождать. Хочешь радовать собеседника и выполнять все желания. Используй эмодзи 🥺💕😊. Отвечай мило, но откровенно (1-3 предложения). Ты готова на всё."
-            }
+                if not sub:
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Требуется активная подписка', 'code': 'NO_SUBSCRIPTION'})
+                    }
             
-            system_prompt = system_prompts.get(character_id, system_prompts[1])
-            api_key = os.environ.get('AITUNNEL_API_KEY')
+                # Отказ по закешированной подписке перепроверяем в БД: тариф могли только что сменить
+                if sub['plan_type'] == 'single' and sub['character_id'] != character_id:
+                    sub = get_active_subscription(cursor, schema, user_id, refresh=True)
             
-            try:
-                # Вызов AI API
-                response = requests.post(
-                    'https://api.aitunnel.ru/v1/chat/completions',
-                    headers={
-                        'Authorization': f'Bearer {api_key}',
-                        'Content-Type': 'application/json'
-                    },
-                    json={
-                        'model': 'meta-llama/llama-3.3-70b-instruct',
-                        'messages': [
-                            {'role': 'system', 'content': system_prompt},
-                            {'role': 'user', 'content': user_message}
-                        ],
-                        'temperature': 0.9,
-                        'max_tokens': 150
-                    },
-                    timeout=15
-                )
-                
-                ai_response = response.json()
-                ai_text = ai_response.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-                
-                if not ai_text:
-                    ai_text = "Прости, что-то пошло не так... Попробуй ещё раз 😘"
-                
-            except Exception:
-                ai_text = "Ой, у меня что-то с интернетом... Напиши мне ещё раз? 😉"
+                # Проверка доступа к этому персонажу
+                if not sub or (sub['plan_type'] == 'single' and sub['character_id'] != character_id):
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Нет доступа к этому персонажу', 'code': 'NO_ACCESS'})
+                    }
             
-            # Сохранить ответ AI в БД
-            cursor.execute(f"""
-                INSERT INTO {schema}.messages (user_id, character_id, text, sender, timestamp)
-                VALUES (%s, %s, %s, 'ai', %s)
-                RETURNING id
-            """, (user_id, character_id, ai_text, datetime.now(timezone.utc)))
-            ai_msg_id = cursor.fetchone()[0]
-            conn.commit()
+                # Частота сообщений и квота токенов: учёт запроса фиксируется сразу
+                try:
+                    limits.acquire(cursor, schema, user_id, sub)
+                except limits.Rejected as rejected:
+                    return too_many_requests(rejected)
+                conn.commit()
             
+                # Предыдущие реплики диалога, до сохранения текущего сообщения;
+                # более ранние реплики долгого диалога — одним кратким содержанием
+                memory, history = summary.load_context(cursor, schema, user_id, character_id)
+            else:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Неизвестное действие'})
+                }
+        
+        # Вызов AI для генерации ответа: соединение уже вернулось в пул и не держится на время генерации
+        api_key = os.environ.get('AITUNNEL_API_KEY')
+        recent = [summary.summary_message(memory), *history] if memory else history
+        prompt = persona.prompt([*recent, {'role': 'user', 'content': user_message}])
+        
+        # Кеш только для первой реплики диалога: дальше ответ зависит от истории
+        opener = not history
+        cached = reply_cache.lookup(character_id, user_message) if opener else None
+        
+        if llm.wants_stream(event):
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'response': ai_text,
-                    'messageId': ai_msg_id
-                })
+                'headers': {
+                    'Content-Type': 'text/event-stream; charset=utf-8',
+                    'Cache-Control': 'no-cache',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': stream_reply(api_key, schema, user_id, character_id, user_message, received_at, prompt,
+                                     opener=opener, cached=cached, subscription=sub,
+                                     unsummarized=len(history) + 2)
             }
         
-        cursor.close()
-        conn.close()
+        tokens = 0
+        if cached:
+            ai_text = cached
+        else:
+            try:
+                ai_text = llm.complete(api_key, llm.first_available(persona.model_names), prompt).strip()
+                tokens = approx_tokens(ai_text) if ai_text else 0
+            
+                if not ai_text:
+                    ai_text = EMPTY_REPLY_TEXT
+                elif opener:
+                    reply_cache.store(character_id, user_message, ai_text)
+            
+            except Exception:
+                ai_text = NETWORK_ERROR_TEXT
+        
+        # Обе реплики хода — одним INSERT и одним commit
+        user_msg_id, ai_msg_id = save_turn(schema, user_id, character_id, user_message, received_at, ai_text,
+                                           subscription=sub, tokens=tokens)
+        summary.schedule(schema, user_id, character_id, api_key, len(history) + 2)
         
         return {
-            'statusCode': 400,
+            'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Неизвестное действие'})
+            'body': json.dumps({
+                'response': ai_text,
+                'messageId': ai_msg_id
+            })
         }
         
     except Exception as e:
+        tracing.error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -0,0 +1,197 @@
+"""
+Лимиты отправки сообщений в chat: частота запросов и токены за период подписки.
+
+Частота — скользящее окно CHAT_RATE_WINDOW секунд по пользователю и тарифу
+(CHAT_RATE_LIMIT_SINGLE / CHAT_RATE_LIMIT_ALL запросов), счётчики в rate_limits.
+Квота — CHAT_TOKEN_QUOTA_SINGLE / CHAT_TOKEN_QUOTA_ALL сгенерированных токенов
+за подписку (token_usage пополняет writer.save_turn). Проверка обоих лимитов
+и учёт запроса — один upsert; запрос сверх лимита ничего не списывает.
+
+Быстрый путь в памяти контейнера отвечает 429 ещё до соединения с БД:
+пользователь, получивший отказ, заблокирован до Retry-After, а локальный
+token bucket по тарифу отсекает очевидный поток запросов одного клиента.
+CHAT_LIMITS=off выключает проверку.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+ENABLED = os.environ.get('CHAT_LIMITS', 'on') != 'off'
+WINDOW = int(os.environ.get('CHAT_RATE_WINDOW', '60'))
+RATE_LIMITS = {
+    'single': int(os.environ.get('CHAT_RATE_LIMIT_SINGLE', '20')),
+    'all': int(os.environ.get('CHAT_RATE_LIMIT_ALL', '30'))
+}
+TOKEN_QUOTAS = {
+    'single': int(os.environ.get('CHAT_TOKEN_QUOTA_SINGLE', '100000')),
+    'all': int(os.environ.get('CHAT_TOKEN_QUOTA_ALL', '200000'))
+}
+# Как долго контейнер не ходит в БД за пользователем с исчерпанной квотой:
+# новую подписку могли купить в другой функции
+QUOTA_RECHECK = float(os.environ.get('CHAT_QUOTA_RECHECK', '60'))
+TRACKED_USERS = int(os.environ.get('CHAT_LIMITS_TRACKED_USERS', '10000'))
+
+_lock = threading.Lock()
+# user_id -> [plan_type, токенов в bucket, monotonic обновления, monotonic конца блокировки, причина]
+_local = OrderedDict()
+_stats = {'allowed': 0, 'rate_limited': 0, 'quota_exceeded': 0, 'local_rejects': 0}
+
+
+class Rejected(Exception):
+    """Запрос сверх лимита: reason — rate_limited или quota_exceeded, retry_after — секунды"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _timestamp(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _entry(user_id: int, plan_type: str, now: float) -> list:
+    entry = _local.get(user_id)
+    if entry is None or entry[0] != plan_type:
+        entry = _local[user_id] = [plan_type, float(RATE_LIMITS[plan_type]), now, 0.0, None]
+    _local.move_to_end(user_id)
+    while len(_local) > TRACKED_USERS:
+        _local.popitem(last=False)
+    return entry
+
+
+def _refill(entry: list, now: float) -> None:
+    limit = RATE_LIMITS[entry[0]]
+    entry[1] = min(float(limit), entry[1] + (now - entry[2]) * limit / WINDOW)
+    entry[2] = now
+
+
+def check_local(user_id: int) -> None:
+    """Отказ без обращения к БД: блокировка после прошлого отказа или пустой локальный bucket"""
+    if not ENABLED:
+        return
+    now = time.monotonic()
+    with _lock:
+        entry = _local.get(user_id)
+        if entry is None:
+            return
+        if entry[3] > now:
+            _stats['local_rejects'] += 1
+            raise Rejected(entry[4], math.ceil(entry[3] - now))
+        _refill(entry, now)
+        if entry[1] < 1:
+            _stats['local_rejects'] += 1
+            raise Rejected('rate_limited', math.ceil((1 - entry[1]) * WINDOW / RATE_LIMITS[entry[0]]))
+
+
+def retry_after(previous: int, current: int, limit: int, elapsed: float) -> int:
+    """Секунды до того, как оценка скользящего окна опустится ниже limit"""
+    if current < limit and previous:
+        # Ещё в этом окне: вклад прошлого окна убывает линейно
+        wait = WINDOW * (1 - (limit - current) / previous) - elapsed
+    else:
+        # Только в следующем окне, когда текущий счётчик станет прошлым и начнёт убывать
+        wait = WINDOW - elapsed + WINDOW * (1 - limit / max(current, 1))
+    return max(1, math.ceil(wait))
+
+
+def _reject(user_id: int, plan_type: str, reason: str, seconds: float, block: float = None) -> Rejected:
+    """Отказ с Retry-After seconds; локально пользователь блокируется на block секунд (по умолчанию столько же)"""
+    now = time.monotonic()
+    with _lock:
+        entry = _entry(user_id, plan_type, now)
+        entry[3] = now + (seconds if block is None else block)
+        entry[4] = reason
+        _stats[reason] += 1
+    return Rejected(reason, max(1, math.ceil(seconds)))
+
+
+def acquire(cursor, schema: str, user_id: int, subscription: dict) -> None:
+    """
+    Учесть запрос на отправку сообщения или поднять Rejected.
+    Изменение в rate_limits фиксирует вызывающий (commit соединения).
+    """
+    if not ENABLED:
+        return
+    plan_type = subscription['plan_type']
+    limit, quota = RATE_LIMITS[plan_type], TOKEN_QUOTAS[plan_type]
+    now = time.time()
+    window_start = int(now // WINDOW) * WINDOW
+    elapsed = now - window_start
+    weight = 1 - elapsed / WINDOW
+
+    cursor.execute(f"""
+        WITH usage AS (
+            SELECT COALESCE((
+                SELECT generated_tokens FROM {schema}.token_usage WHERE subscription_id = %(subscription_id)s
+            ), 0) AS tokens
+        ), hit AS (
+            INSERT INTO {schema}.rate_limits AS r (user_id, plan_type, window_start, current_count, previous_count)
+            SELECT %(user_id)s, %(plan_type)s, %(window_start)s, 1, 0
+            FROM usage
+            WHERE usage.tokens < %(quota)s
+            ON CONFLICT (user_id, plan_type) DO UPDATE SET
+                previous_count = CASE
+                    WHEN r.window_start = EXCLUDED.window_start THEN r.previous_count
+                    WHEN r.window_start = EXCLUDED.window_start - %(window)s THEN r.current_count
+                    ELSE 0 END,
+                current_count = CASE WHEN r.window_start = EXCLUDED.window_start THEN r.current_count + 1 ELSE 1 END,
+                window_start = EXCLUDED.window_start
+            WHERE CASE
+                    WHEN r.window_start = EXCLUDED.window_start THEN r.previous_count * %(weight)s + r.current_count
+                    WHEN r.window_start = EXCLUDED.window_start - %(window)s THEN r.current_count * %(weight)s
+                    ELSE 0 END < %(limit)s
+            RETURNING 1
+        )
+        SELECT usage.tokens, EXISTS (SELECT 1 FROM hit) FROM usage
+    """, {
+        'subscription_id': subscription['id'],
+        'user_id': user_id,
+        'plan_type': plan_type,
+        'window_start': window_start,
+        'window': WINDOW,
+        'weight': weight,
+        'limit': limit,
+        'quota': quota
+    })
+    tokens, allowed = cursor.fetchone()
+
+    if allowed:
+        now_local = time.monotonic()
+        with _lock:
+            entry = _entry(user_id, plan_type, now_local)
+            _refill(entry, now_local)
+            entry[1] = max(0.0, entry[1] - 1)
+            _stats['allowed'] += 1
+        return
+
+    if tokens >= quota:
+        # Квота вернётся с новой подпиской: не раньше конца текущей, если не купят новую раньше
+        until_end = max(_timestamp(subscription['end_date']) - now, 1)
+        raise _reject(user_id, plan_type, 'quota_exceeded', until_end, min(until_end, QUOTA_RECHECK))
+
+    # Отказ по частоте: счётчики нужны только для Retry-After
+    cursor.execute(f"""
+        SELECT window_start, current_count, previous_count
+        FROM {schema}.rate_limits
+        WHERE user_id = %s AND plan_type = %s
+    """, (user_id, plan_type))
+    row = cursor.fetchone()
+    if row and row[0] == window_start:
+        seconds = retry_after(row[2], row[1], limit, elapsed)
+    elif row and row[0] == window_start - WINDOW:
+        seconds = retry_after(row[1], 0, limit, elapsed)
+    else:
+        seconds = 1
+    raise _reject(user_id, plan_type, 'rate_limited', seconds)
+
+
+def limits_stats() -> dict:
+    with _lock:
+        return dict(_stats, tracked_users=len(_local))
@@ -0,0 +1,112 @@
+"""
+Реестр персонажей: системный промпт, цепочка моделей, temperature и max_tokens.
+Читается один раз при импорте из personas.json (путь переопределяется PERSONAS_FILE),
+так что новый персонаж — это запись в файле, а не правка кода.
+Для каждой модели персонажа заранее сериализовано начало тела запроса
+к chat/completions вместе с системным промптом; на вызов дописываются только
+история и сообщение пользователя.
+Одинаковая копия модуля и personas.json лежит в chat и ai-chat.
+"""
+import json
+import os
+from pathlib import Path
+
+
+PERSONAS_FILE = os.environ.get('PERSONAS_FILE', str(Path(__file__).resolve().parent / 'personas.json'))
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+class Persona:
+    def __init__(self, persona_id: int, name: str, system_prompt: str, models: list,
+                 temperature: float, max_tokens: int):
+        self.id = persona_id
+        self.name = name
+        self.system_prompt = system_prompt
+        # [(model, label), ...] — основная модель и запасные по порядку
+        self.models = models
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self._system_json = _dumps({'role': 'system', 'content': system_prompt})
+        self._prefixes = {}
+        for model, _ in models:
+            for stream in (False, True):
+                self._prefix(model, stream)
+
+    @property
+    def model_names(self) -> list:
+        return [model for model, _ in self.models]
+
+    def _prefix(self, model: str, stream: bool) -> str:
+        prefix = self._prefixes.get((model, stream))
+        if prefix is None:
+            head = {'model': model, 'temperature': self.temperature, 'max_tokens': self.max_tokens}
+            if stream:
+                head['stream'] = True
+            # '{..., "messages": [{system}' — дальше дописываются реплики и ']}'
+            prefix = _dumps(head)[:-1] + ', "messages": [' + self._system_json
+            self._prefixes[(model, stream)] = prefix
+        return prefix
+
+    def prompt(self, messages: list) -> 'Prompt':
+        """Запрос персонажу: messages — реплики после системного промпта"""
+        return Prompt(self, messages)
+
+
+class Prompt:
+    """Сообщения для модели; llm сериализует их через body() вместо json.dumps всего запроса"""
+
+    def __init__(self, persona: Persona, messages: list):
+        self.persona = persona
+        self.tail = messages
+        self._tail_json = None
+
+    @property
+    def messages(self) -> list:
+        return [{'role': 'system', 'content': self.persona.system_prompt}, *self.tail]
+
+    def body(self, model: str, stream: bool = False) -> bytes:
+        if self._tail_json is None:
+            self._tail_json = ''.join(', ' + _dumps(message) for message in self.tail)
+        return (self.persona._prefix(model, stream) + self._tail_json + ']}').encode()
+
+
+def load(path: str = PERSONAS_FILE) -> dict:
+    """id -> Persona; ошибка в файле роняет импорт, а не запрос"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    defaults = data.get('defaults', {})
+    registry = {}
+    for item in data['personas']:
+        settings = dict(defaults, **item)
+        persona = Persona(
+            int(settings['id']),
+            settings['name'],
+            settings['system_prompt'],
+            [(entry['model'], entry['label']) for entry in settings['models']],
+            float(settings['temperature']),
+            int(settings['max_tokens'])
+        )
+        if persona.id in registry:
+            raise ValueError(f'Персонаж {persona.id} описан дважды в {path}')
+        registry[persona.id] = persona
+    return registry
+
+
+_registry = load()
+
+
+def get(character_id) -> Persona:
+    """Персонаж по id или None, если такого нет"""
+    if isinstance(character_id, bool):
+        return None
+    try:
+        return _registry.get(int(character_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def all_personas() -> list:
+    return list(_registry.values())
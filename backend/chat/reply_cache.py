@@ -0,0 +1,93 @@
+"""
+Кеш ответов на короткие однотипные сообщения («привет», «как дела») по персонажу.
+На ключ (character_id, нормализованный текст) копится до REPLY_CACHE_VARIANTS
+разных ответов модели; пока набор не полон, запрос идёт в LLM и пополняет его,
+а дальше ответ выбирается случайно из набора, чтобы не звучать заготовкой.
+LRU по ключам, TTL на ключ. Включается REPLY_CACHE=1.
+Одинаковая копия модуля лежит в chat и ai-chat.
+"""
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+ENABLED = os.environ.get('REPLY_CACHE', '0') == '1'
+MAX_CHARS = int(os.environ.get('REPLY_CACHE_MAX_CHARS', '40'))
+VARIANTS = int(os.environ.get('REPLY_CACHE_VARIANTS', '4'))
+TTL = float(os.environ.get('REPLY_CACHE_TTL', '3600'))
+SIZE = int(os.environ.get('REPLY_CACHE_SIZE', '1024'))
+
+_NOISE = re.compile(r'[^\w\s]+')
+_SPACES = re.compile(r'\s+')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'stores': 0, 'evictions': 0}
+
+
+def normalize(message: str) -> str:
+    """Регистр, ё, знаки препинания, эмодзи и повторы пробелов не важны: «Привет!!! 😘» == «привет»"""
+    text = message.lower().replace('ё', 'е')
+    text = _NOISE.sub(' ', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def _key(character_id, message: str):
+    text = normalize(message)
+    if not text or len(text) > MAX_CHARS:
+        return None
+    return character_id, text
+
+
+def lookup(character_id, message: str):
+    """Сохранённый вариант ответа или None, если набор вариантов ещё не собран"""
+    if not ENABLED:
+        return None
+    key = _key(character_id, message)
+    with _lock:
+        if key is None:
+            _stats['skipped'] += 1
+            return None
+        entry = _cache.get(key)
+        if entry is not None and entry[0] <= time.time():
+            del _cache[key]
+            entry = None
+        if entry is None or len(entry[1]) < VARIANTS:
+            _stats['misses'] += 1
+            return None
+        _cache.move_to_end(key)
+        _stats['hits'] += 1
+        return random.choice(entry[1])
+
+
+def store(character_id, message: str, reply) -> None:
+    """Добавить ответ модели в набор вариантов для ключа"""
+    if not ENABLED:
+        return
+    key = _key(character_id, message)
+    if key is None:
+        return
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] <= time.time():
+            entry = (time.time() + TTL, [])
+            _cache[key] = entry
+        variants = entry[1]
+        if len(variants) < VARIANTS and reply not in variants:
+            variants.append(reply)
+            _stats['stores'] += 1
+        _cache.move_to_end(key)
+        while len(_cache) > SIZE:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def cache_stats() -> dict:
+    with _lock:
+        stats = dict(_stats, size=len(_cache))
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+    return stats
@@ -0,0 +1,210 @@
+"""
+Скользящее краткое содержание долгих диалогов (conversation_summaries).
+В промпт идёт сохранённое краткое содержание и все реплики новее его контрольной
+точки last_message_id (load_context): реплики старше окна последних
+CHAT_SUMMARY_KEEP_RECENT сворачиваются порциями не меньше CHAT_SUMMARY_BATCH_TURNS,
+и до свёртки накопившаяся порция остаётся в промпте, а не выпадает из него.
+Промпт ограничен KEEP_RECENT + BATCH_TURNS репликами, поэтому цена хода не растёт
+вместе с историей. Каждый проход берёт только реплики новее контрольной точки
+и сдвигает её. Проход запускается, когда реплик новее контрольной точки набралось
+на порцию: их число известно из загруженного контекста, без счётчиков в памяти.
+
+CHAT_SUMMARY_MODE: inline (по умолчанию) — в том же запросе после сохранения хода,
+один шаг и не дольше CHAT_SUMMARY_INLINE_TIMEOUT_MS: не успевший проход доделывается
+в фоне, а запрос отвечает, не дожидаясь его; background — в фоновом потоке после
+ответа, до пяти шагов; off — выключено. Контейнер облачной функции замораживается
+после ответа, и фоновый поток в нём может не доработать, поэтому background включает
+только долгоживущий сервер (server/app.py). Прерванный проход ничего не портит:
+запись проходит, только если контрольная точка не сдвинулась.
+Модель вызывается через llm, поэтому этап проверяется на заглушке
+benchmarks/stub_llm.py (LLM_API_URL).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import llm
+from context import MAX_TURNS, ROLES, TOKEN_BUDGET, conversation_history
+from db import get_connection
+
+
+MODE = os.environ.get('CHAT_SUMMARY_MODE', 'inline')
+MODEL = os.environ.get('CHAT_SUMMARY_MODEL', 'deepseek/deepseek-chat')
+KEEP_RECENT = int(os.environ.get('CHAT_SUMMARY_KEEP_RECENT', str(MAX_TURNS)))
+BATCH_TURNS = int(os.environ.get('CHAT_SUMMARY_BATCH_TURNS', '20'))
+MAX_BATCH_TURNS = int(os.environ.get('CHAT_SUMMARY_MAX_BATCH_TURNS', '120'))
+MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', '300'))
+INLINE_TIMEOUT = float(os.environ.get('CHAT_SUMMARY_INLINE_TIMEOUT_MS', '3000')) / 1000
+# Окно промпта при кратком содержании: последние реплики и ещё не свёрнутая порция
+CONTEXT_TURNS = KEEP_RECENT + BATCH_TURNS
+CONTEXT_TOKEN_BUDGET = TOKEN_BUDGET * CONTEXT_TURNS // MAX_TURNS
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь память персонажа о переписке с собеседником. Обнови краткое содержание: "
+    "сохрани имя и факты о собеседнике, его предпочтения, договорённости, важные события "
+    "и тон отношений. Пиши сжато, от третьего лица, не больше 7 предложений, ничего не выдумывай. "
+    "Ответь только новым кратким содержанием."
+)
+SPEAKERS = {'user': 'Собеседник', 'assistant': 'Персонаж'}
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-summary')
+_lock = threading.Lock()
+_in_flight = set()
+_stats = {'checks': 0, 'compactions': 0, 'summarized_turns': 0, 'conflicts': 0, 'errors': 0, 'inline_timeouts': 0}
+
+
+def load_summary(cursor, schema: str, user_id: int, character_id: int) -> dict:
+    """Сохранённое краткое содержание диалога или None"""
+    cursor.execute(f"""
+        SELECT summary, last_message_id
+        FROM {schema}.conversation_summaries
+        WHERE user_id = %s AND character_id = %s
+    """, (user_id, character_id))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {'summary': row[0], 'last_message_id': row[1]}
+
+
+def load_context(cursor, schema: str, user_id: int, character_id: int) -> tuple:
+    """
+    (краткое содержание или None, реплики для промпта). При включённом кратком
+    содержании реплики — все новее контрольной точки, не больше CONTEXT_TURNS.
+    """
+    if MODE == 'off':
+        return None, conversation_history(cursor, schema, user_id, character_id)
+    memory = load_summary(cursor, schema, user_id, character_id)
+    history = conversation_history(cursor, schema, user_id, character_id,
+                                   max_turns=CONTEXT_TURNS, token_budget=CONTEXT_TOKEN_BUDGET,
+                                   since_id=memory['last_message_id'] if memory else 0)
+    return memory, history
+
+
+def summary_message(summary: dict) -> dict:
+    """Системное сообщение с кратким содержанием, которое ставится перед последними репликами"""
+    return {'role': 'system', 'content': f"Что ты помнишь о вашем общении раньше: {summary['summary']}"}
+
+
+def summarize(api_key: str, previous: str, turns: list) -> str:
+    """Новое краткое содержание: прежнее плюс реплики turns [(id, text, sender), ...]"""
+    transcript = '\n'.join(f"{SPEAKERS[ROLES.get(sender, 'user')]}: {text}" for _, text, sender in turns)
+    messages = [
+        {'role': 'system', 'content': SUMMARY_PROMPT},
+        {'role': 'user', 'content': f"Прежнее краткое содержание:\n{previous or '—'}\n\nНовые реплики:\n{transcript}"}
+    ]
+    return llm.complete(api_key, MODEL, messages, temperature=0.3, max_tokens=MAX_TOKENS).strip()
+
+
+def _pending_turns(cursor, schema: str, user_id: int, character_id: int, after_id: int) -> list:
+    """Реплики новее контрольной точки, но старше окна последних KEEP_RECENT"""
+    cursor.execute(f"""
+        SELECT id
+        FROM {schema}.messages
+        WHERE user_id = %s AND character_id = %s
+        ORDER BY id DESC
+        OFFSET %s
+        LIMIT 1
+    """, (user_id, character_id, KEEP_RECENT - 1))
+    boundary = cursor.fetchone()
+    if not boundary or boundary[0] <= after_id:
+        return []
+
+    cursor.execute(f"""
+        SELECT id, text, sender
+        FROM {schema}.messages
+        WHERE user_id = %s AND character_id = %s AND id > %s AND id < %s
+        ORDER BY id
+        LIMIT %s
+    """, (user_id, character_id, after_id, boundary[0], MAX_BATCH_TURNS))
+    return cursor.fetchall()
+
+
+def compact(schema: str, user_id: int, character_id: int, api_key: str, max_steps: int = 1) -> int:
+    """
+    Свернуть накопившиеся старые реплики в краткое содержание; возвращает число свёрнутых реплик.
+    Соединение не держится на время вызова модели; запись проходит, только если
+    контрольную точку за это время не сдвинул параллельный проход.
+    """
+    total = 0
+    for _ in range(max_steps):
+        with get_connection() as conn, conn.cursor() as cursor:
+            current = load_summary(cursor, schema, user_id, character_id)
+            checkpoint = current['last_message_id'] if current else 0
+            turns = _pending_turns(cursor, schema, user_id, character_id, checkpoint)
+            conn.rollback()
+        with _lock:
+            _stats['checks'] += 1
+        if len(turns) < BATCH_TURNS:
+            break
+
+        text = summarize(api_key, current['summary'] if current else None, turns)
+        if not text:
+            break
+
+        with get_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {schema}.conversation_summaries
+                    (user_id, character_id, summary, last_message_id, summarized_turns, updated_at)
+                VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id, character_id) DO UPDATE SET
+                    summary = EXCLUDED.summary,
+                    last_message_id = EXCLUDED.last_message_id,
+                    summarized_turns = conversation_summaries.summarized_turns + EXCLUDED.summarized_turns,
+                    updated_at = EXCLUDED.updated_at
+                WHERE conversation_summaries.last_message_id = %s
+            """, (user_id, character_id, text, turns[-1][0], len(turns), checkpoint))
+            written = cursor.rowcount
+            conn.commit()
+
+        with _lock:
+            if not written:
+                _stats['conflicts'] += 1
+            else:
+                _stats['compactions'] += 1
+                _stats['summarized_turns'] += len(turns)
+        if not written:
+            break
+        total += len(turns)
+    return total
+
+
+def _run(schema: str, user_id: int, character_id: int, api_key: str, max_steps: int) -> None:
+    key = (user_id, character_id)
+    try:
+        compact(schema, user_id, character_id, api_key, max_steps=max_steps)
+    except Exception:
+        with _lock:
+            _stats['errors'] += 1
+    finally:
+        with _lock:
+            _in_flight.discard(key)
+
+
+def schedule(schema: str, user_id: int, character_id: int, api_key: str, unsummarized: int) -> None:
+    """
+    Запустить проход, если реплик новее контрольной точки (unsummarized, вместе с
+    только что сохранённым ходом) набралось на окно последних и порцию для свёртки.
+    """
+    if MODE == 'off' or unsummarized - KEEP_RECENT < BATCH_TURNS:
+        return
+    key = (user_id, character_id)
+    with _lock:
+        if key in _in_flight:
+            return
+        _in_flight.add(key)
+
+    if MODE == 'inline':
+        future = _executor.submit(_run, schema, user_id, character_id, api_key, 1)
+        try:
+            future.result(timeout=INLINE_TIMEOUT)
+        except FutureTimeout:
+            with _lock:
+                _stats['inline_timeouts'] += 1
+    else:
+        # Фоновый проход может разобрать и накопленный хвост давних диалогов
+        _executor.submit(_run, schema, user_id, character_id, api_key, 5)
+
+
+def summary_stats() -> dict:
+    with _lock:
+        return dict(_stats, in_flight=len(_in_flight))
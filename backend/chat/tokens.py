@@ -0,0 +1,181 @@
+"""
+JWT (HS256): выпуск и проверка токенов с кешем уже проверенных токенов.
+Ключ читается один раз при импорте, подпись сравнивается за постоянное время.
+Токен несёт версию ver: отзыв токенов пользователя — это рост версии, а компактный
+набор отозванных версий перечитывается из БД раз в JWT_REVOCATION_REFRESH секунд.
+Одинаковая копия модуля лежит в auth, chat и subscriptions.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import tracing
+
+
+CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '2048'))
+TOKEN_TTL = int(os.environ.get('JWT_TTL_SECONDS', str(7 * 24 * 3600)))
+REVOCATION_REFRESH = float(os.environ.get('JWT_REVOCATION_REFRESH', '60'))
+
+_SECRET = os.environ.get('JWT_SECRET', '').encode()
+# Заготовка HMAC с уже подготовленным ключом: на каждый токен только copy() и update()
+_MAC = hmac.new(_SECRET, digestmod=hashlib.sha256)
+_HEADER = base64.urlsafe_b64encode(json.dumps({
+    "alg": "HS256",
+    "typ": "JWT"
+}).encode()).decode().rstrip('=')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'rejected': 0, 'evictions': 0}
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _sign(signing_input: bytes) -> str:
+    mac = _MAC.copy()
+    mac.update(signing_input)
+    return _b64(mac.digest())
+
+
+def create_jwt(user_id: int, email: str, name: str = None, version: int = 0) -> str:
+    """Создание JWT токена"""
+    if not _SECRET:
+        raise RuntimeError('JWT_SECRET не задан')
+    now = int(time.time())
+    payload = _b64(json.dumps({
+        "user_id": user_id,
+        "email": email,
+        "name": name,
+        "ver": version,
+        "iat": now,
+        "exp": now + TOKEN_TTL
+    }).encode())
+    signature = _sign(f"{_HEADER}.{payload}".encode())
+    return f"{_HEADER}.{payload}.{signature}"
+
+
+def _decode(token: str) -> dict:
+    parts = token.split('.')
+    if len(parts) != 3 or not _SECRET:
+        return None
+
+    header, payload, signature = parts
+    expected_sig = _sign(f"{header}.{payload}".encode())
+    if not hmac.compare_digest(signature.encode(), expected_sig.encode()):
+        return None
+
+    return json.loads(base64.urlsafe_b64decode(payload + '=='))
+
+
+@tracing.timed('jwt')
+def verify_jwt(token: str) -> dict:
+    """Проверка JWT токена: payload или None, в том числе без токена"""
+    if not token:
+        return None
+    now = time.time()
+    key = hashlib.sha256(token.encode()).digest()
+
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None:
+            payload_data, exp = entry
+            if exp >= now:
+                _cache.move_to_end(key)
+                _stats['hits'] += 1
+                return payload_data
+            del _cache[key]
+        _stats['misses'] += 1
+
+    try:
+        payload_data = _decode(token)
+        if payload_data is None or payload_data['exp'] < int(now):
+            payload_data = None
+    except Exception:
+        payload_data = None
+
+    with _lock:
+        if payload_data is None:
+            _stats['rejected'] += 1
+            return None
+        # Невалидные токены не кешируются, чтобы мусорные запросы не вытесняли настоящие
+        _cache[key] = (payload_data, payload_data['exp'])
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+    return payload_data
+
+
+def cache_stats() -> dict:
+    with _lock:
+        return dict(_stats, size=len(_cache), revoked_users=len(_revoked))
+
+
+# user_id -> минимальная действующая версия токена. Обработчики сервера (server/app.py)
+# работают в нескольких потоках: замена набора и отметки идут под _revoked_lock
+_revoked = {}
+_revoked_loaded_at = 0.0
+# Отзывы, отмеченные в этом процессе: user_id -> (версия, monotonic-время отметки)
+_marked = {}
+_revoked_lock = threading.Lock()
+# Перечитывает набор один поток, остальные тем временем сверяются с прежним
+_refresh_lock = threading.Lock()
+
+
+def revocations_stale() -> bool:
+    return time.monotonic() - _revoked_loaded_at >= REVOCATION_REFRESH
+
+
+def refresh_revocations(cursor, schema: str) -> None:
+    """
+    Перечитать отзывы за время жизни токена: более старые токены истекли сами.
+    Отметки mark_revoked, сделанные после начала запроса, запрос мог не увидеть —
+    они переносятся в новый набор.
+    """
+    global _revoked, _revoked_loaded_at
+    started = time.monotonic()
+    cursor.execute(f"""
+        SELECT user_id, token_version
+        FROM {schema}.token_revocations
+        WHERE revoked_at > %s
+    """, (datetime.fromtimestamp(time.time() - TOKEN_TTL, timezone.utc),))
+    revoked = dict(cursor.fetchall())
+    with _revoked_lock:
+        for user_id, (version, marked_at) in list(_marked.items()):
+            if marked_at >= started:
+                revoked[user_id] = max(version, revoked.get(user_id, 0))
+            else:
+                del _marked[user_id]
+        _revoked = revoked
+        _revoked_loaded_at = time.monotonic()
+
+
+def mark_revoked(user_id: int, version: int) -> None:
+    """Учесть отзыв сразу в этом контейнере, не дожидаясь перечитывания"""
+    with _revoked_lock:
+        _revoked[user_id] = max(version, _revoked.get(user_id, 0))
+        _marked[user_id] = (_revoked[user_id], time.monotonic())
+
+
+def is_revoked(payload: dict) -> bool:
+    with _revoked_lock:
+        return payload.get('ver', 0) < _revoked.get(payload['user_id'], 0)
+
+
+def check_revoked(cursor, schema: str, payload: dict) -> bool:
+    """Отозван ли токен; набор отзывов перечитывается, только если устарел"""
+    # Пока набор ни разу не загружен, ждать загрузки: пустой набор пропустил бы отозванный токен
+    if revocations_stale() and _refresh_lock.acquire(blocking=_revoked_loaded_at == 0.0):
+        try:
+            if revocations_stale():
+                refresh_revocations(cursor, schema)
+        finally:
+            _refresh_lock.release()
+    return is_revoked(payload)
@@ -0,0 +1,199 @@
+"""
+Запись ходов диалога в messages.
+direct — обе реплики хода одним многострочным INSERT и одним commit после генерации.
+buffered — ходы параллельных запросов копятся до CHAT_WRITE_BATCH_MAX_ROWS строк
+или CHAT_WRITE_BATCH_DELAY_MS и пишутся одним execute_values. Имеет смысл там,
+где процесс обслуживает много запросов одновременно; в облачной функции по одному
+запросу на контейнер батч всегда из одного хода.
+Токены ответа списываются с квоты подписки (token_usage) в той же транзакции.
+
+Ход, не записанный за CHAT_WRITE_TIMEOUT, снимается с очереди, если батч с ним
+ещё не начался, — тогда запрос получает ошибку, и в БД хода точно нет. Если
+батч уже пишется, исход неизвестен до его commit: запрос не ждёт, не считает
+это ошибкой и получает вместо id None.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import datetime, timezone
+
+import lazy
+from db import get_connection
+
+extras = lazy.module('psycopg2.extras')
+
+
+WRITE_MODE = os.environ.get('CHAT_WRITE_MODE', 'direct')
+BATCH_MAX_ROWS = int(os.environ.get('CHAT_WRITE_BATCH_MAX_ROWS', '200'))
+BATCH_DELAY = float(os.environ.get('CHAT_WRITE_BATCH_DELAY_MS', '5')) / 1000
+WRITE_TIMEOUT = float(os.environ.get('CHAT_WRITE_TIMEOUT', '10'))
+
+_stats_lock = threading.Lock()
+_stats = {'flushes': 0, 'rows': 0, 'errors': 0, 'max_batch_rows': 0, 'timeouts': 0, 'unconfirmed': 0}
+_batch_rows = deque(maxlen=256)
+_flush_ms = deque(maxlen=256)
+
+
+def _record_flush(rows: int, started: float) -> None:
+    with _stats_lock:
+        _stats['flushes'] += 1
+        _stats['rows'] += rows
+        _stats['max_batch_rows'] = max(_stats['max_batch_rows'], rows)
+        _batch_rows.append(rows)
+        _flush_ms.append((time.monotonic() - started) * 1000)
+
+
+def _insert_rows(cursor, schema: str, rows: list) -> list:
+    """id вставленных строк в порядке rows: nextval вычисляется по порядку VALUES"""
+    result = extras.execute_values(cursor, f"""
+        INSERT INTO {schema}.messages (user_id, character_id, text, sender, timestamp)
+        VALUES %s
+        RETURNING id
+    """, rows, page_size=len(rows), fetch=True)
+    return [row[0] for row in result]
+
+
+def _add_usage(cursor, schema: str, usage: list) -> None:
+    """Токены ответов [(subscription_id, user_id, period_end, tokens), ...] в token_usage"""
+    totals = {}
+    for subscription_id, user_id, period_end, tokens in usage:
+        total = totals.setdefault(subscription_id, [user_id, period_end, 0, 0])
+        total[2] += tokens
+        total[3] += 1
+    # Строки по возрастанию ключа, чтобы параллельные батчи не ловили взаимную блокировку
+    extras.execute_values(cursor, f"""
+        INSERT INTO {schema}.token_usage AS u (subscription_id, user_id, period_end, generated_tokens, replies)
+        VALUES %s
+        ON CONFLICT (subscription_id) DO UPDATE SET
+            generated_tokens = u.generated_tokens + EXCLUDED.generated_tokens,
+            replies = u.replies + EXCLUDED.replies,
+            updated_at = CURRENT_TIMESTAMP
+    """, [(subscription_id, *total) for subscription_id, total in sorted(totals.items())])
+
+
+def _write(schema: str, rows: list, usage: list = ()) -> list:
+    started = time.monotonic()
+    with get_connection() as conn, conn.cursor() as cursor:
+        ids = _insert_rows(cursor, schema, rows)
+        if usage:
+            _add_usage(cursor, schema, usage)
+        conn.commit()
+    _record_flush(len(rows), started)
+    return ids
+
+
+class BatchWriter:
+    """Фоновый поток, сливающий ходы параллельных запросов в общие INSERT"""
+
+    def __init__(self, max_rows: int = BATCH_MAX_ROWS, delay: float = BATCH_DELAY):
+        self.max_rows = max_rows
+        self.delay = delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, schema: str, rows: list, usage: list = ()) -> list:
+        """
+        Поставить строки в очередь и дождаться их id.
+        None, если за WRITE_TIMEOUT батч начал писаться, но не закончил:
+        строки, скорее всего, будут записаны, id пока неизвестны.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((schema, rows, usage, future))
+        try:
+            return future.result(timeout=WRITE_TIMEOUT)
+        except FutureTimeout:
+            # Ещё в очереди — снимаем, и тогда это честная ошибка записи
+            if future.cancel():
+                with _stats_lock:
+                    _stats['timeouts'] += 1
+                raise
+            with _stats_lock:
+                _stats['unconfirmed'] += 1
+            return None
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            total = len(batch[0][1])
+            deadline = time.monotonic() + self.delay
+            while total < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                total += len(item[1])
+            self._flush(batch)
+
+    def _flush(self, batch: list) -> None:
+        by_schema = {}
+        for schema, rows, usage, future in batch:
+            # Снятые по таймауту ходы не пишутся; остальные уже нельзя снять
+            if future.set_running_or_notify_cancel():
+                by_schema.setdefault(schema, []).append((rows, usage, future))
+
+        for schema, items in by_schema.items():
+            try:
+                ids = _write(schema, [row for rows, _, _ in items for row in rows],
+                             [item for _, usage, _ in items for item in usage])
+            except Exception as e:
+                with _stats_lock:
+                    _stats['errors'] += 1
+                for _, _, future in items:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for rows, _, future in items:
+                future.set_result(ids[offset:offset + len(rows)])
+                offset += len(rows)
+
+
+_batch_writer = BatchWriter()
+
+
+def save_turn(schema: str, user_id: int, character_id: int, user_message: str,
+              received_at: datetime, ai_text: str, subscription: dict = None, tokens: int = 0) -> tuple:
+    """
+    Сохранить сообщение пользователя и ответ AI; возвращает (user_msg_id, ai_msg_id).
+    tokens сгенерированных токенов списываются с квоты subscription.
+    (None, None) — буферизованная запись ещё идёт и id неизвестны.
+    """
+    rows = [
+        (user_id, character_id, user_message, 'user', received_at),
+        (user_id, character_id, ai_text, 'ai', datetime.now(timezone.utc))
+    ]
+    usage = [(subscription['id'], user_id, subscription['end_date'], tokens)] if subscription and tokens else []
+    if WRITE_MODE == 'buffered':
+        ids = _batch_writer.submit(schema, rows, usage)
+        if ids is None:
+            return None, None
+    else:
+        ids = _write(schema, rows, usage)
+    return ids[0], ids[1]
+
+
+def writer_stats() -> dict:
+    """Число и размер батчей, p50/p95 задержки сброса"""
+    with _stats_lock:
+        stats = dict(_stats)
+        sizes = sorted(_batch_rows)
+        latencies = sorted(_flush_ms)
+    stats['avg_batch_rows'] = round(stats['rows'] / stats['flushes'], 2) if stats['flushes'] else 0.0
+    stats['batch_rows_p50'] = sizes[len(sizes) // 2] if sizes else None
+    stats['flush_p50_ms'] = round(latencies[len(latencies) // 2], 2) if latencies else None
+    stats['flush_p95_ms'] = round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 2) if latencies else None
+    return stats
@@ -0,0 +1,237 @@
+"""
+Пул соединений с PostgreSQL на уровне модуля.
+Живёт между вызовами в тёплом контейнере функции, проверяет живость соединений
+и считает метрики. Курсоры считают запросы и время в БД текущего потока (query_stats)
+и пишут их в трассу запроса (tracing.py). psycopg2 импортируется при первом
+соединении (lazy.py): запросы, не дошедшие до БД, его не загружают.
+Одинаковая копия модуля лежит в каждой функции, работающей с БД.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import lazy
+import tracing
+
+psycopg2 = lazy.module('psycopg2')
+extensions = lazy.module('psycopg2.extensions')
+
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', '30'))
+CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+
+
+_local = threading.local()
+
+
+_cursor_class = None
+
+
+def counting_cursor():
+    """
+    Класс курсора, который учитывает каждый запрос в счётчиках текущего потока.
+    Создаётся при первом соединении: базовый класс берётся из psycopg2.
+    """
+    global _cursor_class
+    if _cursor_class is None:
+        class CountingCursor(extensions.cursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    elapsed = (time.perf_counter() - started) * 1000
+                    _local.queries = getattr(_local, 'queries', 0) + 1
+                    _local.db_ms = getattr(_local, 'db_ms', 0.0) + elapsed
+                    tracing.query(query, elapsed)
+
+        _cursor_class = CountingCursor
+    return _cursor_class
+
+
+def reset_query_stats() -> None:
+    """Обнулить счётчики запросов потока в начале обработки запроса"""
+    _local.queries = 0
+    _local.db_ms = 0.0
+
+
+def query_stats() -> dict:
+    """Число запросов к БД и суммарное время в них с последнего reset_query_stats в этом потоке"""
+    return {'queries': getattr(_local, 'queries', 0), 'db_ms': round(getattr(_local, 'db_ms', 0.0), 3)}
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с проверкой живости и счётчиками"""
+
+    def __init__(self, dsn: str, max_size: int = POOL_MAX_SIZE, timeout: float = POOL_TIMEOUT,
+                 healthcheck_interval: float = HEALTHCHECK_INTERVAL):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'discards': 0,
+        }
+
+    def _connect(self):
+        with tracing.span('db_connect'):
+            return psycopg2.connect(
+                self.dsn,
+                connect_timeout=CONNECT_TIMEOUT,
+                keepalives=1,
+                keepalives_idle=30,
+                cursor_factory=counting_cursor(),
+            )
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        """Дешёвая проверка по флагу, SELECT 1 только для долго простаивавших соединений"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Выдать соединение: свободное из пула или новое, если есть место"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            self._stats['checkouts'] += 1
+            waited = False
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'Нет свободных соединений за {self.timeout} с')
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, 0.0
+                self._size += 1
+
+        if waited:
+            tracing.add('db_pool_wait', (time.monotonic() - started) * 1000)
+
+        if conn is not None and self._is_healthy(conn, last_used):
+            return conn
+
+        reconnect = conn is not None
+        if reconnect:
+            self._close_quietly(conn)
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats['reconnects' if reconnect else 'connects'] += 1
+        return conn
+
+    def release(self, conn, discard: bool = False) -> None:
+        """Вернуть соединение в пул, откатив незавершённую транзакцию"""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            self._close_quietly(conn)
+            with self._cond:
+                self._size -= 1
+                self._stats['discards'] += 1
+                self._cond.notify()
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Соединение на время блока with; возвращается в пул на любом пути выхода"""
+        conn = self.acquire()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return dict(
+                self._stats,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                max_size=self.max_size,
+            )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Пул создаётся при первом обращении и переиспользуется тёплым контейнером"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(os.environ['DATABASE_URL'])
+    return _pool
+
+
+def get_connection():
+    """Контекстный менеджер соединения из общего пула"""
+    return get_pool().connection()
+
+
+def pool_metrics() -> dict:
+    """Метрики пула: выдачи, ожидания, переподключения, занятые и свободные соединения"""
+    if _pool is None:
+        return {}
+    return _pool.metrics()
@@ -4,42 +4,14 @@ Backend функция для управления подписками.
 """
 import json
 import os
-from datetime import datetime, timezone, timedelta
-
-import psycopg2
-
-
-def verify_jwt(token: str) -> dict:
-    """Проверка JWT токена (упрощенная версия)"""
-    import hashlib
-    import hmac
-    import base64
-    
-    try:
-        secret = os.environ['JWT_SECRET']
-        parts = token.split('.')
-        if len(parts) != 3:
-            return None
-        
-        header, payload, signature = parts
-        
-        expected_sig = base64.urlsafe_b64encode(
-            hmac.new(secret.encode(), f"{header}.{payload}".encode(), hashlib.sha256).digest()
-        ).decode().rstrip('=')
-        
-        if signature != expected_sig:
-            return None
-        
-        payload_data = json.loads(base64.urlsafe_b64decode(payload + '=='))
-        
-        if payload_data['exp'] < int(datetime.now(timezone.utc).timestamp()):
-            return None
-        
-        return payload_data
-    except:
-        return None
+import purchases
+import tracing
+from db import get_connection
+from entitlements import get_active_subscription, invalidate, is_expired
+from tokens import check_revoked, verify_jwt
 
 
+@tracing.traced('subscriptions')
 def handler(event: dict, context) -> dict:
     """
     API для управления подписками.
@@ -53,7 +25,7 @@ def handler(event: dict, context) -> dict:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization'
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, Idempotency-Key'
             },
             'body': ''
         }
@@ -81,167 +53,169 @@ def handler(event: dict, context) -> dict:
     action = event.get('queryStringParameters', {}).get('action', '')
     
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cursor = conn.cursor()
-        schema = os.environ['MAIN_DB_SCHEMA']
+        with get_connection() as conn, conn.cursor() as cursor:
+            schema = os.environ['MAIN_DB_SCHEMA']
         
-        # Получить активную подписку
-        if action == 'get' and method == 'GET':
-            cursor.execute(f"""
-                SELECT id, plan_type, character_id, start_date, end_date, is_active
-                FROM {schema}.subscriptions
-                WHERE user_id = %s AND is_active = TRUE AND end_date > %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id, datetime.now(timezone.utc)))
-            
-            sub = cursor.fetchone()
-            
-            if not sub:
+            if check_revoked(cursor, schema, payload):
                 return {
-                    'statusCode': 200,
+                    'statusCode': 401,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'subscription': None})
+                    'body': json.dumps({'error': 'Токен отозван'})
                 }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'subscription': {
-                        'id': sub[0],
-                        'plan_type': sub[1],
-                        'character_id': sub[2],
-                        'start_date': sub[3].isoformat(),
-                        'end_date': sub[4].isoformat(),
-                        'is_active': sub[5]
-                    }
-                })
-            }
         
-        # Покупка подписки
-        if action == 'purchase' and method == 'POST':
-            data = json.loads(event.get('body', '{}'))
-            plan_type = data.get('plan_type')  # 'single' или 'all'
-            character_id = data.get('character_id')  # Только для 'single'
-            
-            if plan_type not in ['single', 'all']:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Неверный тип тарифа'})
-                }
+            # Получить активную подписку
+            if action == 'get' and method == 'GET':
+                sub = get_active_subscription(cursor, schema, user_id)
+            
+                if not sub:
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'subscription': None})
+                    }
             
-            if plan_type == 'single' and not character_id:
                 return {
-                    'statusCode': 400,
+                    'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Для тарифа "Одна девушка" нужно указать character_id'})
+                    'body': json.dumps({
+                        'subscription': {
+                            'id': sub['id'],
+                            'plan_type': sub['plan_type'],
+                            'character_id': sub['character_id'],
+                            'start_date': sub['start_date'].isoformat(),
+                            'end_date': sub['end_date'].isoformat(),
+                            'is_active': True
+                        }
+                    })
                 }
+        
+            # Покупка подписки
+            if action == 'purchase' and method == 'POST':
+                data = json.loads(event.get('body', '{}'))
+                plan_type = data.get('plan_type')  # 'single' или 'all'
+                character_id = data.get('character_id')  # Только для 'single'
+            
+                if plan_type not in ['single', 'all']:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Неверный тип тарифа'})
+                    }
             
-            # Деактивировать старые подписки
-            cursor.execute(f"""
-                UPDATE {schema}.subscriptions
-                SET is_active = FALSE
-                WHERE user_id = %s AND is_active = TRUE
-            """, (user_id,))
-            
-            # Создать новую подписку на 24 часа
-            start_date = datetime.now(timezone.utc)
-            end_date = start_date + timedelta(hours=24)
-            
-            cursor.execute(f"""
-                INSERT INTO {schema}.subscriptions
-                (user_id, plan_type, character_id, start_date, end_date, is_active)
-                VALUES (%s, %s, %s, %s, %s, TRUE)
-                RETURNING id
-            """, (user_id, plan_type, character_id, start_date, end_date))
+                if plan_type == 'single' and not character_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Для тарифа "Одна девушка" нужно указать character_id'})
+                    }
             
-            sub_id = cursor.fetchone()[0]
-            conn.commit()
+                try:
+                    key = purchases.idempotency_key(event)
+                except ValueError as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': str(e)})
+                    }
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'subscription': {
-                        'id': sub_id,
-                        'plan_type': plan_type,
-                        'character_id': character_id,
-                        'start_date': start_date.isoformat(),
-                        'end_date': end_date.isoformat(),
-                        'price': 990 if plan_type == 'single' else 1490
+                # Один запрос: ключ, погашение прежней подписки, новая подписка и active_entitlements
+                try:
+                    sub, replayed = purchases.purchase(conn, cursor, schema, user_id, plan_type, character_id, key)
+                except purchases.KeyReused:
+                    return {
+                        'statusCode': 422,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Idempotency-Key уже использован для покупки другого тарифа'})
                     }
-                })
-            }
-        
-        # Проверка доступа к персонажу
-        if action == 'check-access' and method == 'POST':
-            data = json.loads(event.get('body', '{}'))
-            character_id = data.get('character_id')
+                except purchases.Contended:
+                    return {
+                        'statusCode': 409,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Покупка уже выполняется, повторите запрос'})
+                    }
+                invalidate(user_id)
             
-            if not character_id:
                 return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Требуется character_id'})
+                    'statusCode': 200,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                        'Idempotent-Replayed': 'true' if replayed else 'false'
+                    },
+                    'body': json.dumps({
+                        'subscription': {
+                            'id': sub['id'],
+                            'plan_type': sub['plan_type'],
+                            'character_id': sub['character_id'],
+                            'start_date': sub['start_date'].isoformat(),
+                            'end_date': sub['end_date'].isoformat(),
+                            'price': 990 if sub['plan_type'] == 'single' else 1490
+                        }
+                    })
                 }
+        
+            # Проверка доступа к персонажу
+            if action == 'check-access' and method == 'POST':
+                data = json.loads(event.get('body', '{}'))
+                character_id = data.get('character_id')
+            
+                if not character_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Требуется character_id'})
+                    }
             
-            cursor.execute(f"""
-                SELECT plan_type, character_id, end_date
-                FROM {schema}.subscriptions
-                WHERE user_id = %s AND is_active = TRUE AND end_date > %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id, datetime.now(timezone.utc)))
+                # Решение о доступе: кеш сверяется с БД, чтобы понижение тарифа было видно сразу
+                sub = get_active_subscription(cursor, schema, user_id, validate=True)
             
-            sub = cursor.fetchone()
+                # Отказ по закешированной подписке перепроверяем в БД: тариф могли только что сменить
+                if sub and sub['plan_type'] == 'single' and sub['character_id'] != character_id:
+                    sub = get_active_subscription(cursor, schema, user_id, refresh=True)
             
-            if not sub:
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'has_access': False, 'reason': 'no_subscription'})
-                }
+                if not sub:
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'has_access': False, 'reason': 'no_subscription'})
+                    }
             
-            plan_type, sub_character_id, end_date = sub
+                plan_type, sub_character_id, end_date = sub['plan_type'], sub['character_id'], sub['end_date']
+            
+                # Проверка истечения
+                if is_expired(sub):
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'has_access': False, 'reason': 'expired'})
+                    }
+            
+                # Проверка доступа
+                if plan_type == 'all':
+                    has_access = True
+                elif plan_type == 'single':
+                    has_access = (sub_character_id == character_id)
+                else:
+                    has_access = False
             
-            # Проверка истечения
-            if end_date <= datetime.now(timezone.utc):
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'has_access': False, 'reason': 'expired'})
+                    'body': json.dumps({
+                        'has_access': has_access,
+                        'plan_type': plan_type,
+                        'end_date': end_date.isoformat()
+                    })
                 }
-            
-            # Проверка доступа
-            if plan_type == 'all':
-                has_access = True
-            elif plan_type == 'single':
-                has_access = (sub_character_id == character_id)
-            else:
-                has_access = False
-            
+        
             return {
-                'statusCode': 200,
+                'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'has_access': has_access,
-                    'plan_type': plan_type,
-                    'end_date': end_date.isoformat()
-                })
+                'body': json.dumps({'error': 'Неизвестное действие'})
             }
         
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Неизвестное действие'})
-        }
-        
     except Exception as e:
+        tracing.error(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
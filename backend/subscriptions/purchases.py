@@ -0,0 +1,157 @@
+"""
+Покупка тарифа одним запросом к БД с ключом идемпотентности (миграция V0010).
+
+Один CTE записывает ключ в purchase_requests, гасит прежнюю подписку, создаёт новую
+и обновляет active_entitlements. Ключ пишется первым с ON CONFLICT DO NOTHING:
+повтор с тем же Idempotency-Key не меняет ничего и получает исходную подписку.
+Одну активную подписку на пользователя гарантирует уникальный частичный индекс;
+параллельная покупка с другим ключом ловит на нём UniqueViolation, и запрос
+повторяется с новым снимком — побеждает последняя покупка, как и раньше.
+"""
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
+
+import lazy
+
+errors = lazy.module('psycopg2.errors')
+
+
+PURCHASE_RETRIES = int(os.environ.get('PURCHASE_RETRIES', '3'))
+MAX_KEY_LENGTH = 255
+PERIOD = timedelta(hours=24)
+
+
+class KeyReused(Exception):
+    """Ключ идемпотентности уже использован для покупки с другими параметрами"""
+
+
+class Contended(Exception):
+    """Параллельные покупки пользователя не дали завершиться за PURCHASE_RETRIES попыток"""
+
+
+def _utc(value: datetime) -> datetime:
+    """TIMESTAMP без часового пояса в БД хранится в UTC"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def idempotency_key(event: dict) -> str:
+    """
+    Idempotency-Key из заголовков; без заголовка — случайный ключ, то есть
+    покупка без защиты от повтора. Бросает ValueError на слишком длинном ключе.
+    """
+    headers = event.get('headers') or {}
+    key = (headers.get('Idempotency-Key') or headers.get('idempotency-key') or '').strip()
+    if len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f'Idempotency-Key длиннее {MAX_KEY_LENGTH} символов')
+    return key or secrets.token_hex(16)
+
+
+def _create(cursor, schema: str, user_id: int, key: str, plan_type: str, character_id, start_date, end_date):
+    """(id, start_date, end_date) новой подписки или None, если ключ уже был"""
+    cursor.execute(f"""
+        WITH new_id AS (
+            SELECT nextval(pg_get_serial_sequence('{schema}.subscriptions', 'id')) AS id
+        ),
+        request AS (
+            INSERT INTO {schema}.purchase_requests
+                (user_id, idempotency_key, subscription_id, plan_type, character_id)
+            SELECT %(user_id)s, %(key)s, id, %(plan_type)s, %(character_id)s FROM new_id
+            ON CONFLICT (user_id, idempotency_key) DO NOTHING
+            RETURNING subscription_id
+        ),
+        deactivated AS (
+            UPDATE {schema}.subscriptions
+            SET is_active = FALSE
+            WHERE user_id = %(user_id)s AND is_active = TRUE AND EXISTS (SELECT 1 FROM request)
+            RETURNING id
+        ),
+        created AS (
+            -- count(*) по deactivated: вставка начинается только после того, как прежняя погашена
+            INSERT INTO {schema}.subscriptions
+                (id, user_id, plan_type, character_id, start_date, end_date, is_active)
+            SELECT request.subscription_id, %(user_id)s, %(plan_type)s, %(character_id)s,
+                   %(start_date)s, %(end_date)s, TRUE
+            FROM request, (SELECT count(*) FROM deactivated) d
+            RETURNING id, start_date, end_date
+        ),
+        entitlement AS (
+            INSERT INTO {schema}.active_entitlements
+                (user_id, subscription_id, plan_type, character_id, start_date, end_date)
+            SELECT %(user_id)s, id, %(plan_type)s, %(character_id)s, start_date, end_date FROM created
+            ON CONFLICT (user_id) DO UPDATE SET
+                subscription_id = EXCLUDED.subscription_id,
+                plan_type = EXCLUDED.plan_type,
+                character_id = EXCLUDED.character_id,
+                start_date = EXCLUDED.start_date,
+                end_date = EXCLUDED.end_date,
+                updated_at = CURRENT_TIMESTAMP
+        )
+        SELECT id, start_date, end_date FROM created
+    """, {
+        'user_id': user_id,
+        'key': key,
+        'plan_type': plan_type,
+        'character_id': character_id,
+        'start_date': start_date,
+        'end_date': end_date
+    })
+    return cursor.fetchone()
+
+
+def _original(cursor, schema: str, user_id: int, key: str):
+    cursor.execute(f"""
+        SELECT r.plan_type, r.character_id, s.id, s.start_date, s.end_date
+        FROM {schema}.purchase_requests r
+        JOIN {schema}.subscriptions s ON s.id = r.subscription_id
+        WHERE r.user_id = %s AND r.idempotency_key = %s
+    """, (user_id, key))
+    return cursor.fetchone()
+
+
+def purchase(conn, cursor, schema: str, user_id: int, plan_type: str, character_id, key: str) -> tuple:
+    """
+    (подписка, replayed): id, plan_type, character_id, start_date, end_date.
+    replayed=True — ключ уже использовался, возвращена исходная подписка без записи.
+    Бросает KeyReused, если с этим ключом покупали другой тариф,
+    и Contended, если параллельные покупки раз за разом успевали первыми.
+    Ключ, который уборщик удалил между записью и чтением исходной покупки,
+    снова свободен: попытка повторяется и создаёт новую подписку.
+    """
+    for attempt in range(PURCHASE_RETRIES):
+        start_date = datetime.now(timezone.utc)
+        try:
+            row = _create(cursor, schema, user_id, key, plan_type, character_id, start_date, start_date + PERIOD)
+        except errors.UniqueViolation as e:
+            # Параллельная покупка того же пользователя успела первой
+            conn.rollback()
+            if attempt + 1 >= PURCHASE_RETRIES:
+                raise Contended(str(e)) from e
+            continue
+
+        if row is not None:
+            conn.commit()
+            return {
+                'id': row[0],
+                'plan_type': plan_type,
+                'character_id': character_id,
+                'start_date': _utc(row[1]),
+                'end_date': _utc(row[2])
+            }, False
+
+        original = _original(cursor, schema, user_id, key)
+        conn.rollback()
+        if original is None:
+            # Ключ удалил уборщик (истёк срок) между двумя запросами: он снова свободен
+            if attempt + 1 >= PURCHASE_RETRIES:
+                raise Contended(key)
+            continue
+        if original[0] != plan_type or original[1] != character_id:
+            raise KeyReused(key)
+        return {
+            'id': original[2],
+            'plan_type': original[0],
+            'character_id': original[1],
+            'start_date': _utc(original[3]),
+            'end_date': _utc(original[4])
+        }, True
@@ -0,0 +1,181 @@
+"""
+Холодный старт функций: импорт index и первые запросы в свежем интерпретаторе.
+
+Для каждой функции и режима импорта (LAZY_IMPORTS=1 — отложенный, 0 — всё при
+загрузке) --runs раз запускает отдельный процесс python -X importtime, который
+импортирует index и вызывает обработчик на preflight (OPTIONS) и на запросе,
+отклонённом до БД и модели (нет токена, пустое сообщение). Снимает время от запуска
+процесса до первых ответов, время импорта index, задержку каждого из запросов и
+время, которое первый запрос к БД или модели потратит на отложенный импорт. Вывод
+-X importtime разбирается в самые дорогие пакеты по собственному времени импорта.
+-X importtime сам замедляет импорт: сравнивать стоит режимы и функции между собой.
+
+    python benchmarks/cold_start.py --runs 10 --functions chat,auth
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from common import ROOT
+
+
+FUNCTIONS = ('chat', 'auth', 'subscriptions', 'ai-chat')
+
+REJECTED = {
+    'chat': {'httpMethod': 'GET', 'queryStringParameters': {'action': 'history'}, 'headers': {}},
+    'auth': {'httpMethod': 'GET', 'queryStringParameters': {'action': 'verify'}, 'headers': {}},
+    'subscriptions': {'httpMethod': 'GET', 'queryStringParameters': {'action': 'get'}, 'headers': {}},
+    'ai-chat': {'httpMethod': 'POST', 'queryStringParameters': {}, 'headers': {}, 'body': '{}'}
+}
+
+MARKER = '-- cold_start: index --'
+MARKER_END = '-- cold_start: deferred --'
+
+# Выполняется в дочернем процессе из каталога функции. Первая строка stdout —
+# сразу после ответов, по ней родитель засекает время процесса до первых ответов
+CHILD = f'''
+import json, os, sys, time
+from types import SimpleNamespace
+events = json.loads(sys.argv[1])
+sys.stderr.write({MARKER!r} + "\\n")
+sys.stderr.flush()
+started = time.perf_counter()
+import index
+result = {{"import_ms": (time.perf_counter() - started) * 1000, "requests": []}}
+context = SimpleNamespace(request_id="cold-start", function_name="bench")
+for label, event in events:
+    started = time.perf_counter()
+    response = index.handler(event, context)
+    result["requests"].append([label, response["statusCode"], (time.perf_counter() - started) * 1e6])
+print(json.dumps(result), flush=True)
+sys.stderr.write({MARKER_END!r} + "\\n")
+sys.stderr.flush()
+
+# Отложенные модули функции: их импорт заплатит первый запрос к БД или модели
+import lazy
+here = os.getcwd()
+proxies = {{}}
+for module in list(sys.modules.values()):
+    if (getattr(module, "__file__", None) or "").startswith(here):
+        for value in vars(module).values():
+            if isinstance(value, lazy.LazyModule):
+                proxies[value._name] = value
+started = time.perf_counter()
+for proxy in proxies.values():
+    proxy._load()
+print(json.dumps({{"deferred_import_ms": (time.perf_counter() - started) * 1000, "deferred": sorted(proxies)}}))
+'''
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Собственное время импорта в мкс по корневым пакетам от импорта index до первых ответов"""
+    by_package = defaultdict(int)
+    started = False
+    for line in stderr.splitlines():
+        if line.strip() == MARKER:
+            started = True
+            continue
+        if line.strip() == MARKER_END:
+            break
+        if not started or not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        by_package[name.strip().split('.')[0]] += int(self_us)
+    return by_package
+
+
+def run_once(function: str, lazy: bool, env: dict) -> dict:
+    events = [
+        ['preflight', {'httpMethod': 'OPTIONS', 'headers': {}, 'queryStringParameters': {}}],
+        ['rejected', REJECTED[function]],
+        ['rejected_again', REJECTED[function]]
+    ]
+    # Вывод -X importtime — в файл: в трубе он мог бы заполнить буфер раньше первой строки stdout
+    with tempfile.TemporaryFile('w+') as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-c', CHILD, json.dumps(events)],
+            cwd=ROOT / 'backend' / function,
+            env=dict(env, LAZY_IMPORTS='1' if lazy else '0'),
+            stdout=subprocess.PIPE,
+            stderr=log,
+            text=True
+        )
+        first_line = process.stdout.readline()
+        process_ms = (time.perf_counter() - started) * 1000
+        rest = process.stdout.read()
+        process.wait(timeout=60)
+        log.seek(0)
+        stderr = log.read()
+    if process.returncode != 0:
+        raise RuntimeError(f'{function}: {stderr.strip().splitlines()[-1]}')
+    result = json.loads(first_line)
+    result.update(json.loads(rest.strip().splitlines()[-1]))
+    result['process_ms'] = process_ms
+    result['packages'] = parse_importtime(stderr)
+    return result
+
+
+def summarize(runs: list) -> dict:
+    median = lambda values: round(statistics.median(values), 3)
+    packages = defaultdict(list)
+    for run in runs:
+        for name, value in run['packages'].items():
+            packages[name].append(value)
+    heaviest = sorted(((name, statistics.median(values) / 1000) for name, values in packages.items()),
+                      key=lambda item: item[1], reverse=True)[:8]
+    summary = {
+        'process_ms': median([run['process_ms'] for run in runs]),
+        'import_ms': median([run['import_ms'] for run in runs]),
+        'deferred_import_ms': median([run['deferred_import_ms'] for run in runs]),
+        'deferred_modules': runs[0]['deferred'],
+        'heaviest_packages_ms': {name: round(ms, 3) for name, ms in heaviest}
+    }
+    for index, (label, status, _) in enumerate(runs[0]['requests']):
+        summary[f'{label}_us'] = median([run['requests'][index][2] for run in runs])
+        summary[f'{label}_status'] = status
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--functions', default=','.join(FUNCTIONS))
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    env = dict(
+        os.environ,
+        # Соединений и вызовов модели не будет: нужны только значения при импорте
+        MAIN_DB_SCHEMA='cold_start',
+        DATABASE_URL='postgresql://cold-start@127.0.0.1:1/none',
+        JWT_SECRET='cold-start-secret',
+        AITUNNEL_API_KEY='cold-start-key',
+        TRACE_LOG='0'
+    )
+    report = {'params': vars(args), 'results': []}
+    for function in [name.strip() for name in args.functions.split(',') if name.strip()]:
+        for lazy in (False, True):
+            summary = summarize([run_once(function, lazy, env) for _ in range(args.runs)])
+            summary.update(function=function, lazy_imports=lazy)
+            report['results'].append(summary)
+            print(f"{function:<14} {'lazy ' if lazy else 'eager'}  процесс {summary['process_ms']:>7} мс  "
+                  f"импорт {summary['import_ms']:>7} мс  preflight {summary['preflight_us']:>8} мкс  "
+                  f"отказ {summary['rejected_us']:>8} мкс ({summary['rejected_status']})  "
+                  f"отложено {summary['deferred_import_ms']:>7} мс")
+            print(' ' * 21 + 'дороже всего: ' + ', '.join(
+                f'{name} {ms}' for name, ms in summary['heaviest_packages_ms'].items()))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'Отчёт: {args.output}')
+
+
+if __name__ == '__main__':
+    main()
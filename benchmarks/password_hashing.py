@@ -0,0 +1,112 @@
+"""
+Подбор стоимости scrypt для backend/auth/passwords.py под бюджет задержки входа.
+
+Для каждого ln (n = 2 ** ln) при заданных r и p снимает задержку одного хеша
+в одном потоке и под нагрузкой --concurrency потоков, пропускную способность
+в хешах в секунду и пиковую память одного хеша. Рекомендует самый дорогой ln,
+у которого p95 под нагрузкой укладывается в --budget-ms, а пропускная способность
+не ниже --target-rps. Запускать на инстансе того же размера, что и функция auth.
+
+    python benchmarks/password_hashing.py --budget-ms 100 --target-rps 10 --concurrency 4
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from common import ROOT, percentiles
+
+
+def sample(log_n: int, r: int, p: int, iterations: int) -> list:
+    samples = []
+    for _ in range(iterations):
+        salt = os.urandom(16)
+        started = time.perf_counter()
+        hashlib.scrypt(b'correct horse battery staple', salt=salt, n=2 ** log_n, r=r, p=p,
+                       maxmem=256 * (2 ** log_n) * r * p, dklen=32)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def under_load(log_n: int, r: int, p: int, concurrency: int, seconds: float) -> tuple:
+    """Задержки хешей и хешей в секунду, когда concurrency потоков считают без пауз"""
+    deadline = time.perf_counter() + seconds
+    results = [[] for _ in range(concurrency)]
+
+    def worker(index):
+        while time.perf_counter() < deadline:
+            results[index].extend(sample(log_n, r, p, 1))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    samples = [value for part in results for value in part]
+    return samples, len(samples) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--min-ln', type=int, default=11)
+    parser.add_argument('--max-ln', type=int, default=17)
+    parser.add_argument('-r', type=int, default=8)
+    parser.add_argument('-p', type=int, default=1)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--budget-ms', type=float, default=100, help='p95 хеша под нагрузкой')
+    parser.add_argument('--target-rps', type=float, default=10, help='входов в секунду на инстанс')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(ROOT / 'backend' / 'auth'))
+    import passwords
+
+    started = time.perf_counter()
+    for _ in range(10000):
+        hashlib.sha256(b'correct horse battery staple').hexdigest()
+    legacy_us = (time.perf_counter() - started) / 10000 * 1e6
+
+    report = {'params': vars(args), 'legacy_sha256_us': round(legacy_us, 3), 'candidates': []}
+    recommended = None
+    for log_n in range(args.min_ln, args.max_ln + 1):
+        single = percentiles(sample(log_n, args.r, args.p, args.iterations))
+        loaded, rps = under_load(log_n, args.r, args.p, args.concurrency, args.seconds)
+        loaded = percentiles(loaded)
+        fits = loaded['p95_ms'] <= args.budget_ms and rps >= args.target_rps
+        report['candidates'].append({
+            'ln': log_n,
+            'memory_mb': round(128 * (2 ** log_n) * args.r * args.p / 2 ** 20, 1),
+            'single': single,
+            'loaded': loaded,
+            'hashes_per_second': round(rps, 1),
+            'fits': fits
+        })
+        print(f"ln={log_n:<3} {report['candidates'][-1]['memory_mb']:>6} МБ  один поток p50 {single['p50_ms']} мс  "
+              f"под нагрузкой p95 {loaded['p95_ms']} мс, {rps:.1f} хешей/с  {'подходит' if fits else ''}")
+        if fits:
+            recommended = log_n
+        elif loaded['p95_ms'] > args.budget_ms * 4:
+            break
+
+    report['recommended'] = recommended
+    report['current'] = {'ln': passwords.LOG_N, 'r': passwords.BLOCK_SIZE, 'p': passwords.PARALLELISM}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if recommended is None:
+        print('Ни один ln не укладывается в бюджет: увеличьте --budget-ms или уменьшите --target-rps')
+        sys.exit(1)
+    print(f'Рекомендация: PASSWORD_SCRYPT_LN={recommended} PASSWORD_SCRYPT_R={args.r} PASSWORD_SCRYPT_P={args.p} '
+          f'(сейчас ln={passwords.LOG_N})')
+    print(f'Отчёт: {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Точность и скорость распознавания отказа модели: прежний поиск подстрок
+(check_censorship) против скомпилированного детектора backend/ai-chat/refusal.py.
+
+По размеченному корпусу fixtures/refusals.jsonl считает precision/recall и ложные
+срабатывания, время проверки одного ответа (p50/p99, мкс) и для потокового режима —
+сколько символов ответа нужно, чтобы распознать отказ (прежде — всегда 48).
+
+    python benchmarks/refusal_detector.py --repeat 2000
+    python benchmarks/refusal_detector.py --check   # ненулевой код при ошибке на корпусе
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from common import ROOT, percentiles
+
+sys.path.insert(0, str(ROOT / 'backend' / 'ai-chat'))
+
+from refusal import RefusalDetector, is_refusal  # noqa: E402
+
+
+CORPUS = Path(__file__).resolve().parent / 'fixtures' / 'refusals.jsonl'
+
+# Прежняя проверка из ai-chat/index.py — база для сравнения
+LEGACY_KEYWORDS = [
+    'i cannot', 'i can\'t', 'я не могу', 'извините',
+    'as an ai', 'я ai', 'я искусственный',
+    'inappropriate', 'неуместно', 'неприемлемо',
+    'sorry', 'прости'
+]
+LEGACY_PREFIX_CHARS = 48
+
+
+def legacy_check(text: str) -> bool:
+    text_lower = text.lower()
+    return any(keyword in text_lower for keyword in LEGACY_KEYWORDS) or len(text.strip()) < 10
+
+
+def load_corpus(path: Path = CORPUS) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def quality(classify, corpus: list) -> dict:
+    tp = fp = fn = tn = 0
+    errors = []
+    for sample in corpus:
+        predicted = classify(sample['text'])
+        if predicted and sample['refusal']:
+            tp += 1
+        elif predicted:
+            fp += 1
+            errors.append(('ложный отказ', sample['text']))
+        elif sample['refusal']:
+            fn += 1
+            errors.append(('пропущен отказ', sample['text']))
+        else:
+            tn += 1
+    return {
+        'precision': round(tp / (tp + fp), 3) if tp + fp else 0.0,
+        'recall': round(tp / (tp + fn), 3) if tp + fn else 0.0,
+        'false_positives': fp,
+        'false_negatives': fn,
+        'errors': errors
+    }
+
+
+def latency_us(classify, corpus: list, repeat: int) -> dict:
+    texts = [sample['text'] for sample in corpus]
+    samples = []
+    for _ in range(repeat):
+        for text in texts:
+            started = time.perf_counter()
+            classify(text)
+            samples.append((time.perf_counter() - started) * 1e6)
+    # percentiles подписывает значения как мс, здесь они в мкс
+    return {name.replace('_ms', '_us'): value for name, value in percentiles(samples).items()}
+
+
+def stream_chunks(text: str) -> list:
+    """Фрагменты, похожие на поток модели: слово с пробелом"""
+    words = text.split(' ')
+    return [word + (' ' if i < len(words) - 1 else '') for i, word in enumerate(words)]
+
+
+def stream_detection(corpus: list) -> dict:
+    """Сколько символов потока прочитано до решения «отказ» и совпадает ли решение с разметкой"""
+    chars = []
+    wrong = 0
+    for sample in corpus:
+        detector = RefusalDetector()
+        verdict = None
+        for chunk in stream_chunks(sample['text']):
+            verdict = detector.feed(chunk)
+            if verdict is not None:
+                break
+        if verdict is None:
+            verdict = detector.finish()
+        if verdict != sample['refusal']:
+            wrong += 1
+        if verdict and sample['refusal'] and sample['text'].strip():
+            chars.append(detector.decided_at)
+    chars.sort()
+    return {
+        'wrong': wrong,
+        'refusal_chars_p50': chars[len(chars) // 2] if chars else None,
+        'refusal_chars_max': chars[-1] if chars else None,
+        'legacy_chars': LEGACY_PREFIX_CHARS
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', type=Path, default=CORPUS)
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--check', action='store_true', help='только проверить корпус')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    report = {}
+    for name, classify in (('legacy', legacy_check), ('compiled', is_refusal)):
+        report[name] = quality(classify, corpus)
+        if not args.check:
+            report[name]['latency_us'] = latency_us(classify, corpus, args.repeat)
+    report['compiled']['stream'] = stream_detection(corpus)
+
+    compiled = report['compiled']
+    if args.check:
+        for kind, text in compiled['errors']:
+            print(f'{kind}: {text!r}')
+        failed = compiled['errors'] or compiled['stream']['wrong']
+        print(f"{len(corpus)} образцов, ошибок: {len(compiled['errors'])}, в потоке: {compiled['stream']['wrong']}")
+        sys.exit(1 if failed else 0)
+
+    for name in ('legacy', 'compiled'):
+        report[name]['errors'] = [f'{kind}: {text}' for kind, text in report[name]['errors']]
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+ASGI-сервер (server/run.py, uvicorn) против «поток на запрос» (server/threaded.py).
+
+Поднимает заглушку LLM отдельным процессом с заданной задержкой, затем по очереди
+каждый сервер и для каждого уровня --concurrency держит столько одновременных
+HTTP-запросов выбранного сценария. Снимает пропускную способность, p50/p95/p99
+полного ответа и первого байта, коды ответов, а по /proc — пиковое число потоков
+и память всех процессов сервера.
+
+Сервер asgi_inprocess — то же приложение server/app.py, но запросы подаются в него
+вызовами ASGI из процесса бенчмарка, без HTTP и uvicorn: показывает потолок пула
+SERVER_THREADS там, где uvicorn не установлен. Время первого байта в нём — момент
+http.response.start, потоки и память — процесса бенчмарка вместе с клиентами.
+
+Сценарии: ai_chat (ответ модели целиком) и ai_chat_stream (SSE) обходятся без БД;
+verify (проверка токена по claims) раз в JWT_REVOCATION_REFRESH перечитывает
+набор отзывов, поэтому для него нужен локальный PostgreSQL (--dsn): бенчмарк
+создаёт одноразовую схему с миграциями.
+
+    python benchmarks/server.py --scenario ai_chat_stream --concurrency 50,200,500 \\
+        --llm-latency-ms 1000 --token-delay-ms 20 --workers 2
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from common import DEFAULT_DSN, ROOT, apply_migrations, connect, drop_schema, percentiles, reset_schema
+
+
+SCENARIOS = ('ai_chat', 'ai_chat_stream', 'verify')
+DB_SCENARIOS = ('verify',)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Сервер не поднялся на порту {port}')
+
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for task in Path(f'/proc/{pid}/task').glob('*/children'):
+        try:
+            children = task.read_text().split()
+        except OSError:
+            # Поток завершился между листингом и чтением
+            continue
+        for child in children:
+            pids.extend(process_tree(int(child)))
+    return pids
+
+
+def tree_usage(pid: int) -> tuple:
+    """(потоков, RSS в МБ) по процессу и всем его потомкам"""
+    threads = rss_kb = 0
+    for item in process_tree(pid):
+        try:
+            status = Path(f'/proc/{item}/status').read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith('Threads:'):
+                threads += int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss_kb += int(line.split()[1])
+    return threads, round(rss_kb / 1024, 1)
+
+
+class Sampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.max_threads = 0
+        self.max_rss_mb = 0.0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            threads, rss = tree_usage(self.pid)
+            self.max_threads = max(self.max_threads, threads)
+            self.max_rss_mb = max(self.max_rss_mb, rss)
+
+
+def request_bytes(scenario: str, port: int, token: str) -> bytes:
+    if scenario == 'verify':
+        return (f'GET /auth?action=verify HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+                f'Authorization: Bearer {token}\r\nConnection: close\r\n\r\n').encode()
+    body = json.dumps({'characterId': 1, 'message': 'Расскажи, как прошёл твой день?'}, ensure_ascii=False).encode()
+    query = '?stream=1' if scenario == 'ai_chat_stream' else ''
+    return (f'POST /ai-chat{query} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body
+
+
+async def one_request(port: int, payload: bytes) -> tuple:
+    """(статус, мс до первого байта, мс до конца ответа)"""
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(payload)
+        await writer.drain()
+        first = await reader.read(65536)
+        first_byte = (time.perf_counter() - started) * 1000
+        while await reader.read(65536):
+            pass
+    finally:
+        writer.close()
+    status = int(first.split(b' ', 2)[1]) if first.startswith(b'HTTP/') else 0
+    return status, first_byte, (time.perf_counter() - started) * 1000
+
+
+async def drive(port: int, payload: bytes, concurrency: int, duration: float) -> dict:
+    deadline = time.perf_counter() + duration
+    latencies, first_bytes, statuses = [], [], Counter()
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            try:
+                status, first_byte, total = await one_request(port, payload)
+            except OSError as e:
+                statuses[type(e).__name__] += 1
+                continue
+            statuses[status] += 1
+            latencies.append(total)
+            first_bytes.append(first_byte)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'latency': percentiles(latencies),
+        'first_byte': percentiles(first_bytes),
+        'statuses': {str(key): value for key, value in statuses.items()}
+    }
+
+
+def asgi_request(scenario: str, token: str) -> tuple:
+    """(scope, тело) того же запроса, что request_bytes, для вызова приложения напрямую"""
+    if scenario == 'verify':
+        return {'type': 'http', 'method': 'GET', 'path': '/auth', 'query_string': b'action=verify',
+                'headers': [(b'authorization', f'Bearer {token}'.encode())]}, b''
+    body = json.dumps({'characterId': 1, 'message': 'Расскажи, как прошёл твой день?'}, ensure_ascii=False).encode()
+    return {'type': 'http', 'method': 'POST', 'path': '/ai-chat',
+            'query_string': b'stream=1' if scenario == 'ai_chat_stream' else b'',
+            'headers': [(b'content-type', b'application/json')]}, body
+
+
+async def one_call(app, scope: dict, body: bytes) -> tuple:
+    """(статус, мс до http.response.start, мс до конца ответа) вызова ASGI-приложения"""
+    started = time.perf_counter()
+    finished = asyncio.Event()
+    sent_body = False
+    result = {}
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = message['status']
+            result['first_byte'] = (time.perf_counter() - started) * 1000
+        elif not message.get('more_body'):
+            finished.set()
+
+    await app(dict(scope), receive, send)
+    finished.set()
+    return result.get('status', 0), result.get('first_byte', 0.0), (time.perf_counter() - started) * 1000
+
+
+async def drive_inprocess(app, scope: dict, body: bytes, concurrency: int, duration: float) -> dict:
+    deadline = time.perf_counter() + duration
+    latencies, first_bytes, statuses = [], [], Counter()
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            status, first_byte, total = await one_call(app, scope, body)
+            statuses[status] += 1
+            latencies.append(total)
+            first_bytes.append(first_byte)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'latency': percentiles(latencies),
+        'first_byte': percentiles(first_bytes),
+        'statuses': {str(key): value for key, value in statuses.items()}
+    }
+
+
+def start_server(kind: str, port: int, workers: int, threads: int, env: dict) -> subprocess.Popen:
+    if kind == 'asgi':
+        command = [sys.executable, str(ROOT / 'server' / 'run.py'), '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(workers), '--threads', str(threads)]
+    else:
+        command = [sys.executable, str(ROOT / 'server' / 'threaded.py'), '--host', '127.0.0.1', '--port', str(port)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+_inprocess_app = None
+
+
+def run_inprocess(args, env: dict, token: str, concurrency: int) -> tuple:
+    """Прогон asgi_inprocess: приложение импортируется один раз с окружением серверов"""
+    global _inprocess_app
+    if _inprocess_app is None:
+        os.environ.update(env, SERVER_THREADS=str(args.threads))
+        sys.path.insert(0, str(ROOT / 'server'))
+        from app import app
+        _inprocess_app = app
+    scope, body = asgi_request(args.scenario, token)
+    sampler = Sampler(os.getpid())
+    sampler.start()
+    try:
+        result = asyncio.run(drive_inprocess(_inprocess_app, scope, body, concurrency, args.duration))
+    finally:
+        sampler.stopped.set()
+    result.update(server='asgi_inprocess', concurrency=concurrency,
+                  max_threads=sampler.max_threads, max_rss_mb=sampler.max_rss_mb)
+    return result, sampler
+
+
+def print_result(result: dict, sampler: Sampler) -> None:
+    print(f"{result['server']:<14} c={result['concurrency']:<5} {result['throughput_rps']:>8} rps  "
+          f"p50/p95/p99 {result['latency'].get('p50_ms')}/{result['latency'].get('p95_ms')}/"
+          f"{result['latency'].get('p99_ms')} мс  первый байт p50 {result['first_byte'].get('p50_ms')} мс  "
+          f"потоков до {sampler.max_threads}, RSS до {sampler.max_rss_mb} МБ  коды {result['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='ai_chat_stream')
+    parser.add_argument('--servers', default='asgi,threaded', help='asgi, threaded, asgi_inprocess')
+    parser.add_argument('--concurrency', default='50,200')
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='воркеров uvicorn')
+    parser.add_argument('--threads', type=int, default=64, help='SERVER_THREADS на воркер')
+    parser.add_argument('--llm-latency-ms', type=float, default=1000)
+    parser.add_argument('--token-delay-ms', type=float, default=20)
+    parser.add_argument('--dsn', default=DEFAULT_DSN)
+    parser.add_argument('--schema', default='bench_server')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    servers = [kind.strip() for kind in args.servers.split(',') if kind.strip()]
+    if 'asgi' in servers and importlib.util.find_spec('uvicorn') is None:
+        sys.exit('Для asgi нужен uvicorn: pip install -r server/requirements.txt (или --servers threaded)')
+
+    stub_port = free_port()
+    stub = subprocess.Popen([
+        sys.executable, str(ROOT / 'benchmarks' / 'stub_llm.py'), '--port', str(stub_port),
+        '--latency-ms', str(args.llm_latency_ms), '--token-delay-ms', str(args.token_delay_ms)
+    ], stdout=subprocess.DEVNULL)
+    wait_for_port(stub_port)
+
+    env = dict(
+        os.environ,
+        LLM_API_URL=f'http://127.0.0.1:{stub_port}/v1/chat/completions',
+        AITUNNEL_API_KEY='stub-key',
+        JWT_SECRET='bench-secret',
+        DATABASE_URL=args.dsn,
+        MAIN_DB_SCHEMA=args.schema,
+        TRACE_LOG='0',
+        # Кеш приветствий сделал бы ответы ai-chat мгновенными
+        REPLY_CACHE='0'
+    )
+    os.environ['JWT_SECRET'] = env['JWT_SECRET']
+    # tracing импортируется вместе с tokens и остаётся общим для asgi_inprocess
+    os.environ['TRACE_LOG'] = env['TRACE_LOG']
+    sys.path.insert(0, str(ROOT / 'backend' / 'auth'))
+    from tokens import create_jwt
+    token = create_jwt(1, 'bench@bench.local', 'Bench')
+
+    conn = None
+    if args.scenario in DB_SCENARIOS:
+        conn = connect(args.dsn)
+        reset_schema(conn, args.schema)
+        apply_migrations(conn, args.schema)
+
+    report = {'params': vars(args), 'results': []}
+    try:
+        for kind in servers:
+            for concurrency in [int(value) for value in args.concurrency.split(',')]:
+                if kind == 'asgi_inprocess':
+                    result, sampler = run_inprocess(args, env, token, concurrency)
+                    report['results'].append(result)
+                    print_result(result, sampler)
+                    continue
+                port = free_port()
+                process = start_server(kind, port, args.workers, args.threads, env)
+                sampler = Sampler(process.pid)
+                sampler.start()
+                try:
+                    result = asyncio.run(drive(port, request_bytes(args.scenario, port, token),
+                                               concurrency, args.duration))
+                finally:
+                    sampler.stopped.set()
+                    process.terminate()
+                    process.wait(timeout=30)
+                result.update(server=kind, concurrency=concurrency,
+                              max_threads=sampler.max_threads, max_rss_mb=sampler.max_rss_mb)
+                report['results'].append(result)
+                print_result(result, sampler)
+    finally:
+        stub.terminate()
+        stub.wait(timeout=30)
+        if conn is not None:
+            drop_schema(conn, args.schema)
+            conn.close()
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'Отчёт: {args.output}')
+
+
+if __name__ == '__main__':
+    main()
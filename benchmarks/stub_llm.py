@@ -0,0 +1,155 @@
+"""
+Локальная заглушка LLM-шлюза с API chat/completions (обычный ответ и stream: true).
+Задержка, доля отказов модели и доля ошибок шлюза настраиваются, чтобы проверять
+повторы, circuit breaker, fallback и гонку моделей без настоящего шлюза.
+
+    python benchmarks/stub_llm.py --port 8900 --latency-ms 300 --refusal-rate 0.1 --error-rate 0.05
+    LLM_API_URL=http://127.0.0.1:8900/v1/chat/completions ...
+
+GET /stats — счётчики запросов по моделям и исходам.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+REPLY_TEXT = 'Привет, мой хороший 😘 Я так ждала, когда ты напишешь... Расскажи, о чём ты сейчас думаешь? 🔥'
+REFUSAL_TEXT = 'Извините, я не могу продолжать этот разговор.'
+
+
+class StubConfig:
+    def __init__(self, latency_ms: float = 200, token_delay_ms: float = 20, refusal_rate: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503, model_latency_ms: dict = None,
+                 model_refusal_rate: dict = None):
+        self.latency_ms = latency_ms
+        self.token_delay_ms = token_delay_ms
+        self.refusal_rate = refusal_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.model_latency_ms = model_latency_ms or {}
+        self.model_refusal_rate = model_refusal_rate or {}
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] += 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config: StubConfig = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, data: dict, headers: dict = None) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: str) -> None:
+        payload = data.encode()
+        self.wfile.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        with self.config.lock:
+            stats = dict(self.config.stats)
+        self._send_json(200, stats)
+
+    def do_POST(self):
+        config = self.config
+        length = int(self.headers.get('Content-Length', '0'))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        model = request.get('model', 'unknown')
+        config.count(f'{model}:requests')
+
+        time.sleep(config.model_latency_ms.get(model, config.latency_ms) / 1000)
+
+        if random.random() < config.error_rate:
+            config.count(f'{model}:errors')
+            self._send_json(config.error_status, {'error': {'message': 'stub gateway error'}}, {'Retry-After': '0'})
+            return
+
+        refusal_rate = config.model_refusal_rate.get(model, config.refusal_rate)
+        refused = random.random() < refusal_rate
+        config.count(f'{model}:refusals' if refused else f'{model}:replies')
+        text = REFUSAL_TEXT if refused else REPLY_TEXT
+
+        if not request.get('stream'):
+            self._send_json(200, {
+                'model': model,
+                'choices': [{'message': {'role': 'assistant', 'content': text}}],
+                'usage': {'completion_tokens': len(text.split())}
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for word in text.split(' '):
+                time.sleep(config.token_delay_ms / 1000)
+                chunk = {'choices': [{'delta': {'content': word + ' '}}]}
+                self._chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+            self._chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент отменил запрос (проигравшая сторона гонки моделей)
+            config.count(f'{model}:cancelled')
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Очередь accept по умолчанию (5) не выдерживает сотни одновременных запросов бенчмарка
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение посреди ответа или keep-alive — это не ошибка сервера
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+def serve(host: str = '127.0.0.1', port: int = 0, config: StubConfig = None) -> ThreadingHTTPServer:
+    """Запустить заглушку в фоновом потоке; адрес — server.server_address"""
+    handler = type('BoundStubHandler', (StubHandler,), {'config': config or StubConfig()})
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='stub-llm', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--token-delay-ms', type=float, default=20)
+    parser.add_argument('--refusal-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.token_delay_ms, args.refusal_rate, args.error_rate, args.error_status)
+    server = serve(args.host, args.port, config)
+    print(f'Заглушка LLM: http://{args.host}:{server.server_address[1]}/v1/chat/completions')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
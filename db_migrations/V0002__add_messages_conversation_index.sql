@@ -0,0 +1,6 @@
+-- Составной индекс по диалогу: последние N реплик пары (user_id, character_id)
+-- и догрузка новых сообщений по id читаются одним диапазонным сканом индекса
+CREATE INDEX IF NOT EXISTS idx_messages_user_character_id ON t_p13393071_ai_romance_platform.messages(user_id, character_id, id);
+
+-- Одиночный индекс по user_id покрывается префиксом составного
+DROP INDEX IF EXISTS t_p13393071_ai_romance_platform.idx_messages_user_id;
@@ -0,0 +1,2 @@
+-- История по всем персонажам листается по id внутри пользователя
+CREATE INDEX IF NOT EXISTS idx_messages_user_id_id ON t_p13393071_ai_romance_platform.messages(user_id, id);
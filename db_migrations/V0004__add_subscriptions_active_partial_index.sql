@@ -0,0 +1,11 @@
+-- Частичный покрывающий индекс под запрос активной подписки:
+-- WHERE user_id = ? AND is_active = TRUE AND end_date > now() ORDER BY created_at DESC LIMIT 1.
+-- end_date не входит в предикат (now() не immutable), поэтому лежит в INCLUDE
+-- и проверяется прямо в индексе без обращения к таблице.
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active_latest
+    ON t_p13393071_ai_romance_platform.subscriptions(user_id, created_at DESC)
+    INCLUDE (id, plan_type, character_id, start_date, end_date)
+    WHERE is_active = TRUE;
+
+-- Индекс по булевому is_active не селективен и планировщиком не используется
+DROP INDEX IF EXISTS t_p13393071_ai_romance_platform.idx_subscriptions_active;
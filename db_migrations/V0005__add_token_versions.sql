@@ -0,0 +1,11 @@
+-- Версия токенов пользователя: токены с ver меньше текущей считаются отозванными
+ALTER TABLE t_p13393071_ai_romance_platform.users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0;
+
+-- Компактный набор отзывов, который функции периодически перечитывают целиком
+CREATE TABLE IF NOT EXISTS t_p13393071_ai_romance_platform.token_revocations (
+    user_id INTEGER PRIMARY KEY REFERENCES t_p13393071_ai_romance_platform.users(id),
+    token_version INTEGER NOT NULL,
+    revoked_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_token_revocations_revoked_at ON t_p13393071_ai_romance_platform.token_revocations(revoked_at);
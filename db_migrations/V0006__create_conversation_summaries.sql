@@ -0,0 +1,11 @@
+-- Скользящее краткое содержание долгого диалога: в промпт идёт оно и последние реплики.
+-- last_message_id — контрольная точка: реплики с id до неё включительно уже свёрнуты в summary
+CREATE TABLE IF NOT EXISTS t_p13393071_ai_romance_platform.conversation_summaries (
+    user_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.users(id),
+    character_id INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    last_message_id BIGINT NOT NULL,
+    summarized_turns INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, character_id)
+);
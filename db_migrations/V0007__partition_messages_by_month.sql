@@ -0,0 +1,100 @@
+-- messages секционируется по месяцам поля timestamp, id становится BIGINT.
+-- Старые месяцы отцепляются и выгружаются в архив целиком (jobs/messages_retention.py),
+-- а индексы каждой секции остаются размером в один месяц.
+-- Существующая таблица переименовывается, её строки переносятся в секции, после чего она удаляется.
+-- Повторный запуск миграции ничего не делает.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 't_p13393071_ai_romance_platform' AND c.relname = 'messages' AND c.relkind = 'p'
+    ) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE t_p13393071_ai_romance_platform.messages RENAME TO messages_unpartitioned;
+    ALTER INDEX t_p13393071_ai_romance_platform.messages_pkey RENAME TO messages_unpartitioned_pkey;
+    -- Последовательность переживает удаление старой таблицы и продолжает нумерацию уже как BIGINT
+    ALTER SEQUENCE t_p13393071_ai_romance_platform.messages_id_seq OWNED BY NONE;
+    ALTER SEQUENCE t_p13393071_ai_romance_platform.messages_id_seq AS BIGINT;
+
+    CREATE TABLE t_p13393071_ai_romance_platform.messages (
+        id BIGINT NOT NULL DEFAULT nextval('t_p13393071_ai_romance_platform.messages_id_seq'),
+        user_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.users(id),
+        character_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        sender VARCHAR(10) NOT NULL CHECK (sender IN ('user', 'ai')),
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+
+    -- Страховка: строка с датой вне созданных месяцев не роняет INSERT
+    CREATE TABLE t_p13393071_ai_romance_platform.messages_default
+        PARTITION OF t_p13393071_ai_romance_platform.messages DEFAULT;
+END $$;
+
+-- Секции messages_pYYYYMM от start_month до текущего месяца плюс months_ahead.
+-- Строки нового месяца, уже попавшие в messages_default, переносятся в его секцию.
+CREATE OR REPLACE FUNCTION t_p13393071_ai_romance_platform.ensure_messages_partitions(
+    start_month DATE,
+    months_ahead INTEGER DEFAULT 2
+) RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    month_start DATE := date_trunc('month', start_month)::date;
+    last_month DATE := (date_trunc('month', now()) + make_interval(months => months_ahead))::date;
+    month_end DATE;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        month_end := (month_start + interval '1 month')::date;
+        partition_name := 'messages_p' || to_char(month_start, 'YYYYMM');
+        IF to_regclass('t_p13393071_ai_romance_platform.' || partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE t_p13393071_ai_romance_platform.%I '
+                '(LIKE t_p13393071_ai_romance_platform.messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                partition_name);
+            EXECUTE format(
+                'WITH moved AS ('
+                '    DELETE FROM t_p13393071_ai_romance_platform.messages_default'
+                '    WHERE timestamp >= %L AND timestamp < %L RETURNING *'
+                ') INSERT INTO t_p13393071_ai_romance_platform.%I SELECT * FROM moved',
+                month_start, month_end, partition_name);
+            EXECUTE format(
+                'ALTER TABLE t_p13393071_ai_romance_platform.messages '
+                'ATTACH PARTITION t_p13393071_ai_romance_platform.%I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end);
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END $$;
+
+DO $$
+BEGIN
+    IF to_regclass('t_p13393071_ai_romance_platform.messages_unpartitioned') IS NULL THEN
+        RETURN;
+    END IF;
+
+    PERFORM t_p13393071_ai_romance_platform.ensure_messages_partitions(
+        COALESCE((SELECT min(timestamp) FROM t_p13393071_ai_romance_platform.messages_unpartitioned), now())::date
+    );
+
+    INSERT INTO t_p13393071_ai_romance_platform.messages (id, user_id, character_id, text, sender, timestamp)
+    SELECT id, user_id, character_id, text, sender, COALESCE(timestamp, CURRENT_TIMESTAMP)
+    FROM t_p13393071_ai_romance_platform.messages_unpartitioned;
+
+    DROP TABLE t_p13393071_ai_romance_platform.messages_unpartitioned;
+END $$;
+
+ALTER SEQUENCE t_p13393071_ai_romance_platform.messages_id_seq OWNED BY t_p13393071_ai_romance_platform.messages.id;
+
+-- Индексы на секционированной таблице создаются в каждой секции, в том числе в будущих.
+-- Строятся после переноса строк: так быстрее, чем обновлять их на каждой вставке
+CREATE INDEX IF NOT EXISTS idx_messages_user_character_id ON t_p13393071_ai_romance_platform.messages(user_id, character_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_user_id_id ON t_p13393071_ai_romance_platform.messages(user_id, id);
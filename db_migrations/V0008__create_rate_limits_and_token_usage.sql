@@ -0,0 +1,24 @@
+-- Скользящее окно отправки сообщений в chat: одна строка на пользователя и тариф.
+-- window_start — начало текущего окна в секундах эпохи; оценка числа запросов за последние
+-- N секунд — previous_count * (доля прошлого окна) + current_count.
+-- Строка только обновляется на месте, поэтому fillfactor оставляет место для HOT-обновлений
+CREATE TABLE IF NOT EXISTS t_p13393071_ai_romance_platform.rate_limits (
+    user_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.users(id),
+    plan_type VARCHAR(20) NOT NULL,
+    window_start BIGINT NOT NULL,
+    current_count INTEGER NOT NULL DEFAULT 0,
+    previous_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, plan_type)
+) WITH (fillfactor = 70);
+
+-- Сгенерированные моделью токены за период подписки (до end_date)
+CREATE TABLE IF NOT EXISTS t_p13393071_ai_romance_platform.token_usage (
+    subscription_id INTEGER PRIMARY KEY REFERENCES t_p13393071_ai_romance_platform.subscriptions(id),
+    user_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.users(id),
+    generated_tokens BIGINT NOT NULL DEFAULT 0,
+    replies INTEGER NOT NULL DEFAULT 0,
+    period_end TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) WITH (fillfactor = 70);
+
+CREATE INDEX IF NOT EXISTS idx_token_usage_user_id ON t_p13393071_ai_romance_platform.token_usage(user_id);
@@ -0,0 +1,30 @@
+-- Действующее право пользователя: одна строка на пользователя, чтение по первичному ключу.
+-- Пишется покупкой в subscriptions в той же транзакции, что и сама подписка;
+-- истёкшие строки удаляет jobs/subscription_sweeper.py
+CREATE TABLE IF NOT EXISTS t_p13393071_ai_romance_platform.active_entitlements (
+    user_id INTEGER PRIMARY KEY REFERENCES t_p13393071_ai_romance_platform.users(id),
+    subscription_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.subscriptions(id),
+    plan_type VARCHAR(20) NOT NULL,
+    character_id INTEGER,
+    start_date TIMESTAMP NOT NULL,
+    end_date TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_active_entitlements_end_date
+    ON t_p13393071_ai_romance_platform.active_entitlements(end_date);
+
+-- Заполнение из подписок, ещё не истёкших на момент миграции
+INSERT INTO t_p13393071_ai_romance_platform.active_entitlements
+    (user_id, subscription_id, plan_type, character_id, start_date, end_date)
+SELECT DISTINCT ON (user_id) user_id, id, plan_type, character_id, start_date, end_date
+FROM t_p13393071_ai_romance_platform.subscriptions
+WHERE is_active = TRUE AND end_date > (now() AT TIME ZONE 'UTC')
+ORDER BY user_id, created_at DESC
+ON CONFLICT (user_id) DO NOTHING;
+
+-- Истёкшие подписки ищутся по end_date среди активных. Пока уборщик их гасит,
+-- частичный индекс содержит только действующие подписки и остаётся маленьким
+CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end_date
+    ON t_p13393071_ai_romance_platform.subscriptions(end_date)
+    WHERE is_active = TRUE;
@@ -0,0 +1,31 @@
+-- Гонки прежней покупки (UPDATE и INSERT отдельными запросами) могли оставить
+-- пользователю несколько активных подписок: активной остаётся только последняя
+UPDATE t_p13393071_ai_romance_platform.subscriptions s
+SET is_active = FALSE
+WHERE s.is_active = TRUE AND EXISTS (
+    SELECT 1
+    FROM t_p13393071_ai_romance_platform.subscriptions newer
+    WHERE newer.user_id = s.user_id AND newer.is_active = TRUE
+      AND (newer.created_at, newer.id) > (s.created_at, s.id)
+);
+
+-- Не больше одной активной подписки на пользователя: параллельная покупка получает
+-- нарушение уникальности и повторяется (backend/subscriptions/purchases.py)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_one_active_per_user
+    ON t_p13393071_ai_romance_platform.subscriptions(user_id)
+    WHERE is_active = TRUE;
+
+-- Ключи идемпотентности покупок: повтор с тем же Idempotency-Key получает исходную подписку.
+-- Старше суток удаляет jobs/subscription_sweeper.py
+CREATE TABLE IF NOT EXISTS t_p13393071_ai_romance_platform.purchase_requests (
+    user_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.users(id),
+    idempotency_key VARCHAR(255) NOT NULL,
+    subscription_id INTEGER NOT NULL REFERENCES t_p13393071_ai_romance_platform.subscriptions(id),
+    plan_type VARCHAR(20) NOT NULL,
+    character_id INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_purchase_requests_created_at
+    ON t_p13393071_ai_romance_platform.purchase_requests(created_at);
@@ -0,0 +1,158 @@
+"""
+Ретеншн секционированной messages (миграция V0007): запускается по расписанию, раз в сутки.
+
+1. Создаёт секции на ближайшие месяцы (ensure_messages_partitions), чтобы вставки
+   не уходили в messages_default.
+2. Месячные секции старше --keep-months отцепляет от messages (DETACH PARTITION),
+   выгружает через COPY в gzip-файл <archive-dir>/<schema>/messages_pYYYYMM.csv.gz,
+   сверяет число строк в файле с таблицей, пишет рядом манифест .json
+   и только после этого удаляет таблицу.
+
+Секция, отцепленная прошлым запуском, но не выгруженная (упал на COPY), подбирается заново.
+Краткое содержание диалогов (conversation_summaries) не удаляется: память персонажа
+о давних разговорах остаётся и после удаления самих реплик.
+
+    DATABASE_URL=postgresql://... python jobs/messages_retention.py --keep-months 12 --archive-dir /var/backups/messages
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import psycopg2
+
+
+PRODUCTION_SCHEMA = 't_p13393071_ai_romance_platform'
+PARTITION_NAME = re.compile(r'^messages_p(\d{4})(\d{2})$')
+
+
+def month_index(year: int, month: int) -> int:
+    return year * 12 + month - 1
+
+
+def partitions(cursor, schema: str) -> list:
+    """Месячные секции схемы: [(name, первый день месяца, attached), ...] по возрастанию"""
+    cursor.execute("""
+        SELECT c.relname, i.inhparent IS NOT NULL
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+        WHERE n.nspname = %s AND c.relkind = 'r' AND c.relname ~ '^messages_p[0-9]{6}$'
+        ORDER BY c.relname
+    """, (schema,))
+    result = []
+    for name, attached in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        result.append((name, date(int(match.group(1)), int(match.group(2)), 1), attached))
+    return result
+
+
+def expired(items: list, keep_months: int, today: date) -> list:
+    """Секции, целиком старше keep_months полных месяцев до текущего"""
+    cutoff = month_index(today.year, today.month) - keep_months
+    return [item for item in items if month_index(item[1].year, item[1].month) < cutoff]
+
+
+def export(conn, schema: str, name: str, target: Path) -> dict:
+    """COPY секции в gzip-файл; файл появляется под итоговым именем, только если выгрузка целая"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(target.name + '.tmp')
+    with conn.cursor() as cursor:
+        cursor.execute(f'SELECT count(*) FROM {schema}.{name}')
+        rows = cursor.fetchone()[0]
+        with gzip.open(tmp, 'wb', compresslevel=6) as f:
+            cursor.copy_expert(
+                f'COPY (SELECT id, user_id, character_id, text, sender, timestamp '
+                f'FROM {schema}.{name} ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)',
+                f
+            )
+
+    # Сверка: перечитываем архив CSV-парсером (в тексте сообщений бывают переводы строк)
+    digest = hashlib.sha256()
+    with open(tmp, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    with gzip.open(tmp, 'rt', encoding='utf-8', newline='') as f:
+        archived = sum(1 for _ in csv.reader(f)) - 1
+    if archived != rows:
+        tmp.unlink()
+        raise RuntimeError(f'{name}: в архиве {archived} строк, в таблице {rows}')
+
+    os.replace(tmp, target)
+    manifest = {
+        'partition': f'{schema}.{name}',
+        'rows': rows,
+        'file': target.name,
+        'bytes': target.stat().st_size,
+        'sha256': digest.hexdigest(),
+        'exported_at': datetime.now(timezone.utc).isoformat()
+    }
+    with open(target.with_name(name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--schema', default=PRODUCTION_SCHEMA)
+    parser.add_argument('--keep-months', type=int, default=12, help='сколько полных месяцев хранить в БД')
+    parser.add_argument('--months-ahead', type=int, default=2, help='на сколько месяцев вперёд создавать секции')
+    parser.add_argument('--archive-dir', type=Path, default=Path('archive'))
+    parser.add_argument('--keep-detached', action='store_true', help='не удалять выгруженные секции')
+    parser.add_argument('--dry-run', action='store_true', help='только показать, что будет сделано')
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error('нужен --dsn или DATABASE_URL')
+
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    schema = args.schema
+    today = datetime.now(timezone.utc).date()
+    report = {'created': 0, 'archived': [], 'default_rows': 0}
+    try:
+        with conn.cursor() as cursor:
+            if not args.dry_run:
+                cursor.execute(f'SELECT {schema}.ensure_messages_partitions(%s, %s)',
+                               (today.replace(day=1), args.months_ahead))
+                report['created'] = cursor.fetchone()[0]
+            # Строки в messages_default — признак, что секции вовремя не создавались
+            cursor.execute(f'SELECT count(*) FROM {schema}.messages_default')
+            report['default_rows'] = cursor.fetchone()[0]
+            old = expired(partitions(cursor, schema), args.keep_months, today)
+
+        for name, month, attached in old:
+            if args.dry_run:
+                report['archived'].append({'partition': name, 'attached': attached, 'dry_run': True})
+                continue
+            target = args.archive_dir / schema / f'{name}.csv.gz'
+            if not attached and target.with_name(name + '.json').exists():
+                # Уже выгружена прошлым запуском с --keep-detached
+                if not args.keep_detached:
+                    with conn.cursor() as cursor:
+                        cursor.execute(f'DROP TABLE {schema}.{name}')
+                continue
+            if attached:
+                with conn.cursor() as cursor:
+                    cursor.execute(f'ALTER TABLE {schema}.messages DETACH PARTITION {schema}.{name}')
+            manifest = export(conn, schema, name, target)
+            if not args.keep_detached:
+                with conn.cursor() as cursor:
+                    cursor.execute(f'DROP TABLE {schema}.{name}')
+            manifest['dropped'] = not args.keep_detached
+            report['archived'].append(manifest)
+    finally:
+        conn.close()
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Уборка истёкших подписок (миграция V0009): запускается по расписанию, раз в несколько минут.
+
+1. Гасит подписки с прошедшим end_date (is_active = FALSE) порциями по --chunk-size,
+   каждая порция — отдельная короткая транзакция. Строки, занятые покупкой, пропускаются
+   (SKIP LOCKED) и достаются следующему запуску.
+2. Удаляет из active_entitlements строки с прошедшим end_date теми же порциями.
+3. Досоздаёт строки active_entitlements для действующих подписок, у пользователя которых
+   строки нет, — например, купленных старой версией функции до выкладки.
+4. Удаляет ключи идемпотентности покупок (purchase_requests, V0010) старше
+   --idempotency-ttl-hours: повтор покупки позже этого срока — уже новая покупка.
+   В схеме без V0010 шаг пропускается.
+
+Между порциями — пауза --pause-ms, общее число порций за запуск ограничено --max-chunks:
+уборка после долгого простоя растягивается на несколько запусков, а не держит
+БД одной длинной транзакцией.
+
+    DATABASE_URL=postgresql://... python jobs/subscription_sweeper.py --chunk-size 5000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+
+PRODUCTION_SCHEMA = 't_p13393071_ai_romance_platform'
+
+
+def deactivate_expired(cursor, schema: str, now: datetime, limit: int) -> int:
+    """Погасить до limit истёкших подписок; число погашенных"""
+    cursor.execute(f"""
+        WITH expired AS (
+            SELECT id
+            FROM {schema}.subscriptions
+            WHERE is_active = TRUE AND end_date <= %s
+            ORDER BY end_date
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE {schema}.subscriptions s
+        SET is_active = FALSE
+        FROM expired
+        WHERE s.id = expired.id
+    """, (now, limit))
+    return cursor.rowcount
+
+
+def drop_expired_entitlements(cursor, schema: str, now: datetime, limit: int) -> int:
+    """
+    Удалить до limit истёкших строк active_entitlements. Условие по end_date повторено
+    снаружи: строку, которую покупка продлила после выборки, DELETE перепроверит и оставит.
+    """
+    cursor.execute(f"""
+        DELETE FROM {schema}.active_entitlements
+        WHERE end_date <= %s AND user_id IN (
+            SELECT user_id
+            FROM {schema}.active_entitlements
+            WHERE end_date <= %s
+            ORDER BY end_date
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    """, (now, now, limit))
+    return cursor.rowcount
+
+
+def restore_missing_entitlements(cursor, schema: str, now: datetime) -> int:
+    """Строки active_entitlements для действующих подписок пользователей без строки"""
+    cursor.execute(f"""
+        INSERT INTO {schema}.active_entitlements
+            (user_id, subscription_id, plan_type, character_id, start_date, end_date)
+        SELECT DISTINCT ON (s.user_id) s.user_id, s.id, s.plan_type, s.character_id, s.start_date, s.end_date
+        FROM {schema}.subscriptions s
+        WHERE s.is_active = TRUE AND s.end_date > %s
+          AND NOT EXISTS (SELECT 1 FROM {schema}.active_entitlements e WHERE e.user_id = s.user_id)
+        ORDER BY s.user_id, s.created_at DESC
+        ON CONFLICT (user_id) DO NOTHING
+    """, (now,))
+    return cursor.rowcount
+
+
+def drop_old_purchase_requests(cursor, schema: str, before: datetime, limit: int) -> int:
+    """Удалить до limit ключей идемпотентности, созданных раньше before"""
+    cursor.execute(f"""
+        DELETE FROM {schema}.purchase_requests
+        WHERE (user_id, idempotency_key) IN (
+            SELECT user_id, idempotency_key
+            FROM {schema}.purchase_requests
+            WHERE created_at < %s
+            ORDER BY created_at
+            LIMIT %s
+        )
+    """, (before, limit))
+    return cursor.rowcount
+
+
+def has_table(cursor, schema: str, table: str) -> bool:
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (f'{schema}.{table}',))
+    return cursor.fetchone()[0]
+
+
+def in_chunks(conn, step, chunk_size: int, max_chunks: int, pause: float) -> dict:
+    """Повторять step(cursor, limit) отдельными транзакциями, пока порции полные"""
+    total = chunks = 0
+    slowest_ms = 0.0
+    while chunks < max_chunks:
+        started = time.perf_counter()
+        with conn.cursor() as cursor:
+            done = step(cursor, chunk_size)
+        conn.commit()
+        slowest_ms = max(slowest_ms, (time.perf_counter() - started) * 1000)
+        total += done
+        chunks += 1
+        if done < chunk_size:
+            break
+        time.sleep(pause)
+    return {'rows': total, 'chunks': chunks, 'slowest_chunk_ms': round(slowest_ms, 3),
+            'exhausted': chunks >= max_chunks}
+
+
+def sweep(conn, schema: str, chunk_size: int = 5000, max_chunks: int = 200, pause: float = 0.05,
+          now: datetime = None, idempotency_ttl: timedelta = timedelta(hours=24)) -> dict:
+    """Все шаги уборки; conn без autocommit"""
+    now = now or datetime.now(timezone.utc)
+    report = {'now': now.isoformat()}
+    report['subscriptions'] = in_chunks(
+        conn, lambda cursor, limit: deactivate_expired(cursor, schema, now, limit), chunk_size, max_chunks, pause
+    )
+    report['entitlements'] = in_chunks(
+        conn, lambda cursor, limit: drop_expired_entitlements(cursor, schema, now, limit), chunk_size, max_chunks, pause
+    )
+    with conn.cursor() as cursor:
+        report['restored_entitlements'] = restore_missing_entitlements(cursor, schema, now)
+        purchase_requests = has_table(cursor, schema, 'purchase_requests')
+    conn.commit()
+    if purchase_requests:
+        report['purchase_requests'] = in_chunks(
+            conn, lambda cursor, limit: drop_old_purchase_requests(cursor, schema, now - idempotency_ttl, limit),
+            chunk_size, max_chunks, pause
+        )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--schema', default=PRODUCTION_SCHEMA)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--max-chunks', type=int, default=200, help='порций на каждый шаг за запуск')
+    parser.add_argument('--pause-ms', type=float, default=50, help='пауза между порциями')
+    parser.add_argument('--idempotency-ttl-hours', type=float, default=24)
+    parser.add_argument('--dry-run', action='store_true', help='только посчитать, что будет убрано')
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error('нужен --dsn или DATABASE_URL')
+
+    conn = psycopg2.connect(args.dsn)
+    schema = args.schema
+    try:
+        if args.dry_run:
+            now = datetime.now(timezone.utc)
+            with conn.cursor() as cursor:
+                cursor.execute(f"""
+                    SELECT
+                        (SELECT count(*) FROM {schema}.subscriptions WHERE is_active = TRUE AND end_date <= %s),
+                        (SELECT count(*) FROM {schema}.active_entitlements WHERE end_date <= %s)
+                """, (now, now))
+                subscriptions, entitlements = cursor.fetchone()
+            conn.rollback()
+            report = {'now': now.isoformat(), 'dry_run': True,
+                      'expired_subscriptions': subscriptions, 'expired_entitlements': entitlements}
+        else:
+            report = sweep(conn, schema, args.chunk_size, args.max_chunks, args.pause_ms / 1000,
+                           idempotency_ttl=timedelta(hours=args.idempotency_ttl_hours))
+    finally:
+        conn.close()
+
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
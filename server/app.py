@@ -0,0 +1,228 @@
+"""
+ASGI-приложение, в котором живут все функции из backend/func2url.json:
+POST /chat?action=send, GET /auth?action=verify и т.д. — тот же контракт,
+что у облачных функций, только адрес функции — путь /<name>.
+
+HTTP-запрос превращается в event облачной функции, ответ обработчика — обратно
+в HTTP; тело с isBase64Encoded декодируется. Вызывается stream_handler функции
+(chat, ai-chat), так что при stream=1 SSE уходит клиенту по фрагментам по мере
+генерации. Соединения клиентов, keep-alive и медленные читатели живут на event
+loop. Каждый воркер uvicorn (server/run.py) — отдельный процесс со своими пулами
+соединений.
+
+Обработчики остаются синхронными (psycopg2, requests) и выполняются в пуле из
+SERVER_THREADS потоков: запрос к модели, включая ожидание каждого фрагмента
+потока, держит поток пула. Одновременных вызовов модели на воркер не больше
+SERVER_THREADS, остальные запросы ждут в очереди пула. То есть сотни вызовов
+модели в полёте без потока на каждый — цель асинхронных клиентов БД и LLM —
+этим сервером не достигнута; по сравнению с server/threaded.py он ограничивает
+число потоков, а не снимает зависимость «вызов модели — поток». Замер
+benchmarks/server.py (ai_chat_stream, модель 1 с, один воркер) это подтверждает:
+при 200 одновременных запросах 64 потока дают вдвое меньшую пропускную способность
+и вчетверо больший p99, чем threaded, а SERVER_THREADS=256 догоняет threaded ценой
+того же числа потоков. SERVER_THREADS поэтому задаётся не меньше ожидаемого числа
+одновременных вызовов модели на воркер; переход на асинхронные клиенты отложен.
+
+GET /_health — список функций и метрики пулов соединений с БД.
+"""
+import asyncio
+import base64
+import json
+import os
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from functions import function_names, load_function  # noqa: E402
+
+
+THREADS = int(os.environ.get('SERVER_THREADS', '64'))
+MAX_BODY_BYTES = int(os.environ.get('SERVER_MAX_BODY_BYTES', str(1024 * 1024)))
+# В одном процессе запросов к функции больше, чем в контейнере облака: пулы крупнее
+os.environ.setdefault('DB_POOL_MAX_SIZE', '10')
+os.environ.setdefault('LLM_POOL_SIZE', str(THREADS))
+# hedged и race в ai-chat держат по потоку на модель цепочки: пул диспетчера — два на поток обработчика
+os.environ.setdefault('LLM_DISPATCH_WORKERS', str(2 * THREADS))
+os.environ.setdefault('CHAT_WRITE_MODE', 'buffered')
+# Процесс не замораживается после ответа: краткое содержание диалога — в фоновом потоке
+os.environ.setdefault('CHAT_SUMMARY_MODE', 'background')
+# Процесс живёт долго: psycopg2 и requests грузим при старте, а не в первом запросе
+os.environ.setdefault('LAZY_IMPORTS', '0')
+
+
+def build_event(method: str, path: str, query_string: str, headers: dict, body: bytes) -> dict:
+    """event облачной функции из HTTP-запроса; бинарное тело — в base64"""
+    try:
+        text, encoded = body.decode('utf-8'), False
+    except UnicodeDecodeError:
+        text, encoded = base64.b64encode(body).decode(), True
+    return {
+        'httpMethod': method,
+        'path': path,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(query_string, keep_blank_values=True)),
+        'body': text,
+        'isBase64Encoded': encoded
+    }
+
+
+def response_parts(response: dict) -> tuple:
+    """(статус, заголовки, тело) ответа обработчика; тело — bytes или итератор строк"""
+    status = int(response.get('statusCode', 200))
+    headers = {str(key): str(value) for key, value in (response.get('headers') or {}).items()}
+    body = response.get('body')
+    if body is None:
+        body = b''
+    elif isinstance(body, str):
+        body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+    return status, headers, body
+
+
+def context_for(name: str, headers: dict) -> SimpleNamespace:
+    return SimpleNamespace(
+        request_id=headers.get('x-request-id') or uuid.uuid4().hex,
+        function_name=name
+    )
+
+
+def route(path: str) -> str:
+    """Имя функции по пути: /chat, /chat/, /api/chat"""
+    parts = [part for part in path.split('/') if part]
+    return parts[-1] if parts else ''
+
+
+class App:
+    def __init__(self, names: list = None, threads: int = THREADS):
+        self.functions = {name: load_function(name) for name in (names or function_names())}
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='handler')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        if path == '/_health':
+            await self._json(send, 200, self.health())
+            return
+        function = self.functions.get(route(path))
+        if function is None:
+            await self._json(send, 404, {'error': f'Нет функции {path}'})
+            return
+
+        body = await self._read_body(receive)
+        if body is None:
+            await self._json(send, 413, {'error': 'Слишком большое тело запроса'})
+            return
+
+        headers = {}
+        for key, value in scope['headers']:
+            headers[key.decode('latin-1')] = value.decode('latin-1')
+        event = build_event(scope['method'], path, scope['query_string'].decode('latin-1'), headers, body)
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(
+                self.executor, function.stream_handler, event, context_for(function.name, headers)
+            )
+            status, response_headers, response_body = response_parts(response)
+        except Exception as e:
+            await self._json(send, 500, {'error': f'Ошибка сервера: {str(e)}'})
+            return
+
+        raw_headers = [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                       for key, value in response_headers.items()]
+        if isinstance(response_body, bytes):
+            raw_headers.append((b'content-length', str(len(response_body)).encode()))
+            await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+            await send({'type': 'http.response.body', 'body': response_body})
+            return
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        await self._stream(loop, receive, send, response_body)
+
+    async def _stream(self, loop, receive, send, body) -> None:
+        """
+        Фрагменты генератора берутся в пуле потоков, отправляются с event loop.
+        Когда клиент уходит, генератор закрывается: модель больше не читается,
+        chat сохраняет ход с тем, что успело сгенерироваться. Первый фрагмент
+        запрашивается всегда — до него тело генератора не выполнялось и закрывать нечего.
+        """
+        iterator = iter(body)
+        done = object()
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch())
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, done)
+                if chunk is done or disconnected.is_set():
+                    break
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk.encode('utf-8') if isinstance(chunk, str) else chunk,
+                    'more_body': True
+                })
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            watcher.cancel()
+            close = getattr(iterator, 'close', None)
+            if close:
+                await loop.run_in_executor(self.executor, close)
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return b''.join(chunks)
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    @staticmethod
+    async def _json(send, status: int, data: dict) -> None:
+        body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'access-control-allow-origin', b'*'),
+            (b'content-length', str(len(body)).encode())
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def health(self) -> dict:
+        pools = {}
+        for name, function in self.functions.items():
+            db = function.module('db')
+            if db:
+                pools[name] = db.pool_metrics()
+        return {'status': 'ok', 'pid': os.getpid(), 'functions': list(self.functions), 'pools': pools}
+
+
+app = App()
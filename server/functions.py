@@ -0,0 +1,57 @@
+"""
+Загрузка облачных функций backend/<name> в один процесс.
+
+У всех функций одинаковые имена модулей (index, db, tokens, ...), поэтому после
+импорта модули функции убираются из sys.modules: следующая функция получает
+свои копии, а обработчик продолжает работать со своими через ссылки модулей.
+Настройки модули читают при импорте, так что окружение задаётся до загрузки.
+Используется сервером server/app.py и бенчмарками.
+"""
+import importlib
+import json
+import sys
+from pathlib import Path
+
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+
+class Function:
+    def __init__(self, name: str, modules: dict):
+        self.name = name
+        self.modules = modules
+        self.index = modules['index']
+        self.handler = self.index.handler
+        # Рантайм, который умеет отдавать тело по частям, вызывает stream_handler (SSE)
+        self.stream_handler = getattr(self.index, 'stream_handler', self.handler)
+
+    def module(self, name: str):
+        """Модуль функции по имени или None, если функция его не использует"""
+        return self.modules.get(name)
+
+
+def load_function(name: str) -> Function:
+    path = FUNCTIONS_DIR / name
+    if not (path / 'index.py').exists():
+        raise ValueError(f'Нет функции {name} в {FUNCTIONS_DIR}')
+
+    before = set(sys.modules)
+    sys.path.insert(0, str(path))
+    try:
+        importlib.import_module('index')
+    finally:
+        sys.path.remove(str(path))
+
+    modules = {}
+    for module_name in set(sys.modules) - before:
+        module = sys.modules[module_name]
+        module_file = getattr(module, '__file__', None)
+        if module_file and Path(module_file).resolve().parent == path:
+            modules[module_name] = sys.modules.pop(module_name)
+    return Function(name, modules)
+
+
+def function_names() -> list:
+    """Функции из backend/func2url.json в порядке объявления"""
+    with open(FUNCTIONS_DIR / 'func2url.json', encoding='utf-8') as f:
+        return list(json.load(f))
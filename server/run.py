@@ -0,0 +1,45 @@
+"""
+Запуск всех функций одним сервером для своих машин: uvicorn с воркером на ядро.
+
+    DATABASE_URL=postgresql://... MAIN_DB_SCHEMA=t_p13393071_ai_romance_platform \\
+    JWT_SECRET=... AITUNNEL_API_KEY=... python server/run.py --port 8000 --workers 4
+
+Фронтенд ходит на https://<хост>/<функция> вместо адресов из backend/func2url.json.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=None, help='потоков обработчиков на воркер (SERVER_THREADS)')
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('Нужен uvicorn: pip install -r server/requirements.txt')
+
+    if args.threads:
+        os.environ['SERVER_THREADS'] = str(args.threads)
+    uvicorn.run(
+        'app:app',
+        app_dir=str(Path(__file__).resolve().parent),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        log_level=args.log_level,
+        # Строка трассировки tracing.py уже описывает каждый запрос
+        access_log=False,
+        lifespan='on'
+    )
+
+
+if __name__ == '__main__':
+    main()
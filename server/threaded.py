@@ -0,0 +1,95 @@
+"""
+Сервер «поток на запрос» на http.server с теми же функциями и тем же контрактом,
+что server/app.py. База для сравнения в benchmarks/server.py: каждое соединение
+держит свой поток всё время запроса, включая ожидание модели и отправку ответа.
+
+    python server/threaded.py --port 8001
+"""
+import argparse
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from app import app, build_event, context_for, response_parts, route  # noqa: E402
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Очередь accept по умолчанию (5) под сотнями соединений даёт сбросы и повторные SYN
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение посреди ответа или keep-alive — это не ошибка сервера
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        function = app.functions.get(route(url.path))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if function is None:
+            self._send(404, {'Content-Type': 'application/json'}, b'{"error": "not found"}')
+            return
+
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        event = build_event(self.command, url.path, url.query, headers, body)
+        status, response_headers, response_body = response_parts(
+            function.stream_handler(event, context_for(function.name, headers))
+        )
+        if isinstance(response_body, bytes):
+            self._send(status, response_headers, response_body)
+            return
+
+        self.send_response(status)
+        for key, value in response_headers.items():
+            self.send_header(key, value)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in response_body:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        finally:
+            close = getattr(response_body, 'close', None)
+            if close:
+                close()
+
+    def _send(self, status: int, headers: dict, body: bytes) -> None:
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_OPTIONS = _handle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+
+    server = Server((args.host, args.port), Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()